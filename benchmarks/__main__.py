@@ -0,0 +1,87 @@
+# Copyright 2022 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Runs the benchmarks, and prints the results as a JSON object.
+
+Run with `python -m benchmarks [--quick] [--filter SUBSTRING] [--output FILE]`, and
+compare two sets of results with `python -m benchmarks.compare BASE NEW`.
+"""
+import argparse
+import json
+import platform
+import sys
+from typing import Any, Dict, List, Optional
+
+from benchmarks import mxc_uri, regex
+from benchmarks._harness import Benchmark, run_benchmark
+from matrix_common.versionstring import get_distribution_version_string
+
+BENCHMARKS: List[Benchmark] = [*regex.BENCHMARKS, *mxc_uri.BENCHMARKS]
+
+
+def run(quick: bool = False, name_filter: str = "") -> Dict[str, Any]:
+    """Runs the benchmarks whose names contain `name_filter`.
+
+    Returns:
+        a JSON-serialisable object describing the environment and the results, keyed
+        by benchmark name.
+    """
+    try:
+        # The checkout being benchmarked, rather than wherever it is installed.
+        version = get_distribution_version_string("matrix-common", __file__)
+    except Exception:
+        version = None
+
+    results = {}
+    for benchmark in BENCHMARKS:
+        if name_filter in benchmark.name:
+            results[benchmark.name] = run_benchmark(benchmark, quick)
+
+    return {
+        "environment": {
+            "matrix_common": version,
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "platform": platform.platform(),
+            "quick": quick,
+        },
+        "results": results,
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description=__doc__)
+    parser.add_argument(
+        "--quick",
+        action="store_true",
+        help="time each benchmark once, to check that they run",
+    )
+    parser.add_argument(
+        "--filter",
+        default="",
+        help="only run the benchmarks whose names contain this",
+    )
+    parser.add_argument("--output", help="write the results to this file")
+    args = parser.parse_args(argv)
+
+    results = run(quick=args.quick, name_filter=args.filter)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+# Copyright 2022 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import statistics
+import timeit
+from typing import Callable, ContextManager, Dict, NamedTuple, Tuple, Union
+
+# A function to time, and the number of items it processes per call.
+Workload = Tuple[Callable[[], object], int]
+
+
+class Benchmark(NamedTuple):
+    name: str
+    # Sets up the workload when entered, and undoes any global changes when exited.
+    setup: Callable[[], ContextManager[Workload]]
+
+
+def run_benchmark(benchmark: Benchmark, quick: bool) -> Dict[str, Union[int, float]]:
+    """Times a benchmark.
+
+    Args:
+        benchmark: the benchmark to run.
+        quick: if true, time a single call rather than repeating calls for at least
+            a second. The results are only useful to check that the benchmark works.
+
+    Returns:
+        the number of items per call, and the best and median seconds per item.
+    """
+    with benchmark.setup() as (func, items):
+        timer = timeit.Timer(func)
+        if quick:
+            number, repeat = 1, 1
+        else:
+            number, _ = timer.autorange()
+            repeat = 5
+        per_item = [t / (number * items) for t in timer.repeat(repeat, number)]
+
+    best = min(per_item)
+    return {
+        "items": items,
+        "calls": number * repeat,
+        "best_seconds_per_item": best,
+        "median_seconds_per_item": statistics.median(per_item),
+        "items_per_second": 1 / best if best else float("inf"),
+    }
@@ -0,0 +1,81 @@
+# Copyright 2022 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Compares two sets of results from `python -m benchmarks`.
+
+Run with `python -m benchmarks.compare BASE NEW [--threshold RATIO]`. Prints how much
+slower or faster each benchmark got, and exits with status 1 if any got slower by
+more than the threshold.
+"""
+import argparse
+import json
+import sys
+from typing import Any, Dict, List, Optional, Tuple
+
+
+def compare(
+    base: Dict[str, Any], new: Dict[str, Any]
+) -> List[Tuple[str, float, float, float]]:
+    """Compares the best time per item of the benchmarks present in both results.
+
+    Returns:
+        the name, base and new times and the ratio of new to base for each benchmark.
+    """
+    rows = []
+    for name, new_result in new["results"].items():
+        base_result = base["results"].get(name)
+        if base_result is None:
+            continue
+        base_time = base_result["best_seconds_per_item"]
+        new_time = new_result["best_seconds_per_item"]
+        rows.append((name, base_time, new_time, new_time / base_time))
+    return rows
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks.compare", description=__doc__
+    )
+    parser.add_argument("base", help="the results to compare against")
+    parser.add_argument("new", help="the results to compare")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=1.25,
+        help="the ratio of new to base time above which to fail (default: 1.25)",
+    )
+    args = parser.parse_args(argv)
+
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+
+    regressed = False
+    for name, base_time, new_time, ratio in compare(base, new):
+        flag = ""
+        if ratio > args.threshold:
+            flag = "  SLOWER"
+            regressed = True
+        elif ratio < 1 / args.threshold:
+            flag = "  faster"
+        print(
+            f"{name:45} {base_time * 1e6:12.3f}us {new_time * 1e6:12.3f}us"
+            f" {ratio:7.2f}x{flag}"
+        )
+
+    sys.exit(1 if regressed else 0)
+
+
+if __name__ == "__main__":
+    main()
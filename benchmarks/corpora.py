@@ -0,0 +1,104 @@
+# Copyright 2022 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Deterministic corpora resembling what Synapse matches globs and MXC URIs against."""
+import random
+from typing import List
+
+_WORDS = (
+    "the be to of and a in that have it for not on with he as you do at this but "
+    "his by from they we say her she or an will my one all would there their what "
+    "so up out if about who get which go me when make can like time no just him "
+    "know take people into year your good some could them see other than then now "
+    "look only come its over think also back after use two how our work first well "
+    "way even new want because any these give day most us deploy server room "
+    "message release meeting lunch review bug fix merge branch test broken outage "
+    "urgent tomorrow today thanks please ok yes lol 👍 🎉 café naïve"
+).split()
+
+# Push rule patterns: the user's localpart and display name, `@room`, and some
+# keyword rules. They are matched against message bodies at word boundaries.
+PUSH_RULE_GLOBS = [
+    "alice",
+    "Alice Liddell",
+    "@room",
+    "deploy*",
+    "*outage*",
+    "release v?.*",
+    "urgent",
+    "bug #*",
+]
+
+# Event type patterns, matched against whole event types.
+EVENT_TYPE_GLOBS = ["m.room.message", "m.call.*", "m.room.encrypted", "m.reaction"]
+EVENT_TYPES = [
+    "m.room.message",
+    "m.room.encrypted",
+    "m.reaction",
+    "m.room.member",
+    "m.call.invite",
+    "m.room.redaction",
+    "org.example.custom",
+]
+
+# A server ACL: a deny list of a few hand-written entries plus the kind of long
+# list of banned domains that large rooms accumulate.
+ACL_DENY_GLOBS = [
+    "evil.example",
+    "*.evil.example",
+    "203.0.113.*",
+    "*.spam.*",
+    "bad?.example.org",
+    *(f"*.banned{i}.example" for i in range(200)),
+    *(f"banned{i}.example" for i in range(200)),
+]
+
+
+def message_bodies(count: int, seed: int = 0) -> List[str]:
+    """Returns message bodies of a few to a few dozen words."""
+    rng = random.Random(seed)
+    bodies = []
+    for _ in range(count):
+        words = rng.choices(_WORDS, k=rng.randint(3, 40))
+        if rng.random() < 0.05:
+            words.insert(rng.randrange(len(words)), "alice")
+        if rng.random() < 0.02:
+            words.append("https://example.com/some/path?query=1")
+        bodies.append(" ".join(words).capitalize())
+    return bodies
+
+
+def server_names(count: int, seed: int = 0) -> List[str]:
+    """Returns server names: mostly DNS names, some with ports or IP literals."""
+    rng = random.Random(seed)
+    names = []
+    for _ in range(count):
+        roll = rng.random()
+        if roll < 0.1:
+            name = "203.0.113.%d" % rng.randrange(256)
+        elif roll < 0.15:
+            name = f"banned{rng.randrange(400)}.example"
+        else:
+            labels = rng.choices(_WORDS[:100], k=rng.randint(1, 3))
+            name = ".".join([*labels, rng.choice(["org", "com", "net", "example"])])
+        if rng.random() < 0.1:
+            name += ":%d" % rng.choice([8448, 443, 8008])
+        names.append(name)
+    return names
+
+
+def media_ids(count: int, seed: int = 0) -> List[str]:
+    """Returns media IDs like Synapse's: 24 random ASCII letters."""
+    rng = random.Random(seed)
+    letters = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
+    return ["".join(rng.choices(letters, k=24)) for _ in range(count)]
@@ -0,0 +1,161 @@
+# Copyright 2022 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Benchmarks for parsing and formatting MXC URIs."""
+from contextlib import contextmanager
+from typing import Iterator, List
+
+from benchmarks._harness import Benchmark, Workload
+from benchmarks.corpora import media_ids, server_names
+from matrix_common.types import MXCUri
+from matrix_common.types.mxc_uri import parse_many, set_mxc_uri_parse_cache_size
+from matrix_common.types.server_name import (
+    DEFAULT_SERVER_NAME_PARSE_CACHE_SIZE,
+    clear_server_name_parse_cache,
+    set_server_name_parse_cache_size,
+)
+
+_MXC_URIS = [
+    MXCUri(server_name, media_id)
+    for server_name, media_id in zip(server_names(10_000), media_ids(10_000))
+]
+_MXC_URI_STRS = [str(mxc_uri) for mxc_uri in _MXC_URIS]
+# URIs which the fast path leaves to `urlparse`.
+_IPV6_MXC_URI_STRS = [
+    f"mxc://[2001:db8::{i:x}]:8448/{media_id}"
+    for i, media_id in enumerate(media_ids(1000))
+]
+
+
+@contextmanager
+def _from_str() -> Iterator[Workload]:
+    def parse_all() -> None:
+        for mxc_uri_str in _MXC_URI_STRS:
+            MXCUri.from_str(mxc_uri_str)
+
+    yield parse_all, len(_MXC_URI_STRS)
+
+
+@contextmanager
+def _from_str_urlparse() -> Iterator[Workload]:
+    def parse_all() -> None:
+        for mxc_uri_str in _IPV6_MXC_URI_STRS:
+            MXCUri.from_str(mxc_uri_str)
+
+    yield parse_all, len(_IPV6_MXC_URI_STRS)
+
+
+@contextmanager
+def _from_str_cached() -> Iterator[Workload]:
+    # A few popular URIs, such as avatars, parsed over and over.
+    mxc_uri_strs = _MXC_URI_STRS[:100] * 100
+
+    def parse_all() -> None:
+        for mxc_uri_str in mxc_uri_strs:
+            MXCUri.from_str(mxc_uri_str)
+
+    set_mxc_uri_parse_cache_size(1000)
+    try:
+        yield parse_all, len(mxc_uri_strs)
+    finally:
+        set_mxc_uri_parse_cache_size(0)
+
+
+@contextmanager
+def _parse_many() -> Iterator[Workload]:
+    lines = [mxc_uri_str + "\n" for mxc_uri_str in _MXC_URI_STRS]
+    yield lambda: sum(1 for _ in parse_many(lines)), len(lines)
+
+
+@contextmanager
+def _from_bytes() -> Iterator[Workload]:
+    mxc_uri_bytes = [mxc_uri_str.encode("ascii") for mxc_uri_str in _MXC_URI_STRS]
+
+    def parse_all() -> None:
+        for value in mxc_uri_bytes:
+            MXCUri.from_bytes(value)
+
+    yield parse_all, len(mxc_uri_bytes)
+
+
+@contextmanager
+def _to_str() -> Iterator[Workload]:
+    def format_all() -> None:
+        for mxc_uri in _MXC_URIS:
+            str(mxc_uri)
+
+    yield format_all, len(_MXC_URIS)
+
+
+@contextmanager
+def _to_bytes() -> Iterator[Workload]:
+    def format_all() -> None:
+        for mxc_uri in _MXC_URIS:
+            bytes(mxc_uri)
+
+    yield format_all, len(_MXC_URIS)
+
+
+@contextmanager
+def _parsed_server_name() -> Iterator[Workload]:
+    def parse_all() -> None:
+        for mxc_uri in _MXC_URIS:
+            mxc_uri.parsed_server_name
+
+    yield parse_all, len(_MXC_URIS)
+
+
+@contextmanager
+def _parsed_server_name_uncached() -> Iterator[Workload]:
+    def parse_all() -> None:
+        for mxc_uri in _MXC_URIS:
+            mxc_uri.parsed_server_name
+
+    set_server_name_parse_cache_size(0)
+    try:
+        yield parse_all, len(_MXC_URIS)
+    finally:
+        set_server_name_parse_cache_size(DEFAULT_SERVER_NAME_PARSE_CACHE_SIZE)
+
+
+@contextmanager
+def _parsed_server_name_misses() -> Iterator[Workload]:
+    # Every server name is distinct, so that each access misses the cache.
+    mxc_uris = [
+        MXCUri(f"{i}.{mxc_uri.server_name}", mxc_uri.media_id)
+        for i, mxc_uri in enumerate(_MXC_URIS)
+    ]
+
+    def parse_all() -> None:
+        for mxc_uri in mxc_uris:
+            mxc_uri.parsed_server_name
+
+    clear_server_name_parse_cache()
+    try:
+        yield parse_all, len(mxc_uris)
+    finally:
+        clear_server_name_parse_cache()
+
+
+BENCHMARKS: List[Benchmark] = [
+    Benchmark("mxc_uri.from_str", _from_str),
+    Benchmark("mxc_uri.from_str.urlparse", _from_str_urlparse),
+    Benchmark("mxc_uri.from_str.cached", _from_str_cached),
+    Benchmark("mxc_uri.parse_many", _parse_many),
+    Benchmark("mxc_uri.from_bytes", _from_bytes),
+    Benchmark("mxc_uri.str", _to_str),
+    Benchmark("mxc_uri.bytes", _to_bytes),
+    Benchmark("mxc_uri.parsed_server_name", _parsed_server_name),
+    Benchmark("mxc_uri.parsed_server_name.uncached", _parsed_server_name_uncached),
+    Benchmark("mxc_uri.parsed_server_name.misses", _parsed_server_name_misses),
+]
@@ -0,0 +1,64 @@
+# Copyright 2022 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Compares the memory used by an `MXCUriSet` and a `set` of `MXCUri`s.
+
+Run with `python -m benchmarks.mxc_uri_set_memory [count]`. Prints a JSON object.
+"""
+import gc
+import json
+import sys
+import tracemalloc
+from typing import Callable, Iterator, Mapping, Union
+
+from matrix_common.types import MXCUri, MXCUriSet
+
+
+def _generate_uris(count: int) -> Iterator[MXCUri]:
+    # Media IDs like Synapse's: 24 random-looking ASCII letters, over a few hundred
+    # servers with a skewed distribution.
+    for i in range(count):
+        server_name = f"server{(i * i) % 300}.example.com"
+        media_id = f"{i:024x}".translate(str.maketrans("0123456789", "ghijklmnop"))
+        yield MXCUri(server_name, media_id)
+
+
+def _measure(build: Callable[[], object]) -> int:
+    """Returns the number of bytes still allocated by `build` once it returns."""
+    gc.collect()
+    tracemalloc.start()
+    try:
+        result = build()
+        gc.collect()
+        size, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del result
+    return size
+
+
+def run(count: int) -> Mapping[str, Union[int, float]]:
+    set_bytes = _measure(lambda: set(_generate_uris(count)))
+    mxc_uri_set_bytes = _measure(lambda: MXCUriSet(_generate_uris(count)))
+    return {
+        "count": count,
+        "set_bytes": set_bytes,
+        "mxc_uri_set_bytes": mxc_uri_set_bytes,
+        "ratio": mxc_uri_set_bytes / set_bytes,
+    }
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    json.dump(run(count), sys.stdout)
+    print()
@@ -0,0 +1,233 @@
+# Copyright 2022 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Benchmarks for compiling globs and matching them in `matrix_common.regex`."""
+from contextlib import contextmanager
+from typing import Iterator, List
+
+from benchmarks._harness import Benchmark, Workload
+from benchmarks.corpora import (
+    ACL_DENY_GLOBS,
+    EVENT_TYPE_GLOBS,
+    EVENT_TYPES,
+    PUSH_RULE_GLOBS,
+    message_bodies,
+    server_names,
+)
+from matrix_common.regex import (
+    DomainGlobSet,
+    GlobBackend,
+    GlobSet,
+    KeyedConditionEvaluator,
+    MatchContext,
+    clear_glob_cache,
+    glob_to_matcher,
+    glob_to_regex,
+    to_word_pattern,
+)
+
+_BODIES = message_bodies(1000)
+# Synapse strips the port before checking server ACLs.
+_HOSTS = [name.rsplit(":", 1)[0] for name in server_names(1000)]
+_COMPILE_GLOBS = PUSH_RULE_GLOBS + EVENT_TYPE_GLOBS + ACL_DENY_GLOBS
+
+
+@contextmanager
+def _compile_uncached() -> Iterator[Workload]:
+    def compile_all() -> None:
+        clear_glob_cache()
+        for glob in _COMPILE_GLOBS:
+            glob_to_regex(glob)
+            glob_to_regex(glob, word_boundary=True)
+
+    try:
+        yield compile_all, 2 * len(_COMPILE_GLOBS)
+    finally:
+        clear_glob_cache()
+
+
+@contextmanager
+def _compile_cached() -> Iterator[Workload]:
+    def compile_all() -> None:
+        for glob in _COMPILE_GLOBS:
+            glob_to_regex(glob)
+            glob_to_regex(glob, word_boundary=True)
+
+    compile_all()
+    yield compile_all, 2 * len(_COMPILE_GLOBS)
+
+
+@contextmanager
+def _to_word_pattern() -> Iterator[Workload]:
+    patterns = [glob_to_regex(glob).pattern for glob in _COMPILE_GLOBS]
+
+    def convert_all() -> None:
+        for pattern in patterns:
+            to_word_pattern(pattern)
+
+    yield convert_all, len(patterns)
+
+
+@contextmanager
+def _build_matchers() -> Iterator[Workload]:
+    def build_all() -> None:
+        for glob in _COMPILE_GLOBS:
+            glob_to_matcher(glob, word_boundary=True)
+
+    yield build_all, len(_COMPILE_GLOBS)
+
+
+@contextmanager
+def _push_rules_regex() -> Iterator[Workload]:
+    # As Synapse's push rule evaluator did: one word-boundary regex per rule.
+    patterns = [glob_to_regex(glob, word_boundary=True) for glob in PUSH_RULE_GLOBS]
+
+    def match_all() -> None:
+        for body in _BODIES:
+            for pattern in patterns:
+                pattern.search(body)
+
+    yield match_all, len(_BODIES) * len(patterns)
+
+
+def _push_rules_matchers(backend: GlobBackend) -> Benchmark:
+    @contextmanager
+    def setup() -> Iterator[Workload]:
+        matchers = [
+            glob_to_matcher(glob, word_boundary=True, backend=backend)
+            for glob in PUSH_RULE_GLOBS
+        ]
+
+        def match_all() -> None:
+            for body in _BODIES:
+                context = MatchContext(body)
+                for matcher in matchers:
+                    matcher.match_context(context)
+
+        yield match_all, len(_BODIES) * len(matchers)
+
+    return Benchmark(f"regex.push_rules.matcher.{backend.name.lower()}", setup)
+
+
+@contextmanager
+def _push_rules_glob_set() -> Iterator[Workload]:
+    glob_set = GlobSet(PUSH_RULE_GLOBS, word_boundary=True)
+
+    def match_all() -> None:
+        for body in _BODIES:
+            glob_set.matches(body)
+
+    yield match_all, len(_BODIES) * len(PUSH_RULE_GLOBS)
+
+
+@contextmanager
+def _push_rules_evaluator() -> Iterator[Workload]:
+    # A rule per keyword, each also checking the event type, as push rules do.
+    evaluator = KeyedConditionEvaluator(
+        [("type", "m.room.message"), ("content.body", glob)] for glob in PUSH_RULE_GLOBS
+    )
+    events = [
+        {"type": EVENT_TYPES[i % len(EVENT_TYPES)], "content.body": body}
+        for i, body in enumerate(_BODIES)
+    ]
+
+    def evaluate_all() -> None:
+        for event in events:
+            evaluator.evaluate(event)
+
+    yield evaluate_all, len(events)
+
+
+@contextmanager
+def _event_types() -> Iterator[Workload]:
+    matchers = [glob_to_matcher(glob) for glob in EVENT_TYPE_GLOBS]
+    event_types = EVENT_TYPES * 100
+
+    def match_all() -> None:
+        for event_type in event_types:
+            for matcher in matchers:
+                matcher.match(event_type)
+
+    yield match_all, len(event_types) * len(matchers)
+
+
+@contextmanager
+def _acl_regex() -> Iterator[Workload]:
+    # As Synapse's server ACL check did: one anchored regex per glob.
+    patterns = [glob_to_regex(glob) for glob in ACL_DENY_GLOBS]
+
+    def match_all() -> None:
+        for host in _HOSTS:
+            any(pattern.match(host) for pattern in patterns)
+
+    yield match_all, len(_HOSTS)
+
+
+@contextmanager
+def _acl_glob_set() -> Iterator[Workload]:
+    glob_set = GlobSet(ACL_DENY_GLOBS)
+
+    def match_all() -> None:
+        for host in _HOSTS:
+            glob_set.match_any(host)
+
+    yield match_all, len(_HOSTS)
+
+
+@contextmanager
+def _acl_domain_glob_set() -> Iterator[Workload]:
+    domain_glob_set = DomainGlobSet(ACL_DENY_GLOBS)
+
+    def match_all() -> None:
+        for host in _HOSTS:
+            domain_glob_set.match_any(host)
+
+    yield match_all, len(_HOSTS)
+
+
+def _adversarial(backend: GlobBackend, glob: str, length: int) -> Benchmark:
+    """Matches a glob which backtracking regex engines handle badly.
+
+    Bodies of `a`s never match globs ending in `b`, so a backtracking engine tries
+    every way of splitting the body between the `*`s.
+    """
+
+    @contextmanager
+    def setup() -> Iterator[Workload]:
+        matcher = glob_to_matcher(glob, backend=backend)
+        body = "a" * length
+        yield lambda: matcher.match(body), 1
+
+    return Benchmark(f"regex.adversarial.{backend.name.lower()}.n{length}", setup)
+
+
+BENCHMARKS: List[Benchmark] = [
+    Benchmark("regex.compile.uncached", _compile_uncached),
+    Benchmark("regex.compile.cached", _compile_cached),
+    Benchmark("regex.compile.to_word_pattern", _to_word_pattern),
+    Benchmark("regex.compile.matcher", _build_matchers),
+    Benchmark("regex.push_rules.regex", _push_rules_regex),
+    _push_rules_matchers(GlobBackend.REGEX),
+    _push_rules_matchers(GlobBackend.LINEAR),
+    Benchmark("regex.push_rules.glob_set", _push_rules_glob_set),
+    Benchmark("regex.push_rules.evaluator", _push_rules_evaluator),
+    Benchmark("regex.event_types.matcher", _event_types),
+    Benchmark("regex.acl.regex", _acl_regex),
+    Benchmark("regex.acl.glob_set", _acl_glob_set),
+    Benchmark("regex.acl.domain_glob_set", _acl_domain_glob_set),
+    # `re` takes time polynomial in the body length, to the power of the number of
+    # `*`s, so only short bodies are practical. The linear backend also gets long
+    # ones.
+    *(_adversarial(GlobBackend.REGEX, "*a*a*a*a*b", n) for n in (16, 32, 48)),
+    *(_adversarial(GlobBackend.LINEAR, "*a*a*a*a*b", n) for n in (48, 1000, 100_000)),
+]
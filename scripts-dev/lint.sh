@@ -10,6 +10,7 @@ set -e
 files=(
   "src"
   "tests"
+  "benchmarks"
 )
 
 # Print out the commands being run
@@ -0,0 +1,116 @@
+# Copyright 2022 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Generic, Hashable, NamedTuple, TypeVar
+
+KT = TypeVar("KT", bound=Hashable)
+VT = TypeVar("VT")
+
+# Returned by lookups of missing keys. Cheaper than catching a `KeyError`, which
+# matters on the miss path of caches which mostly see distinct keys.
+_MISSING: Any = object()
+
+
+class CacheInfo(NamedTuple):
+    """A snapshot of the statistics of an `LruCache`."""
+
+    hits: int
+    misses: int
+    evictions: int
+    maxsize: int
+    currsize: int
+
+
+class LruCache(Generic[KT, VT]):
+    """A thread-safe, bounded, least-recently-used cache with statistics.
+
+    Unlike `functools.lru_cache`, the cache can be resized at runtime and counts
+    evictions. A `maxsize` of 0 disables caching entirely.
+    """
+
+    def __init__(self, maxsize: int) -> None:
+        if maxsize < 0:
+            raise ValueError(f"maxsize must not be negative: {maxsize}")
+
+        self._maxsize = maxsize
+        self._data: "OrderedDict[KT, VT]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    @property
+    def maxsize(self) -> int:
+        """The maximum number of entries. 0 if caching is disabled."""
+        return self._maxsize
+
+    def get_or_compute(self, key: KT, compute: Callable[[], VT]) -> VT:
+        """Returns the cached value for `key`, calling `compute` to fill it on a miss.
+
+        `compute` is called without holding the cache lock, so it may be called more
+        than once for the same key if several threads miss at the same time.
+        """
+        with self._lock:
+            value: VT = self._data.get(key, _MISSING)
+            if value is _MISSING:
+                self._misses += 1
+            else:
+                self._hits += 1
+                self._data.move_to_end(key)
+                return value
+
+        value = compute()
+
+        with self._lock:
+            if self._maxsize > 0:
+                self._data[key] = value
+                self._data.move_to_end(key)
+                self._evict()
+
+        return value
+
+    def resize(self, maxsize: int) -> None:
+        """Changes the maximum number of entries, evicting entries if necessary."""
+        if maxsize < 0:
+            raise ValueError(f"maxsize must not be negative: {maxsize}")
+
+        with self._lock:
+            self._maxsize = maxsize
+            self._evict()
+
+    def clear(self) -> None:
+        """Removes all entries and resets the statistics."""
+        with self._lock:
+            self._data.clear()
+            self._hits = 0
+            self._misses = 0
+            self._evictions = 0
+
+    def info(self) -> CacheInfo:
+        """Returns a snapshot of the cache statistics."""
+        with self._lock:
+            return CacheInfo(
+                hits=self._hits,
+                misses=self._misses,
+                evictions=self._evictions,
+                maxsize=self._maxsize,
+                currsize=len(self._data),
+            )
+
+    def _evict(self) -> None:
+        # Must be called with `_lock` held.
+        while len(self._data) > self._maxsize:
+            self._data.popitem(last=False)
+            self._evictions += 1
@@ -0,0 +1,892 @@
+# Copyright 2022 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Reads the metadata of a git checkout without running `git`.
+
+`read_git_metadata` gives the same answers as
+
+    git rev-parse --abbrev-ref HEAD
+    git describe --exact-match
+    git rev-parse --short HEAD
+
+by reading `HEAD`, loose refs, `packed-refs` and pack indices directly. Whenever a
+repository uses a feature which could change those answers and which is not handled
+here, it returns `None` so that the caller can run `git` instead.
+"""
+import logging
+import os
+import shutil
+import struct
+import time
+import zlib
+from typing import BinaryIO, Dict, List, NamedTuple, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Environment variables which change how git finds or reads a repository.
+_GIT_ENVIRONMENT_VARIABLES = (
+    "GIT_DIR",
+    "GIT_WORK_TREE",
+    "GIT_COMMON_DIR",
+    "GIT_CEILING_DIRECTORIES",
+    "GIT_DISCOVERY_ACROSS_FILESYSTEM",
+    "GIT_OBJECT_DIRECTORY",
+    "GIT_ALTERNATE_OBJECT_DIRECTORIES",
+    "GIT_NAMESPACE",
+    "GIT_REPLACE_REF_BASE",
+    "GIT_NO_REPLACE_OBJECTS",
+)
+
+# Configuration which changes the answers, and is not handled here.
+_UNSUPPORTED_CONFIG = (
+    b"abbrev",
+    b"ambiguous",
+    b"extensions",
+    b"include",
+    b"worktree",
+)
+
+# As `FALLBACK_DEFAULT_ABBREV` in git.
+_MIN_ABBREV = 7
+
+_SHA1_HEX_LENGTH = 40
+_HEX_DIGITS = frozenset("0123456789abcdef")
+
+# How long after a change timestamps are not trusted to change again. Some
+# filesystems only store timestamps to the second, or even two seconds.
+_RACY_NS = 2_000_000_000
+
+# Pack object types, as in git's `object_type`.
+_OBJ_TYPES = {1: b"commit", 2: b"tree", 3: b"blob", 4: b"tag"}
+_OBJ_TAG = 4
+_OBJ_OFS_DELTA = 6
+_OBJ_REF_DELTA = 7
+
+# git's default `pack.depth` is 50, but it may be raised up to this.
+_MAX_DELTA_DEPTH = 4095
+
+
+class GitMetadata(NamedTuple):
+    # The output of `git rev-parse --abbrev-ref HEAD`, or "" if it fails.
+    branch: str
+    # The output of `git describe --exact-match`, or "" if it fails.
+    tag: str
+    # The output of `git rev-parse --short HEAD`, or "" if it fails.
+    commit: str
+    # Whether `git describe` could succeed. It fails if there are no annotated tags.
+    describable: bool
+
+
+_NO_METADATA = GitMetadata("", "", "", False)
+
+
+class _Unsupported(Exception):
+    """Raised when the repository needs the git CLI to be read correctly."""
+
+
+_READ_ERRORS = (
+    _Unsupported,
+    OSError,
+    ValueError,
+    IndexError,
+    zlib.error,
+    struct.error,
+)
+
+
+def read_git_metadata(cwd: str) -> Optional[GitMetadata]:
+    """Reads the branch, tag and commit of the checkout containing `cwd`.
+
+    Returns:
+        the metadata, as `git` would report it if run in `cwd`, or `None` if `git`
+        must be run to find out.
+    """
+    if _git_environment_overridden():
+        return None
+
+    # Mirror the failures of running `git` in `cwd`.
+    if shutil.which("git") is None or not os.path.isdir(cwd):
+        return _NO_METADATA
+
+    try:
+        repository = _Repository.discover(cwd)
+        if repository is None:
+            return _NO_METADATA
+        return repository.read_metadata()
+    except _READ_ERRORS as e:
+        logger.debug("Falling back to the git CLI for %s: %r", cwd, e)
+        return None
+
+
+class CheckoutFingerprint(NamedTuple):
+    # A digest of the state of the checkout.
+    digest: str
+    # Whether some file changed too recently for its timestamps to be trusted: it
+    # could change again without its timestamps changing.
+    racy: bool
+
+
+def checkout_fingerprint(cwd: str) -> Optional[CheckoutFingerprint]:
+    """Computes a cheap fingerprint of the git checkout containing `cwd`.
+
+    The fingerprint changes whenever the output of `read_git_metadata`, or of
+    `git describe --dirty`, could change. It digests the stat information of the
+    repository's refs, index and configuration and of every tracked file, rather
+    than comparing any contents.
+
+    Returns:
+        the fingerprint, or `None` if the checkout cannot be fingerprinted, for
+        example because it is not in a repository or has submodules.
+    """
+    if _git_environment_overridden() or not os.path.isdir(cwd):
+        return None
+
+    try:
+        repository = _Repository.discover(cwd)
+        if repository is None:
+            return None
+        return repository.fingerprint()
+    except _READ_ERRORS as e:
+        logger.debug("Cannot fingerprint the checkout at %s: %r", cwd, e)
+        return None
+
+
+def _git_environment_overridden() -> bool:
+    return any(name in os.environ for name in _GIT_ENVIRONMENT_VARIABLES) or any(
+        name.startswith("GIT_CONFIG") for name in os.environ
+    )
+
+
+def _is_git_directory(path: str) -> bool:
+    """As `is_git_directory` in git."""
+    return (
+        os.path.isfile(os.path.join(path, "HEAD"))
+        and os.path.isdir(os.path.join(_common_dir(path), "objects"))
+        and os.path.isdir(os.path.join(_common_dir(path), "refs"))
+    )
+
+
+def _common_dir(gitdir: str) -> str:
+    """Returns the directory holding the refs and objects of a git directory.
+
+    This differs from the git directory for linked worktrees.
+    """
+    commondir_file = os.path.join(gitdir, "commondir")
+    if os.path.isfile(commondir_file):
+        return os.path.join(gitdir, _read_text(commondir_file))
+    return gitdir
+
+
+def _read_text(path: str) -> str:
+    with open(path, "rb") as f:
+        return f.read().decode("utf-8").strip()
+
+
+def _common_hex_prefix(left: str, right: str) -> int:
+    length = 0
+    for left_char, right_char in zip(left, right):
+        if left_char != right_char:
+            break
+        length += 1
+    return length
+
+
+class _PackIndex:
+    """A version 2 pack index (`.idx`) file."""
+
+    _HEADER = b"\xfftOc\x00\x00\x00\x02"
+    _FANOUT_OFFSET = len(_HEADER)
+    _NAMES_OFFSET = _FANOUT_OFFSET + 256 * 4
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        with open(path, "rb") as f:
+            header = f.read(self._NAMES_OFFSET)
+        if header[: self._FANOUT_OFFSET] != self._HEADER:
+            raise _Unsupported(f"Unsupported pack index {path}")
+        self._fanout = struct.unpack(">256I", header[self._FANOUT_OFFSET :])
+        self.num_objects = self._fanout[255]
+
+    def _name(self, f: BinaryIO, position: int) -> str:
+        f.seek(self._NAMES_OFFSET + 20 * position)
+        return f.read(20).hex()
+
+    def neighbours(self, sha: str) -> Tuple[Optional[int], List[str]]:
+        """Finds an object in the index.
+
+        Returns:
+            the position of the object, if present, and the names of the objects on
+            either side of where it is or would be.
+        """
+        first_byte = int(sha[:2], 16)
+        low = self._fanout[first_byte - 1] if first_byte else 0
+        high = self._fanout[first_byte]
+
+        with open(self.path, "rb") as f:
+            while low < high:
+                middle = (low + high) // 2
+                if self._name(f, middle) < sha:
+                    low = middle + 1
+                else:
+                    high = middle
+
+            found = low < self.num_objects and self._name(f, low) == sha
+            candidates = [low - 1, low + 1 if found else low]
+            names = [
+                self._name(f, position)
+                for position in candidates
+                if 0 <= position < self.num_objects
+            ]
+
+        return (low if found else None), names
+
+    def offset(self, f: BinaryIO, position: int) -> int:
+        """Returns the offset in the pack of the object at `position`."""
+        offsets_table = self._NAMES_OFFSET + 24 * self.num_objects
+        f.seek(offsets_table + 4 * position)
+        offset: int = struct.unpack(">I", f.read(4))[0]
+        if offset & 0x80000000:
+            large_offsets_table = offsets_table + 4 * self.num_objects
+            f.seek(large_offsets_table + 8 * (offset & 0x7FFFFFFF))
+            offset = struct.unpack(">Q", f.read(8))[0]
+        return offset
+
+
+class _Repository:
+    def __init__(self, worktree: str, gitdir: str) -> None:
+        self.worktree = worktree
+        self.gitdir = gitdir
+
+        self.commondir = _common_dir(gitdir)
+        self.objects = os.path.join(self.commondir, "objects")
+
+        self._packed_refs: Optional[Dict[str, Tuple[str, Optional[str]]]] = None
+        self._tags_peeled = False
+        self._pack_indices: Optional[List[_PackIndex]] = None
+
+    @classmethod
+    def discover(cls, cwd: str) -> Optional["_Repository"]:
+        """Finds the repository containing `cwd`, as git's setup does.
+
+        Returns:
+            the repository, or `None` if `cwd` is not in a repository.
+        """
+        directory = os.path.abspath(cwd)
+        device = os.stat(directory).st_dev
+        while True:
+            dotgit = os.path.join(directory, ".git")
+            if os.path.isfile(dotgit):
+                content = _read_text(dotgit)
+                if not content.startswith("gitdir: "):
+                    raise _Unsupported(f"Invalid gitfile {dotgit}")
+                gitdir = os.path.join(directory, content[len("gitdir: ") :])
+                if not _is_git_directory(gitdir):
+                    raise _Unsupported(f"Invalid gitdir {gitdir}")
+                repository = cls(directory, gitdir)
+                repository.check_ownership(dotgit)
+                return repository
+
+            if os.path.isdir(dotgit) and _is_git_directory(dotgit):
+                repository = cls(directory, dotgit)
+                repository.check_ownership()
+                return repository
+
+            if _is_git_directory(directory):
+                # A bare repository, or the inside of a .git directory.
+                raise _Unsupported(f"{directory} is a git directory")
+
+            parent = os.path.dirname(directory)
+            if parent == directory:
+                return None
+            if os.stat(parent).st_dev != device:
+                # git stops at filesystem boundaries.
+                raise _Unsupported(f"{parent} is on another filesystem")
+            directory = parent
+
+    def check_ownership(self, *paths: str) -> None:
+        """Defers to git if it might refuse to use the repository.
+
+        git refuses to work in repositories owned by other users, unless they are
+        allowed by its `safe.directory` configuration.
+        """
+        if not hasattr(os, "geteuid"):
+            raise _Unsupported("Cannot check ownership on this platform")
+        for path in (*paths, self.worktree, self.gitdir):
+            if os.stat(path).st_uid != os.geteuid():
+                raise _Unsupported(f"{path} is owned by another user")
+
+    def config_files(self) -> List[str]:
+        """Returns the paths of the configuration files git would read."""
+        config_files = [os.path.join(self.commondir, "config"), "/etc/gitconfig"]
+        home = os.path.expanduser("~")
+        config_files.append(os.path.join(home, ".gitconfig"))
+        xdg_config_home = os.environ.get("XDG_CONFIG_HOME") or os.path.join(
+            home, ".config"
+        )
+        config_files.append(os.path.join(xdg_config_home, "git", "config"))
+        if self.commondir != self.gitdir:
+            config_files.append(os.path.join(self.gitdir, "config.worktree"))
+        return config_files
+
+    def check_config(self) -> None:
+        for path in self.config_files():
+            try:
+                with open(path, "rb") as f:
+                    config = f.read().lower()
+            except FileNotFoundError:
+                continue
+            for keyword in _UNSUPPORTED_CONFIG:
+                if keyword in config:
+                    raise _Unsupported(f"{path} mentions {keyword!r}")
+
+        for path in ("info/alternates", "pack/multi-pack-index"):
+            if os.path.exists(os.path.join(self.objects, path)):
+                raise _Unsupported(f"Repository has {path}")
+        if os.path.exists(os.path.join(self.commondir, "refs", "replace")):
+            raise _Unsupported("Repository has replace refs")
+
+    def read_metadata(self) -> GitMetadata:
+        self.check_config()
+
+        head = _read_text(os.path.join(self.gitdir, "HEAD"))
+        if head.startswith("ref: "):
+            head_ref: Optional[str] = head[len("ref: ") :]
+            head_sha = self.resolve_ref(head[len("ref: ") :])
+        else:
+            head_ref = None
+            head_sha = self._check_sha(head)
+
+        if head_sha is None:
+            # An unborn branch: `HEAD` does not name a commit yet.
+            return _NO_METADATA
+
+        tag, has_annotated_tags = self.find_exact_tag(head_sha)
+        return GitMetadata(
+            branch=self.abbreviate_ref(head_ref) if head_ref else "HEAD",
+            tag=tag,
+            commit=self.abbreviate_sha(head_sha),
+            describable=has_annotated_tags,
+        )
+
+    def fingerprint(self) -> CheckoutFingerprint:
+        self.check_config()
+
+        import hashlib
+
+        hasher = hashlib.sha256()
+        racy_after = time.time_ns() - _RACY_NS
+        racy = False
+
+        def add(*fields: object) -> None:
+            hasher.update(repr(fields).encode("utf-8", "surrogateescape"))
+
+        def add_stat(path: str) -> None:
+            nonlocal racy
+            try:
+                st = os.lstat(path)
+            except FileNotFoundError:
+                add(path)
+                return
+            if max(st.st_mtime_ns, st.st_ctime_ns) >= racy_after:
+                racy = True
+            add(path, st.st_mtime_ns, st.st_ctime_ns, st.st_size, st.st_ino, st.st_mode)
+
+        add(shutil.which("git"))
+
+        # HEAD, the refs it might point at and the objects its abbreviation depends
+        # on. git writes refs by renaming, which also changes the directory mtimes.
+        head_path = os.path.join(self.gitdir, "HEAD")
+        add_stat(head_path)
+        head = _read_text(head_path)
+        add(head)
+        head_sha = (
+            self.resolve_ref(head[len("ref: ") :]) if head.startswith("ref: ") else head
+        )
+        if head_sha is not None:
+            add_stat(os.path.join(self.objects, head_sha[:2]))
+        for directory in dict.fromkeys((self.gitdir, self.commondir)):
+            for dirpath, dirnames, filenames in os.walk(
+                os.path.join(directory, "refs")
+            ):
+                dirnames.sort()
+                add_stat(dirpath)
+                for filename in sorted(filenames):
+                    add_stat(os.path.join(dirpath, filename))
+        add_stat(os.path.join(self.commondir, "packed-refs"))
+        add_stat(os.path.join(self.objects, "pack"))
+        add_stat(os.path.join(self.objects, "info"))
+
+        # Configuration, and everything `git describe --dirty` compares.
+        for path in self.config_files():
+            add_stat(path)
+        add_stat(os.path.join(self.commondir, "info", "attributes"))
+        # Not the stat information of the index: `git describe --dirty` itself
+        # rewrites the cached stat information in it.
+        for path, staged in self.index_entries():
+            add(staged)
+            add_stat(os.path.join(self.worktree, path))
+
+        return CheckoutFingerprint(hasher.hexdigest(), racy)
+
+    def index_entries(self) -> List[Tuple[str, bytes]]:
+        """Reads the index, as `read_index` in git.
+
+        Returns:
+            the path of each entry, with its mode, object name and flags.
+
+        Raises:
+            _Unsupported: if the index has submodules, or is split or sparse.
+        """
+        try:
+            with open(os.path.join(self.gitdir, "index"), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return []
+
+        signature, version, count = struct.unpack_from(">4sII", data)
+        if signature != b"DIRC" or version not in (2, 3, 4):
+            raise _Unsupported(f"Unsupported index version {version}")
+
+        entries = []
+        position = 12
+        path = b""
+        for _ in range(count):
+            (mode,) = struct.unpack_from(">I", data, position + 24)
+            (flags,) = struct.unpack_from(">H", data, position + 60)
+            if mode & 0o170000 == 0o160000:
+                raise _Unsupported("Repository has submodules")
+
+            name_start = position + 62
+            if version >= 3 and flags & 0x4000:
+                name_start += 2
+            # Skip the cached stat information, which git updates as it pleases.
+            staged = (
+                data[position + 24 : position + 28] + data[position + 40 : name_start]
+            )
+            if version == 4:
+                # Each path is stored as the number of bytes to remove from the end
+                # of the previous one, then the bytes to append.
+                strip, name_start = _read_offset_varint(data, name_start)
+                name_end = data.index(b"\x00", name_start)
+                path = path[: len(path) - strip] + data[name_start:name_end]
+                position = name_end + 1
+            else:
+                # Entries are padded with 1-8 NULs to a multiple of 8 bytes.
+                name_end = data.index(b"\x00", name_start)
+                path = data[name_start:name_end]
+                position += (name_end - position + 8) & ~7
+            entries.append((os.fsdecode(path), staged))
+
+        # Extensions follow the entries, before the trailing checksum.
+        while position + 20 < len(data):
+            signature, size = struct.unpack_from(">4sI", data, position)
+            if signature in (b"link", b"sdir"):
+                raise _Unsupported(f"Index has the {signature!r} extension")
+            position += 8 + size
+
+        return entries
+
+    def _check_sha(self, value: str) -> str:
+        if len(value) != _SHA1_HEX_LENGTH or not _HEX_DIGITS.issuperset(value):
+            raise _Unsupported(f"Unexpected object name {value!r}")
+        return value
+
+    # Refs
+
+    def packed_refs(self) -> Dict[str, Tuple[str, Optional[str]]]:
+        """Returns the packed refs, mapped to their value and peeled value."""
+        if self._packed_refs is not None:
+            return self._packed_refs
+
+        refs: Dict[str, Tuple[str, Optional[str]]] = {}
+        try:
+            with open(os.path.join(self.commondir, "packed-refs"), "rb") as f:
+                lines = f.read().decode("utf-8").splitlines()
+        except FileNotFoundError:
+            lines = []
+
+        last_ref = None
+        for line in lines:
+            if line.startswith("#"):
+                if line.startswith("# pack-refs with:"):
+                    traits = line.split(":", 1)[1].split()
+                    self._tags_peeled = "peeled" in traits or "fully-peeled" in traits
+            elif line.startswith("^"):
+                if last_ref is None:
+                    raise _Unsupported("Malformed packed-refs")
+                refs[last_ref] = (refs[last_ref][0], self._check_sha(line[1:]))
+            elif line:
+                sha, name = line.split(" ", 1)
+                refs[name] = (self._check_sha(sha), None)
+                last_ref = name
+
+        self._packed_refs = refs
+        return refs
+
+    def _loose_ref_path(self, ref: str) -> str:
+        # Only pseudo-refs such as `HEAD` are per-worktree; see git's `ref_type`.
+        if ref.startswith("refs/"):
+            return os.path.join(self.commondir, ref)
+        return os.path.join(self.gitdir, ref)
+
+    def ref_exists(self, ref: str) -> bool:
+        return os.path.isfile(self._loose_ref_path(ref)) or ref in self.packed_refs()
+
+    def resolve_ref(self, ref: str) -> Optional[str]:
+        """Returns the object a ref points at, or `None` if it does not exist."""
+        for _ in range(5):
+            try:
+                value = _read_text(self._loose_ref_path(ref))
+            except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+                packed = self.packed_refs().get(ref)
+                return packed[0] if packed else None
+
+            if not value.startswith("ref: "):
+                return self._check_sha(value)
+            ref = value[len("ref: ") :]
+
+        raise _Unsupported(f"Symbolic ref chain too long at {ref}")
+
+    def abbreviate_ref(self, ref: str) -> str:
+        """As `git rev-parse --abbrev-ref` in its default, strict, mode."""
+        if not ref.startswith("refs/heads/"):
+            raise _Unsupported(f"HEAD points at {ref}")
+
+        name = ref[len("refs/heads/") :]
+        # The other refs which `name` could refer to: see `ref_rev_parse_rules`.
+        for other in (
+            name,
+            f"refs/{name}",
+            f"refs/tags/{name}",
+            f"refs/remotes/{name}",
+            f"refs/remotes/{name}/HEAD",
+        ):
+            if self.ref_exists(other):
+                raise _Unsupported(f"{name} is ambiguous")
+        return name
+
+    def _tag_refs(self) -> Dict[str, Tuple[str, Optional[str]]]:
+        """Returns the tags, mapped to their value and peeled value (if known)."""
+        tags = {
+            name: value
+            for name, value in self.packed_refs().items()
+            if name.startswith("refs/tags/")
+        }
+
+        if self._tags_peeled:
+            # Every packed annotated tag has its peeled value recorded.
+            for name, (sha, peeled) in tags.items():
+                if peeled is None:
+                    tags[name] = (sha, sha)
+
+        tags_directory = os.path.join(self.commondir, "refs", "tags")
+        for directory, _, filenames in os.walk(tags_directory):
+            for filename in filenames:
+                path = os.path.join(directory, filename)
+                relative_path = os.path.relpath(path, tags_directory)
+                name = "refs/tags/" + relative_path.replace(os.sep, "/")
+                value = _read_text(path)
+                if value.startswith("ref: "):
+                    raise _Unsupported(f"{name} is a symbolic ref")
+                tags[name] = (self._check_sha(value), None)
+
+        return tags
+
+    def find_exact_tag(self, head_sha: str) -> Tuple[str, bool]:
+        """As `git describe --exact-match`.
+
+        Returns:
+            the name of the annotated tag of `head_sha` (or "" if there is none), and
+            whether the repository has any annotated tags at all.
+        """
+        has_annotated_tags = False
+        best: Optional[Tuple[int, str]] = None
+
+        # Refs are visited in name order; for ties, git keeps the first.
+        for _, (sha, peeled) in sorted(self._tag_refs().items()):
+            if peeled is None:
+                peeled = self._peel(sha)
+            if peeled == sha:
+                # A lightweight tag, which describe ignores by default.
+                continue
+
+            has_annotated_tags = True
+            if peeled != head_sha:
+                continue
+
+            # Among several annotated tags, git prefers the newest.
+            date, name = self._parse_tag(sha)
+            if best is None or best[0] < date:
+                best = (date, name)
+
+        return (best[1] if best else ""), has_annotated_tags
+
+    # Objects
+
+    def _peel(self, sha: str) -> str:
+        """Returns the object which a (possibly nested) tag object points at."""
+        for _ in range(10):
+            found = self.read_object(sha)
+            if found is None:
+                raise _Unsupported(f"Cannot read object {sha}")
+            object_type, data = found
+            if object_type != b"tag":
+                return sha
+            sha = self._tag_headers(data)[b"object"][0].decode("ascii")
+        raise _Unsupported(f"Tag chain too long at {sha}")
+
+    def _parse_tag(self, sha: str) -> Tuple[int, str]:
+        """Returns the date and name of an annotated tag, as git's `parse_tag`."""
+        found = self.read_object(sha)
+        if found is None or found[0] != b"tag":
+            raise _Unsupported(f"Cannot read tag {sha}")
+
+        headers = self._tag_headers(found[1])
+        name = headers[b"tag"][0].decode("utf-8")
+
+        date = 0
+        tagger = headers.get(b"tagger")
+        if tagger:
+            email_end = tagger[0].rfind(b">")
+            if email_end != -1:
+                fields = tagger[0][email_end + 1 :].split()
+                if fields and fields[0].isdigit():
+                    date = int(fields[0])
+
+        return date, name
+
+    def _tag_headers(self, data: bytes) -> Dict[bytes, List[bytes]]:
+        headers: Dict[bytes, List[bytes]] = {}
+        for line in data.split(b"\n"):
+            if not line:
+                break
+            key, _, value = line.partition(b" ")
+            headers.setdefault(key, []).append(value)
+        if b"object" not in headers or b"tag" not in headers:
+            raise _Unsupported("Malformed tag object")
+        return headers
+
+    def pack_indices(self) -> List[_PackIndex]:
+        if self._pack_indices is None:
+            pack_directory = os.path.join(self.objects, "pack")
+            try:
+                filenames = os.listdir(pack_directory)
+            except FileNotFoundError:
+                filenames = []
+
+            filenames.sort()
+            self._pack_indices = [
+                _PackIndex(os.path.join(pack_directory, filename))
+                for filename in filenames
+                if filename.endswith(".idx")
+                # git ignores indices without a pack.
+                and filename[: -len(".idx")] + ".pack" in filenames
+            ]
+        return self._pack_indices
+
+    def _loose_objects(self, prefix: str) -> List[str]:
+        """Returns the loose objects whose names start with the given two digits."""
+        try:
+            filenames = os.listdir(os.path.join(self.objects, prefix))
+        except FileNotFoundError:
+            return []
+        return [
+            prefix + filename
+            for filename in filenames
+            if len(filename) == _SHA1_HEX_LENGTH - 2
+            and _HEX_DIGITS.issuperset(filename)
+        ]
+
+    def read_object(self, sha: str) -> Optional[Tuple[bytes, bytes]]:
+        """Returns the type and content of an object, or `None` if it is not found.
+
+        The content of packed objects other than tags is not read.
+        """
+        try:
+            with open(os.path.join(self.objects, sha[:2], sha[2:]), "rb") as f:
+                raw = zlib.decompress(f.read())
+        except FileNotFoundError:
+            pass
+        else:
+            header, _, data = raw.partition(b"\x00")
+            object_type, _, _ = header.partition(b" ")
+            return object_type, data
+
+        for index in self.pack_indices():
+            position, _ = index.neighbours(sha)
+            if position is None:
+                continue
+
+            with open(index.path, "rb") as f:
+                offset = index.offset(f, position)
+            with open(index.path[: -len(".idx")] + ".pack", "rb") as f:
+                return _read_packed_object(index, f, offset)
+
+        return None
+
+    def abbreviate_sha(self, sha: str) -> str:
+        """As `git rev-parse --short`, with the default `core.abbrev`.
+
+        git picks a length from the number of packed objects, then lengthens it until
+        no other object shares the prefix.
+        """
+        count = sum(index.num_objects for index in self.pack_indices())
+        length = max(_MIN_ABBREV, (count.bit_length() + 1) // 2)
+
+        others: List[str] = []
+        for index in self.pack_indices():
+            _, neighbours = index.neighbours(sha)
+            others.extend(neighbours)
+        others.extend(
+            other
+            for other in self._loose_objects(sha[:2])
+            if other.startswith(sha[:length])
+        )
+
+        for other in others:
+            common = _common_hex_prefix(sha, other)
+            # git does not lengthen past 32 digits; the object itself shares all 40.
+            if length <= common < 32:
+                length = common + 1
+
+        return sha[:length]
+
+
+def _read_packed_object(
+    index: _PackIndex, f: BinaryIO, offset: int
+) -> Tuple[bytes, bytes]:
+    """Reads the object at `offset` in a pack, resolving deltas.
+
+    Only the content of tags is read: other objects are returned with empty content.
+    """
+    # The offsets of the deltas to apply, outermost first.
+    delta_offsets: List[int] = []
+    while True:
+        if len(delta_offsets) > _MAX_DELTA_DEPTH:
+            raise _Unsupported(f"Delta chain at {offset} is too long")
+
+        f.seek(offset)
+        byte = f.read(1)[0]
+        pack_type = (byte >> 4) & 7
+        while byte & 0x80:
+            byte = f.read(1)[0]
+
+        if pack_type == _OBJ_OFS_DELTA:
+            byte = f.read(1)[0]
+            distance = byte & 0x7F
+            while byte & 0x80:
+                byte = f.read(1)[0]
+                distance = ((distance + 1) << 7) | (byte & 0x7F)
+            delta_offsets.append(f.tell())
+            offset -= distance
+        elif pack_type == _OBJ_REF_DELTA:
+            base_sha = f.read(20).hex()
+            delta_offsets.append(f.tell())
+            position, _ = index.neighbours(base_sha)
+            if position is None:
+                raise _Unsupported(f"Delta base {base_sha} is not in the same pack")
+            with open(index.path, "rb") as index_file:
+                offset = index.offset(index_file, position)
+        elif pack_type in _OBJ_TYPES:
+            break
+        else:
+            raise ValueError(f"Unknown pack object type {pack_type} at {offset}")
+
+    if pack_type != _OBJ_TAG:
+        return _OBJ_TYPES[pack_type], b""
+
+    data = _decompress_from(f)
+    for delta_offset in reversed(delta_offsets):
+        f.seek(delta_offset)
+        data = _apply_delta(data, _decompress_from(f))
+    return b"tag", data
+
+
+def _read_offset_varint(data: bytes, position: int) -> Tuple[int, int]:
+    """Reads a variable-length integer as encoded by git's `encode_varint`.
+
+    Returns:
+        the integer, and the position after it.
+    """
+    byte = data[position]
+    position += 1
+    value = byte & 0x7F
+    while byte & 0x80:
+        byte = data[position]
+        position += 1
+        value = ((value + 1) << 7) | (byte & 0x7F)
+    return value, position
+
+
+def _decompress_from(f: BinaryIO) -> bytes:
+    """Decompresses a zlib stream starting at the current position of `f`."""
+    decompressor = zlib.decompressobj()
+    data = b""
+    while not decompressor.eof:
+        chunk = f.read(4096)
+        if not chunk:
+            raise ValueError("Truncated pack object")
+        data += decompressor.decompress(chunk)
+    return data
+
+
+def _apply_delta(base: bytes, delta: bytes) -> bytes:
+    """As `patch_delta` in git."""
+    position = 0
+
+    def read_size() -> int:
+        nonlocal position
+        size = shift = 0
+        while True:
+            byte = delta[position]
+            position += 1
+            size |= (byte & 0x7F) << shift
+            shift += 7
+            if not byte & 0x80:
+                return size
+
+    if read_size() != len(base):
+        raise ValueError("Delta base has the wrong size")
+    result_size = read_size()
+
+    result = bytearray()
+    while position < len(delta):
+        command = delta[position]
+        position += 1
+        if command & 0x80:
+            # Copy a range of the base. Bits 0-3 say which bytes of the offset
+            # follow, and bits 4-6 which bytes of the size.
+            copy_offset = copy_size = 0
+            for bit in range(4):
+                if command & (1 << bit):
+                    copy_offset |= delta[position] << (8 * bit)
+                    position += 1
+            for bit in range(3):
+                if command & (0x10 << bit):
+                    copy_size |= delta[position] << (8 * bit)
+                    position += 1
+            if copy_size == 0:
+                copy_size = 0x10000
+            if copy_offset + copy_size > len(base):
+                raise ValueError("Delta copies past the end of its base")
+            result += base[copy_offset : copy_offset + copy_size]
+        elif command:
+            # Insert the next `command` bytes of the delta.
+            result += delta[position : position + command]
+            position += command
+        else:
+            raise ValueError("Delta uses a reserved command")
+
+    if len(result) != result_size:
+        raise ValueError("Delta result has the wrong size")
+    return bytes(result)
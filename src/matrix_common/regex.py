@@ -12,10 +12,73 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import abc
+import collections
+import enum
+import itertools
+import os
 import re
-from typing import List, Pattern
+import threading
+import time
+from typing import (
+    Any,
+    Callable,
+    Deque,
+    Dict,
+    FrozenSet,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    NamedTuple,
+    Optional,
+    Pattern,
+    Sequence,
+    Tuple,
+    Type,
+    Union,
+)
+
+from matrix_common._cache import CacheInfo, LruCache
 
 _WILDCARD_RUN = re.compile(r"([\?\*]+)")
+_WORD = re.compile(r"\w+")
+
+# The only non-ASCII characters for which `str.lower` and `re.IGNORECASE` disagree
+# about matching ASCII: U+0130, whose lower case is two characters, and U+0131, U+017F
+# and U+212A, which `re` treats as equal to "i", "s" and "k" respectively.
+_UNFOLDABLE = re.compile("[\u0130\u0131\u017f\u212a]")
+
+# The default number of compiled globs kept by `glob_to_regex`. Python's own `re`
+# cache holds 512 patterns in total, which is easily thrashed by a homeserver
+# evaluating thousands of push rules and server ACLs.
+DEFAULT_GLOB_CACHE_SIZE = 4096
+
+_glob_cache: "LruCache[Tuple[str, bool, bool], Pattern[str]]" = LruCache(
+    DEFAULT_GLOB_CACHE_SIZE
+)
+
+
+class GlobBackend(enum.Enum):
+    """The engine used by `glob_to_matcher` for globs without a string fast path."""
+
+    # Python's `re` module. Fast in the common case, but backtracking: globs with many
+    # `*`s can take time polynomial in the length of the input, with the degree set
+    # by the number of `*`s.
+    REGEX = "regex"
+
+    # A bit-parallel NFA simulation, which takes O(len(glob) * len(value)) time in the
+    # worst case. Use this for globs from untrusted sources.
+    LINEAR = "linear"
+
+
+_default_backend = GlobBackend.REGEX
+
+
+def set_default_glob_backend(backend: GlobBackend) -> None:
+    """Sets the backend used by `glob_to_matcher` when none is given."""
+    global _default_backend
+    _default_backend = backend
 
 
 def glob_to_regex(
@@ -26,6 +89,9 @@ def glob_to_regex(
 ) -> Pattern[str]:
     """Converts a glob to a compiled regex object.
 
+    Compiled patterns are kept in a bounded LRU cache, which can be inspected and
+    tuned with `glob_cache_info`, `clear_glob_cache` and `set_glob_cache_size`.
+
     Args:
         glob: pattern to match
         word_boundary: If `True`, the pattern will be allowed to match at word
@@ -39,6 +105,52 @@ def glob_to_regex(
     Returns:
         compiled regex pattern
     """
+    return _glob_cache.get_or_compute(
+        (glob, word_boundary, ignore_case),
+        lambda: _compile_glob(glob, word_boundary, ignore_case),
+    )
+
+
+def glob_cache_info() -> CacheInfo:
+    """Returns the hit, miss and eviction statistics of the `glob_to_regex` cache."""
+    return _glob_cache.info()
+
+
+def clear_glob_cache() -> None:
+    """Empties the `glob_to_regex` cache and resets its statistics."""
+    _glob_cache.clear()
+
+
+def set_glob_cache_size(maxsize: int) -> None:
+    """Changes the number of compiled globs kept by `glob_to_regex`.
+
+    Args:
+        maxsize: The new maximum number of entries. Least recently used entries are
+            evicted if the cache currently holds more than this. A value of 0 disables
+            caching.
+
+    Raises:
+        ValueError: if `maxsize` is negative.
+    """
+    _glob_cache.resize(maxsize)
+
+
+def _compile_glob(glob: str, word_boundary: bool, ignore_case: bool) -> Pattern[str]:
+    pattern = _glob_to_pattern(glob)
+
+    if word_boundary:
+        pattern = to_word_pattern(pattern)
+    else:
+        # `\A` anchors at start of string, `\Z` at end of string
+        # `\Z` is not the same as `$`! The latter will match the position before
+        # a `\n` at the end of the string.
+        pattern = rf"\A({pattern})\Z"
+
+    return re.compile(pattern, re.IGNORECASE if ignore_case else 0)
+
+
+def _glob_to_pattern(glob: str) -> str:
+    """Converts a glob to an unanchored regular expression string."""
     # Patterns with wildcards must be simplified to avoid performance cliffs
     # - The glob `?**?**?` is equivalent to the glob `???*`
     # - The glob `???*` is equivalent to the regex `.{3,}`
@@ -56,17 +168,7 @@ def glob_to_regex(
         else:
             chunks.append(".{%d}" % (question_marks,))
 
-    pattern = "".join(chunks)
-
-    if word_boundary:
-        pattern = to_word_pattern(pattern)
-    else:
-        # `\A` anchors at start of string, `\Z` at end of string
-        # `\Z` is not the same as `$`! The latter will match the position before
-        # a `\n` at the end of the string.
-        pattern = rf"\A({pattern})\Z"
-
-    return re.compile(pattern, re.IGNORECASE if ignore_case else 0)
+    return "".join(chunks)
 
 
 def to_word_pattern(pattern: str) -> str:
@@ -93,3 +195,1359 @@ def to_word_pattern(pattern: str) -> str:
     # `^|\W` and `\W|$` handle the case where `pattern` starts or ends with a non-word
     # character.
     return rf"(?:^|\W|\b)({pattern})(?:\b|\W|$)"
+
+
+def _can_fold(text: str) -> bool:
+    """Returns whether `text.lower()` can stand in for `re.IGNORECASE` on `text`.
+
+    If so, comparing any slice of `text.lower()` with lower-case ASCII gives the same
+    result as a case-insensitive regex of that ASCII would on the same slice of `text`,
+    and `text.lower()` has the same length and word characters as `text`.
+    """
+    return text.isascii() or _UNFOLDABLE.search(text) is None
+
+
+class MatchContext:
+    """A string prepared once for matching against many word-boundary globs.
+
+    Push rules check an event body against many `word_boundary=True` globs. Matching
+    each with its own regex rescans, and re-folds the case of, the whole body every
+    time. A `MatchContext` lower-cases the body and splits it into words once, and is
+    shared by every matcher given to `GlobMatcher.match_context`.
+
+    Text containing one of the few characters which `str.lower` does not fold as
+    `re.IGNORECASE` does, as explained in `glob_to_matcher`, is matched
+    case-insensitively by the regex as usual.
+    """
+
+    __slots__ = ("text", "foldable", "_lowered", "_words", "_lowered_words")
+
+    def __init__(self, text: str) -> None:
+        self.text = text
+        self.foldable = _can_fold(text)
+        self._lowered: Optional[str] = None
+        self._words: Optional[FrozenSet[str]] = None
+        self._lowered_words: Optional[FrozenSet[str]] = None
+
+    @property
+    def lowered(self) -> str:
+        """The text, in lower case. Only valid for comparisons if `foldable`."""
+        if self._lowered is None:
+            self._lowered = self.text.lower()
+        return self._lowered
+
+    @property
+    def words(self) -> FrozenSet[str]:
+        """The maximal runs of word characters in the text."""
+        if self._words is None:
+            self._words = frozenset(_WORD.findall(self.text))
+        return self._words
+
+    @property
+    def lowered_words(self) -> FrozenSet[str]:
+        """The maximal runs of word characters in the lower-cased text."""
+        if self._lowered_words is None:
+            self._lowered_words = frozenset(_WORD.findall(self.lowered))
+        return self._lowered_words
+
+
+class GlobMatcher(abc.ABC):
+    """Matches strings against a single glob.
+
+    Most globs seen in practice are literals, or literals with a single leading or
+    trailing `*`. `glob_to_matcher` picks a subclass which checks those with plain
+    string operations, and only falls back to a regular expression for other globs.
+    Every matcher gives the same results as the `Pattern` from `glob_to_regex`.
+    """
+
+    __slots__ = ("glob", "word_boundary", "ignore_case", "_regex")
+
+    def __init__(self, glob: str, *, word_boundary: bool, ignore_case: bool) -> None:
+        self.glob = glob
+        self.word_boundary = word_boundary
+        self.ignore_case = ignore_case
+        self._regex: Optional[Pattern[str]] = None
+
+    @property
+    def pattern(self) -> Pattern[str]:
+        """The equivalent compiled regex, as returned by `glob_to_regex`."""
+        if self._regex is None:
+            self._regex = glob_to_regex(
+                self.glob,
+                word_boundary=self.word_boundary,
+                ignore_case=self.ignore_case,
+            )
+        return self._regex
+
+    @abc.abstractmethod
+    def match(self, value: str) -> bool:
+        """Returns whether `value` matches the glob."""
+
+    def match_context(self, context: MatchContext) -> bool:
+        """Returns whether the text of a `MatchContext` matches the glob."""
+        return self.match(context.text)
+
+    def match_many(self, values: Iterable[str]) -> Iterator[bool]:
+        """Lazily matches each of `values` against the glob."""
+        return map(self.match, values)
+
+    def __repr__(self) -> str:
+        return f"<{type(self).__name__} {self.glob!r}>"
+
+
+class _EngineMatcher(GlobMatcher):
+    """A matcher for globs which need a regex engine.
+
+    Any match contains the longest literal part of the glob, so `match_context` first
+    rules out texts without it with a substring search of the prepared text.
+    """
+
+    __slots__ = ("_required",)
+
+    def __init__(self, glob: str, *, word_boundary: bool, ignore_case: bool) -> None:
+        super().__init__(glob, word_boundary=word_boundary, ignore_case=ignore_case)
+        longest = max(_WILDCARD_RUN.split(glob)[::2], key=len)
+        if ignore_case:
+            # Only ASCII can be compared against the lower-cased text.
+            longest = longest.lower() if longest.isascii() else ""
+        self._required: Optional[str] = longest or None
+
+    def match_context(self, context: MatchContext) -> bool:
+        required = self._required
+        if required is not None:
+            if not self.ignore_case:
+                if required not in context.text:
+                    return False
+            elif context.foldable and required not in context.lowered:
+                return False
+        return self.match(context.text)
+
+
+class _RegexMatcher(_EngineMatcher):
+    """Matches using the compiled regex from `glob_to_regex`."""
+
+    __slots__ = ()
+
+    def match(self, value: str) -> bool:
+        if self.word_boundary:
+            return self.pattern.search(value) is not None
+        return self.pattern.match(value) is not None
+
+    def match_many(self, values: Iterable[str]) -> Iterator[bool]:
+        # Stay in C for the whole loop: `Match` objects are always truthy.
+        if self.word_boundary:
+            return map(bool, map(self.pattern.search, values))
+        return map(bool, map(self.pattern.match, values))
+
+
+class _LiteralMatcher(GlobMatcher):
+    """Matches a glob without wildcards by comparing strings."""
+
+    __slots__ = ("_literal",)
+
+    def __init__(self, glob: str, *, word_boundary: bool, ignore_case: bool) -> None:
+        super().__init__(glob, word_boundary=word_boundary, ignore_case=ignore_case)
+        self._literal = glob.lower() if ignore_case else glob
+
+    def match(self, value: str) -> bool:
+        # A regex matches one character of the string per character of a literal, so
+        # the lengths must agree.
+        if len(value) != len(self._literal):
+            return False
+        if not self.ignore_case:
+            return value == self._literal
+        if _can_fold(value):
+            return value.lower() == self._literal
+        return self.pattern.match(value) is not None
+
+    def match_many(self, values: Iterable[str]) -> Iterator[bool]:
+        if not self.ignore_case:
+            return map(self._literal.__eq__, values)
+        return super().match_many(values)
+
+
+class _PrefixMatcher(GlobMatcher):
+    """Matches a glob of the form `literal*` with `str.startswith`."""
+
+    __slots__ = ("_literal",)
+
+    def __init__(self, glob: str, *, word_boundary: bool, ignore_case: bool) -> None:
+        super().__init__(glob, word_boundary=word_boundary, ignore_case=ignore_case)
+        literal = glob.rstrip("*")
+        self._literal = literal.lower() if ignore_case else literal
+
+    def match(self, value: str) -> bool:
+        length = len(self._literal)
+        if len(value) < length:
+            return False
+        if not self.ignore_case:
+            prefix_matches = value.startswith(self._literal)
+        elif _can_fold(value):
+            prefix_matches = value[:length].lower() == self._literal
+        else:
+            return self.pattern.match(value) is not None
+
+        # `*` does not match newlines.
+        return prefix_matches and value.find("\n", length) == -1
+
+
+class _SuffixMatcher(GlobMatcher):
+    """Matches a glob of the form `*literal` with `str.endswith`."""
+
+    __slots__ = ("_literal",)
+
+    def __init__(self, glob: str, *, word_boundary: bool, ignore_case: bool) -> None:
+        super().__init__(glob, word_boundary=word_boundary, ignore_case=ignore_case)
+        literal = glob.lstrip("*")
+        self._literal = literal.lower() if ignore_case else literal
+
+    def match(self, value: str) -> bool:
+        start = len(value) - len(self._literal)
+        if start < 0:
+            return False
+        if not self.ignore_case:
+            suffix_matches = value.endswith(self._literal)
+        elif _can_fold(value):
+            suffix_matches = value[start:].lower() == self._literal
+        else:
+            return self.pattern.match(value) is not None
+
+        # `*` does not match newlines.
+        return suffix_matches and value.find("\n", 0, start) == -1
+
+
+class _WordLiteralMatcher(GlobMatcher):
+    """Matches a glob without wildcards at word boundaries by searching for it.
+
+    A match is any occurrence of the literal which does not start or end strictly
+    inside a word. If the literal consists only of word characters, that means it must
+    be a whole word of the text, which a `MatchContext` can look up directly.
+    """
+
+    __slots__ = ("_literal", "_is_word")
+
+    def __init__(self, glob: str, *, word_boundary: bool, ignore_case: bool) -> None:
+        super().__init__(glob, word_boundary=word_boundary, ignore_case=ignore_case)
+        self._literal = glob.lower() if ignore_case else glob
+        self._is_word = _WORD.fullmatch(glob) is not None
+
+    def match(self, value: str) -> bool:
+        if not self.ignore_case:
+            return _find_word_literal(value, self._literal)
+        if _can_fold(value):
+            return _find_word_literal(value.lower(), self._literal)
+        return self.pattern.search(value) is not None
+
+    def match_context(self, context: MatchContext) -> bool:
+        if not self.ignore_case:
+            if self._is_word:
+                return self._literal in context.words
+            return _find_word_literal(context.text, self._literal)
+
+        if not context.foldable:
+            return self.pattern.search(context.text) is not None
+        if self._is_word:
+            return self._literal in context.lowered_words
+        return _find_word_literal(context.lowered, self._literal)
+
+
+class _WordAffixMatcher(GlobMatcher):
+    """Matches a glob of the form `literal*`, `*literal` or `*literal*` at word
+    boundaries by searching for the literal.
+
+    The regex from `to_word_pattern` may start and end a match at the ends of a line,
+    which are never inside a word, and a `*` can stretch the match to the end of the
+    line. So the glob matches wherever the literal occurs without starting inside a word
+    (unless the glob starts with `*`) or ending inside one (unless it ends with `*`).
+    """
+
+    __slots__ = ("_literal", "_check_start", "_check_end")
+
+    def __init__(self, glob: str, *, word_boundary: bool, ignore_case: bool) -> None:
+        super().__init__(glob, word_boundary=word_boundary, ignore_case=ignore_case)
+        literal = glob.strip("*")
+        self._literal = literal.lower() if ignore_case else literal
+        self._check_start = not glob.startswith("*")
+        self._check_end = not glob.endswith("*")
+
+    def match(self, value: str) -> bool:
+        if not self.ignore_case:
+            return self._find(value)
+        if _can_fold(value):
+            return self._find(value.lower())
+        return self.pattern.search(value) is not None
+
+    def match_context(self, context: MatchContext) -> bool:
+        if not self.ignore_case:
+            return self._find(context.text)
+        if context.foldable:
+            return self._find(context.lowered)
+        return self.pattern.search(context.text) is not None
+
+    def _find(self, text: str) -> bool:
+        return _find_word_literal(
+            text,
+            self._literal,
+            check_start=self._check_start,
+            check_end=self._check_end,
+        )
+
+
+def _find_word_literal(
+    text: str, literal: str, *, check_start: bool = True, check_end: bool = True
+) -> bool:
+    """Returns whether `literal` occurs in `text` without starting or ending in a word.
+
+    Equivalent to searching with `to_word_pattern(re.escape(literal))`. If
+    `check_start` or `check_end` is `False`, the literal may start or end inside a word
+    respectively.
+    """
+    if not check_start and not check_end:
+        return literal in text
+
+    length = len(literal)
+    start = text.find(literal)
+    while start != -1:
+        if not (check_start and _inside_word(text, start)) and not (
+            check_end and _inside_word(text, start + length)
+        ):
+            return True
+        start = text.find(literal, start + 1)
+    return False
+
+
+def _inside_word(text: str, position: int) -> bool:
+    """Returns whether `position` lies between two word characters of `text`."""
+    return (
+        0 < position < len(text)
+        and _WORD.fullmatch(text, position - 1, position + 1) is not None
+    )
+
+
+class _LinearMatcher(_EngineMatcher):
+    """Matches by simulating an NFA for the glob, one bit per state.
+
+    The glob is treated as a sequence of tokens, each of which is a literal character or
+    a `?`. State `k` means that the first `k` tokens have been matched, and a `*` is a
+    loop on the state where it appears. Every state is advanced at once by shifting an
+    integer bitmask, so each character of the input costs a few operations on an
+    integer of `len(glob)` bits and there is no backtracking.
+
+    As with the regex, wildcards do not match newlines.
+    """
+
+    __slots__ = ("_literal_masks", "_any_mask", "_star_mask", "_accept", "_transitions")
+
+    # Bounds the memo of per-character transitions, for inputs with many distinct
+    # characters.
+    _MAX_TRANSITIONS = 4096
+
+    def __init__(self, glob: str, *, word_boundary: bool, ignore_case: bool) -> None:
+        super().__init__(glob, word_boundary=word_boundary, ignore_case=ignore_case)
+
+        self._literal_masks: Dict[str, int] = {}
+        self._any_mask = 0
+        self._star_mask = 0
+
+        tokens = 0
+        for chunk in _WILDCARD_RUN.split(glob):
+            if not _WILDCARD_RUN.match(chunk):
+                for char in chunk:
+                    tokens += 1
+                    self._literal_masks[char] = self._literal_masks.get(char, 0) | (
+                        1 << tokens
+                    )
+                continue
+
+            # As for the regex, `?**?` is simplified to `??*`.
+            for _ in range(chunk.count("?")):
+                tokens += 1
+                self._any_mask |= 1 << tokens
+            if "*" in chunk:
+                self._star_mask |= 1 << tokens
+
+        self._accept = 1 << tokens
+
+        # Maps a character to the states reachable by consuming it (shifted by one) and
+        # the states which loop on it.
+        self._transitions: Dict[str, Tuple[int, int, bool]] = {}
+
+    def match(self, value: str) -> bool:
+        transitions = self._transitions
+        if len(transitions) > self._MAX_TRANSITIONS:
+            transitions.clear()
+
+        if self.word_boundary:
+            return self._search(value, transitions)
+
+        states = 1
+        for char in value:
+            transition = transitions.get(char)
+            if transition is None:
+                transition = transitions[char] = self._transition(char)
+            advance, loop, _ = transition
+
+            states = ((states << 1) & advance) | (states & loop)
+            if not states:
+                return False
+
+        return bool(states & self._accept)
+
+    def _search(
+        self, value: str, transitions: Dict[str, Tuple[int, int, bool]]
+    ) -> bool:
+        """Matches as the regex from `to_word_pattern` does.
+
+        That regex matches if the glob matches any substring which neither starts nor
+        ends strictly inside a word (i.e. between two word characters). So a new match
+        is started at, and accepting states are checked at, every position which is not
+        inside a word.
+        """
+        accept = self._accept
+        states = 0
+        previous_is_word = False
+        for char in value:
+            transition = transitions.get(char)
+            if transition is None:
+                transition = transitions[char] = self._transition(char)
+            advance, loop, is_word = transition
+
+            if not (previous_is_word and is_word):
+                states |= 1
+                if states & accept:
+                    return True
+
+            states = ((states << 1) & advance) | (states & loop)
+            previous_is_word = is_word
+
+        # The end of the string is never inside a word.
+        return bool((states | 1) & accept)
+
+    def _transition(self, char: str) -> Tuple[int, int, bool]:
+        advance = 0
+        for literal, mask in self._literal_masks.items():
+            if char == literal or (
+                self.ignore_case
+                and re.fullmatch(re.escape(literal), char, re.IGNORECASE)
+            ):
+                advance |= mask
+
+        # Like `.` in the regex, wildcards match anything but a newline.
+        loop = 0
+        if char != "\n":
+            advance |= self._any_mask
+            loop = self._star_mask
+
+        # The definition of a word character used by `\w` in `re`.
+        is_word = char.isalnum() or char == "_"
+
+        return advance, loop, is_word
+
+
+def glob_to_matcher(
+    glob: str,
+    *,
+    word_boundary: bool = False,
+    ignore_case: bool = True,
+    backend: Optional[GlobBackend] = None,
+) -> GlobMatcher:
+    """Converts a glob to a matcher, avoiding regular expressions where possible.
+
+    Takes the same arguments as `glob_to_regex`. Literal globs are matched by string
+    comparison, and globs with a single leading or trailing `*` by
+    `str.endswith`/`str.startswith`. Other globs use the compiled regex, or the
+    linear-time engine if `backend` is `GlobBackend.LINEAR`.
+
+    With word boundaries, literal globs are searched for with `str.find`, as are globs
+    of the form `literal*`, `*literal` and `*literal*`, and other globs are only given
+    to the regex if the text contains their longest literal part.
+
+    Case-insensitive comparisons use `str.lower`, and so are only made for ASCII globs.
+    `re.IGNORECASE` treats a few non-ASCII characters as equal to ASCII letters (e.g.
+    `K` and `ſ`), which neither `str.lower` nor `str.casefold` reproduce, so strings
+    containing them are given to the regex instead.
+
+    If a `MatchInstrumentation` has been set with `set_match_instrumentation`, the
+    matcher reports the time taken by each match to it.
+
+    Args:
+        backend: The engine to use for globs which need one. Defaults to the backend
+            set with `set_default_glob_backend`, which is initially
+            `GlobBackend.REGEX`.
+
+    Returns:
+        a matcher whose `match` method gives the same result as the regex from
+        `glob_to_regex`.
+    """
+    if backend is None:
+        backend = _default_backend
+
+    matcher_class = _classify_glob(glob, word_boundary, ignore_case, backend)
+    matcher = matcher_class(glob, word_boundary=word_boundary, ignore_case=ignore_case)
+    if _instrumentation is not None:
+        return _InstrumentedMatcher(matcher, _instrumentation)
+    return matcher
+
+
+def _classify_glob(
+    glob: str, word_boundary: bool, ignore_case: bool, backend: GlobBackend
+) -> Type[GlobMatcher]:
+    """Picks the cheapest `GlobMatcher` that can match the given glob."""
+    fallback: Type[GlobMatcher] = (
+        _LinearMatcher if backend is GlobBackend.LINEAR else _RegexMatcher
+    )
+    if ignore_case and not glob.isascii():
+        return fallback
+
+    chunks = _WILDCARD_RUN.split(glob)
+    if len(chunks) == 1:
+        return _WordLiteralMatcher if word_boundary else _LiteralMatcher
+
+    if word_boundary:
+        # Wildcard runs are separated by non-empty literals, so a glob with a single
+        # literal and only `*`s is `literal*`, `*literal` or `*literal*`.
+        if sum(1 for literal in chunks[::2] if literal) == 1 and all(
+            set(wildcards) == {"*"} for wildcards in chunks[1::2]
+        ):
+            return _WordAffixMatcher
+        return fallback
+
+    # `split` returns the text either side of a single run of wildcards.
+    if len(chunks) == 3 and set(chunks[1]) == {"*"}:
+        if not chunks[0]:
+            return _SuffixMatcher
+        if not chunks[2]:
+            return _PrefixMatcher
+
+    return fallback
+
+
+class PatternStats(NamedTuple):
+    """The statistics `MatchInstrumentation` keeps for each glob."""
+
+    calls: int
+    matches: int
+    total_seconds: float
+    max_seconds: float
+
+
+class SlowMatch(NamedTuple):
+    """A match which took longer than `MatchInstrumentation.slow_threshold`."""
+
+    glob: str
+    seconds: float
+    # The length of the string matched against. The string itself is not kept, as it
+    # may be private, e.g. a message body.
+    length: int
+    matched: bool
+
+
+class MatchInstrumentation:
+    """Records how long matching takes, per glob.
+
+    Enable it with `set_match_instrumentation`. The statistics can be read with
+    `stats`, or forwarded elsewhere, e.g. to Prometheus, by the callbacks.
+    """
+
+    def __init__(
+        self,
+        *,
+        slow_threshold: float = 0.01,
+        max_slow_matches: int = 100,
+        on_match: Optional[Callable[[str, float, bool], None]] = None,
+        on_slow_match: Optional[Callable[[SlowMatch], None]] = None,
+    ) -> None:
+        """
+        Args:
+            slow_threshold: The number of seconds above which a match is slow.
+            max_slow_matches: The number of most recent slow matches to keep in
+                `slow_matches`.
+            on_match: Called after every match with the glob, the number of seconds
+                taken and whether the string matched.
+            on_slow_match: Called after every slow match.
+        """
+        self.slow_threshold = slow_threshold
+        self.on_match = on_match
+        self.on_slow_match = on_slow_match
+        self.slow_matches: Deque[SlowMatch] = collections.deque(maxlen=max_slow_matches)
+
+        # Maps each glob to its call count, match count, total and maximum seconds.
+        self._stats: Dict[str, List[Any]] = {}
+        self._lock = threading.Lock()
+
+    def record(self, glob: str, seconds: float, length: int, matched: bool) -> None:
+        """Records a match of a string of the given length against a glob."""
+        slow_match = None
+        with self._lock:
+            stats = self._stats.get(glob)
+            if stats is None:
+                stats = self._stats[glob] = [0, 0, 0.0, 0.0]
+            stats[0] += 1
+            stats[1] += matched
+            stats[2] += seconds
+            stats[3] = max(stats[3], seconds)
+
+            if seconds > self.slow_threshold:
+                slow_match = SlowMatch(glob, seconds, length, matched)
+                self.slow_matches.append(slow_match)
+
+        if self.on_match is not None:
+            self.on_match(glob, seconds, matched)
+        if slow_match is not None and self.on_slow_match is not None:
+            self.on_slow_match(slow_match)
+
+    def stats(self) -> Dict[str, PatternStats]:
+        """Returns a snapshot of the statistics of each glob matched so far."""
+        with self._lock:
+            return {glob: PatternStats(*stats) for glob, stats in self._stats.items()}
+
+    def reset(self) -> None:
+        """Forgets all statistics and slow matches."""
+        with self._lock:
+            self._stats.clear()
+            self.slow_matches.clear()
+
+
+_instrumentation: Optional[MatchInstrumentation] = None
+
+
+def set_match_instrumentation(instrumentation: Optional[MatchInstrumentation]) -> None:
+    """Instruments the matchers built by `glob_to_matcher` from now on.
+
+    `GlobSet`s, and so `KeyedConditionEvaluator`s, built from now on are instrumented
+    too, and match each glob on their own while they are. Either can also be given a
+    `MatchInstrumentation` of its own. Matchers and sets built earlier are
+    unaffected, so that matching costs nothing extra while instrumentation is
+    disabled. Pass `None` to disable it again.
+
+    Not everything reports to it: the globs a `DomainGlobSet` looks up in its trie are
+    not timed, only those it leaves to a `GlobSet`, and the worker processes of
+    `glob_scan` have instrumentation of their own, if any.
+    """
+    global _instrumentation
+    _instrumentation = instrumentation
+
+
+class _InstrumentedMatcher(GlobMatcher):
+    """Times the matches of another matcher."""
+
+    __slots__ = ("_matcher", "_instrumentation")
+
+    def __init__(
+        self, matcher: GlobMatcher, instrumentation: MatchInstrumentation
+    ) -> None:
+        super().__init__(
+            matcher.glob,
+            word_boundary=matcher.word_boundary,
+            ignore_case=matcher.ignore_case,
+        )
+        self._matcher = matcher
+        self._instrumentation = instrumentation
+
+    def match(self, value: str) -> bool:
+        start = time.perf_counter()
+        matched = self._matcher.match(value)
+        self._instrumentation.record(
+            self.glob, time.perf_counter() - start, len(value), matched
+        )
+        return matched
+
+    def match_context(self, context: MatchContext) -> bool:
+        start = time.perf_counter()
+        matched = self._matcher.match_context(context)
+        self._instrumentation.record(
+            self.glob, time.perf_counter() - start, len(context.text), matched
+        )
+        return matched
+
+    def __repr__(self) -> str:
+        return f"<instrumented {self._matcher!r}>"
+
+
+# Below this many globs, a single anchored alternation rejects a string faster than
+# the dict lookups of `GlobSet` do, so smaller sets without word boundaries use it for
+# all their globs.
+_MIN_BUCKETED_GLOBS = 32
+
+
+class GlobSet:
+    """A collection of globs matched together.
+
+    Checking a string against many globs one `Pattern` at a time costs a Python-level
+    call per glob. A `GlobSet` sorts the globs as `glob_to_matcher` does, and matches
+    each kind together:
+
+    * Without word boundaries, literal globs are looked up in a dict, as are the
+      literals of `literal*` and `*literal` globs, by the prefix or suffix of the string
+      of each length.
+    * With word boundaries, literal globs which are single words are looked up in the
+      set of words of the string, and the other globs which `glob_to_matcher` can
+      match without a regex share a `MatchContext`.
+
+    The remaining globs are joined into one regex alternation, so that strings which
+    match none of them, the common case, are ruled out by a single scan. Small sets of
+    globs without word boundaries are joined into the alternation entirely. With
+    `GlobBackend.LINEAR`, the globs which need an engine are left out of the
+    alternation, and each is matched by the linear-time engine instead, once the
+    string is known to contain its longest literal part.
+
+    An instrumented `GlobSet` matches each glob on its own instead, so that the time
+    taken by each can be reported.
+
+    The globs follow the same rules as `glob_to_regex`.
+    """
+
+    def __init__(
+        self,
+        globs: Iterable[str],
+        *,
+        word_boundary: bool = False,
+        ignore_case: bool = True,
+        backend: Optional[GlobBackend] = None,
+        instrumentation: Optional["MatchInstrumentation"] = None,
+    ) -> None:
+        """
+        Args:
+            globs: The globs to match against.
+            word_boundary: If `True`, each glob may match at word boundaries anywhere
+                in the string, as for `glob_to_regex`. Otherwise, each glob must match
+                the whole string.
+            ignore_case: If `True`, the globs will be case-insensitive.
+            backend: The engine to use for globs which need one, as for
+                `glob_to_matcher`. Defaults to the backend set with
+                `set_default_glob_backend`.
+            instrumentation: Where to report the time taken to match each glob.
+                Defaults to the instrumentation set with `set_match_instrumentation`,
+                if any.
+        """
+        self.globs: Sequence[str] = tuple(globs)
+        self.word_boundary = word_boundary
+        self.ignore_case = ignore_case
+        self.backend = _default_backend if backend is None else backend
+
+        if instrumentation is None:
+            instrumentation = _instrumentation
+        # If instrumented, a timed matcher for each glob, used instead of the rest.
+        self._instrumented: Optional[List[GlobMatcher]] = None
+        if instrumentation is not None:
+            self._instrumented = [
+                _InstrumentedMatcher(matcher, instrumentation)
+                for matcher in self._glob_matchers()
+            ]
+
+        # The indices of the literal globs, keyed by the literal, and of the `literal*`
+        # and `*literal` globs, keyed by the length of the literal and then the
+        # literal. The literals are lower-cased if `ignore_case`.
+        self._literals: Dict[str, List[int]] = {}
+        self._prefixes: Dict[int, Dict[str, List[int]]] = {}
+        self._suffixes: Dict[int, Dict[str, List[int]]] = {}
+        # The other globs which are matched without the alternation.
+        self._matchers: List[Tuple[int, GlobMatcher]] = []
+        # The globs in the alternation.
+        self._regex_matchers: List[Tuple[int, GlobMatcher]] = []
+
+        bucketed = word_boundary or len(self.globs) >= _MIN_BUCKETED_GLOBS
+        for index, glob in enumerate(self.globs):
+            matcher_class = _classify_glob(
+                glob, word_boundary, ignore_case, self.backend
+            )
+            if bucketed and self._bucket_glob(index, glob, matcher_class):
+                continue
+
+            matcher = matcher_class(
+                glob, word_boundary=word_boundary, ignore_case=ignore_case
+            )
+            # A backtracking alternation would defeat the linear engine.
+            if matcher_class is _LinearMatcher or (
+                bucketed and matcher_class is not _RegexMatcher
+            ):
+                self._matchers.append((index, matcher))
+            else:
+                self._regex_matchers.append((index, matcher))
+
+        self._combined: Optional[Pattern[str]] = None
+        if self._regex_matchers:
+            if word_boundary:
+                alternatives = "|".join(
+                    _glob_to_pattern(matcher.glob)
+                    for _, matcher in self._regex_matchers
+                )
+                pattern = to_word_pattern(alternatives)
+            else:
+                # Each glob gets a capturing group of its own, and no other capturing
+                # groups are used, so that the position in `_regex_matchers` of the
+                # first glob that matches is `Match.lastindex - 1`.
+                alternatives = "|".join(
+                    f"({_glob_to_pattern(matcher.glob)})"
+                    for _, matcher in self._regex_matchers
+                )
+                pattern = rf"\A(?:{alternatives})\Z"
+            self._combined = re.compile(pattern, re.IGNORECASE if ignore_case else 0)
+
+        # A matcher for each glob, for strings which cannot be folded.
+        self._fallback_matchers: Optional[List[GlobMatcher]] = None
+
+    def __len__(self) -> int:
+        return len(self.globs)
+
+    def match_any(self, value: str) -> bool:
+        """Returns whether any of the globs match `value`."""
+        if (
+            self.word_boundary
+            or self._instrumented is not None
+            or (self.ignore_case and not _can_fold(value))
+        ):
+            return bool(self.matches(value))
+
+        if self._combined is not None and self._combined.match(value):
+            return True
+        if (
+            self._literals or self._prefixes or self._suffixes
+        ) and self._bucket_matches(value):
+            return True
+        if self._matchers:
+            context = MatchContext(value)
+            return any(matcher.match_context(context) for _, matcher in self._matchers)
+        return False
+
+    def match_first(self, value: str) -> Optional[int]:
+        """Returns the lowest index of a glob that matches `value`, if any."""
+        found = self.matches(value)
+        return found[0] if found else None
+
+    def matches(self, value: str) -> List[int]:
+        """Returns the indices of all the globs that match `value`, in order."""
+        if self._instrumented is not None:
+            return self._instrumented_matches(value, self._instrumented)
+
+        if self.ignore_case and not _can_fold(value):
+            # Rare enough that matching each glob on its own will do.
+            if self._fallback_matchers is None:
+                self._fallback_matchers = self._glob_matchers()
+            return [
+                index
+                for index, matcher in enumerate(self._fallback_matchers)
+                if matcher.match(value)
+            ]
+
+        if self.word_boundary:
+            found = self._word_matches(value)
+        else:
+            found = self._anchored_matches(value)
+        if len(found) > 1:
+            found.sort()
+        return found
+
+    def _glob_matchers(self) -> List[GlobMatcher]:
+        """Returns a matcher for each glob, using the backend of the set."""
+        matchers = []
+        for glob in self.globs:
+            matcher_class = _classify_glob(
+                glob, self.word_boundary, self.ignore_case, self.backend
+            )
+            matchers.append(
+                matcher_class(
+                    glob, word_boundary=self.word_boundary, ignore_case=self.ignore_case
+                )
+            )
+        return matchers
+
+    def _fold(self, literal: str) -> str:
+        return literal.lower() if self.ignore_case else literal
+
+    def _bucket_glob(
+        self, index: int, glob: str, matcher_class: Type[GlobMatcher]
+    ) -> bool:
+        """Adds a glob to the dict for its kind, if there is one.
+
+        Returns:
+            `True` if the glob was added, `False` if it needs a matcher of its own.
+        """
+        if matcher_class is _LiteralMatcher or (
+            matcher_class is _WordLiteralMatcher and _WORD.fullmatch(glob)
+        ):
+            self._literals.setdefault(self._fold(glob), []).append(index)
+        elif matcher_class is _PrefixMatcher:
+            literal = self._fold(glob.rstrip("*"))
+            prefixes = self._prefixes.setdefault(len(literal), {})
+            prefixes.setdefault(literal, []).append(index)
+        elif matcher_class is _SuffixMatcher:
+            literal = self._fold(glob.lstrip("*"))
+            suffixes = self._suffixes.setdefault(len(literal), {})
+            suffixes.setdefault(literal, []).append(index)
+        else:
+            return False
+        return True
+
+    def _anchored_matches(self, value: str) -> List[int]:
+        found: List[int] = []
+        if self._literals or self._prefixes or self._suffixes:
+            found = self._bucket_matches(value)
+
+        match = self._combined.match(value) if self._combined is not None else None
+        if match is not None:
+            # The alternation is tried in order, so only the globs after the one that
+            # matched are left to check.
+            assert match.lastindex is not None
+            first = match.lastindex - 1
+            regex_matchers = self._regex_matchers
+            found.append(regex_matchers[first][0])
+            for index, matcher in regex_matchers[first + 1 :]:
+                if matcher.pattern.match(value):
+                    found.append(index)
+
+        if self._matchers:
+            context = MatchContext(value)
+            found.extend(
+                index
+                for index, matcher in self._matchers
+                if matcher.match_context(context)
+            )
+        return found
+
+    def _bucket_matches(self, value: str) -> List[int]:
+        key = self._fold(value)
+        literal_indices = self._literals.get(key)
+        found = list(literal_indices) if literal_indices else []
+        # `*` does not match newlines, so there must be none after a prefix or before
+        # a suffix.
+        for length, prefixes in self._prefixes.items():
+            indices = prefixes.get(key[:length])
+            if indices and value.find("\n", length) == -1:
+                found.extend(indices)
+        for length, suffixes in self._suffixes.items():
+            start = len(key) - length
+            if start >= 0:
+                indices = suffixes.get(key[start:])
+                if indices and value.find("\n", 0, start) == -1:
+                    found.extend(indices)
+        return found
+
+    def _word_matches(self, value: str) -> List[int]:
+        context = MatchContext(value)
+        found: List[int] = []
+        if self._literals:
+            words = context.lowered_words if self.ignore_case else context.words
+            for word in self._literals.keys() & words:
+                found.extend(self._literals[word])
+        found.extend(
+            index for index, matcher in self._matchers if matcher.match_context(context)
+        )
+        if self._combined is not None and self._combined.search(value):
+            found.extend(
+                index
+                for index, matcher in self._regex_matchers
+                if matcher.match_context(context)
+            )
+        return found
+
+    def _instrumented_matches(
+        self, value: str, matchers: List[GlobMatcher]
+    ) -> List[int]:
+        if self.word_boundary:
+            context = MatchContext(value)
+            return [
+                index
+                for index, matcher in enumerate(matchers)
+                if matcher.match_context(context)
+            ]
+        return [index for index, matcher in enumerate(matchers) if matcher.match(value)]
+
+
+class KeyedConditionEvaluator:
+    """Evaluates rules made of `(key, glob)` conditions against flattened events.
+
+    Push rules and similar filters are lists of rules, each of which matches if all of
+    its conditions do. A condition matches if the event has a string at the given
+    dotted key, e.g. `content.body`, which matches the glob.
+
+    The globs are grouped by key, and each group is compiled into a single `GlobSet`.
+    When evaluating, each key is only looked up and matched once, the first time a
+    rule needs it, and each rule stops at its first failing condition.
+    """
+
+    def __init__(
+        self,
+        rules: Iterable[Iterable[Tuple[str, str]]],
+        *,
+        word_boundary_keys: Iterable[str] = ("content.body",),
+        ignore_case: bool = True,
+        backend: Optional[GlobBackend] = None,
+        instrumentation: Optional["MatchInstrumentation"] = None,
+    ) -> None:
+        """
+        Args:
+            rules: The rules, in priority order. Each is a sequence of `(key, glob)`
+                conditions. A rule without conditions always matches.
+            word_boundary_keys: The keys whose globs may match at word boundaries
+                anywhere in the value, as for `glob_to_regex`. The globs of other keys
+                must match the whole value. Defaults to `content.body`, as for push
+                rules.
+            ignore_case: If `True`, the globs will be case-insensitive.
+            backend: The engine to use for globs which need one, as for `GlobSet`.
+                Defaults to the backend set with `set_default_glob_backend`. Rules
+                from untrusted sources, such as push rules, should use
+                `GlobBackend.LINEAR`.
+            instrumentation: Where to report the time taken to match each glob, as
+                for `GlobSet`. Defaults to the instrumentation set with
+                `set_match_instrumentation`, if any.
+        """
+        word_boundary_keys = frozenset(word_boundary_keys)
+
+        # The globs of each key, and each rule as `(key, index of glob)` pairs.
+        globs_by_key: Dict[str, Dict[str, int]] = {}
+        self._rules: List[List[Tuple[str, int]]] = []
+        for rule in rules:
+            conditions = []
+            for key, glob in rule:
+                key_globs = globs_by_key.setdefault(key, {})
+                conditions.append((key, key_globs.setdefault(glob, len(key_globs))))
+            self._rules.append(conditions)
+
+        self._glob_sets = {
+            key: GlobSet(
+                key_globs,
+                word_boundary=key in word_boundary_keys,
+                ignore_case=ignore_case,
+                backend=backend,
+                instrumentation=instrumentation,
+            )
+            for key, key_globs in globs_by_key.items()
+        }
+
+    def __len__(self) -> int:
+        return len(self._rules)
+
+    def evaluate(self, event: Mapping[str, Any]) -> Optional[int]:
+        """Returns the index of the first rule which matches `event`, if any.
+
+        Args:
+            event: The flattened event, mapping dotted keys to values. Conditions on
+                keys which are missing or whose values are not strings do not match.
+        """
+        return next(self._matching_rules(event), None)
+
+    def matching_rules(self, event: Mapping[str, Any]) -> List[int]:
+        """Returns the indices of all the rules which match `event`, in order."""
+        return list(self._matching_rules(event))
+
+    def _matching_rules(self, event: Mapping[str, Any]) -> Iterator[int]:
+        # The indices of the matching globs of each key visited so far.
+        matched_by_key: Dict[str, FrozenSet[int]] = {}
+        for rule_index, conditions in enumerate(self._rules):
+            for key, glob_index in conditions:
+                matched = matched_by_key.get(key)
+                if matched is None:
+                    value = event.get(key)
+                    matched = matched_by_key[key] = (
+                        frozenset(self._glob_sets[key].matches(value))
+                        if isinstance(value, str)
+                        else frozenset()
+                    )
+                if glob_index not in matched:
+                    break
+            else:
+                yield rule_index
+
+
+def glob_match_mask(
+    glob: Union[str, GlobMatcher, GlobSet],
+    values: Iterable[str],
+    *,
+    word_boundary: bool = False,
+    ignore_case: bool = True,
+) -> Iterator[bool]:
+    """Matches a glob against many strings.
+
+    The glob is compiled once, and the strings are consumed lazily, so `values` may be a
+    generator over more strings than fit in memory.
+
+    Args:
+        glob: The glob to match, as for `glob_to_matcher`. A `GlobMatcher` or `GlobSet`
+            may be given instead, in which case `word_boundary` and `ignore_case` are
+            ignored. A `GlobSet` matches a string if any of its globs do.
+        values: The strings to match against.
+        word_boundary: As for `glob_to_regex`.
+        ignore_case: As for `glob_to_regex`.
+
+    Returns:
+        an iterator of whether each string matches, in the order of `values`.
+    """
+    if isinstance(glob, GlobSet):
+        return map(glob.match_any, values)
+    if isinstance(glob, str):
+        glob = glob_to_matcher(
+            glob, word_boundary=word_boundary, ignore_case=ignore_case
+        )
+    return glob.match_many(values)
+
+
+def glob_match_indices(
+    glob: Union[str, GlobMatcher, GlobSet],
+    values: Iterable[str],
+    *,
+    word_boundary: bool = False,
+    ignore_case: bool = True,
+) -> Iterator[int]:
+    """Like `glob_match_mask`, but returns the indices of the strings which match."""
+    mask = glob_match_mask(
+        glob, values, word_boundary=word_boundary, ignore_case=ignore_case
+    )
+    return itertools.compress(itertools.count(), mask)
+
+
+# The globs of the `glob_scan` running in this worker process.
+_scan_glob_set: Optional[GlobSet] = None
+
+
+def glob_scan(
+    globs: Iterable[str],
+    values: Iterable[str],
+    *,
+    word_boundary: bool = True,
+    ignore_case: bool = True,
+    backend: Optional[GlobBackend] = None,
+    workers: Optional[int] = None,
+    chunk_size: int = 1000,
+) -> Iterator[List[int]]:
+    """Matches a set of globs against many strings using a pool of processes.
+
+    Intended for sweeps over large numbers of message bodies, which would otherwise be
+    limited to one core. The strings are split into chunks which are sent to the
+    worker processes, each of which compiles the globs into a `GlobSet` once. The
+    strings are consumed lazily, with a bounded number of chunks in flight.
+
+    Args:
+        globs: The globs to match, as for `GlobSet`.
+        values: The strings to match against.
+        word_boundary: As for `GlobSet`. Defaults to `True`, as for message bodies.
+        ignore_case: As for `GlobSet`.
+        backend: As for `GlobSet`. Defaults to the backend set with
+            `set_default_glob_backend` in the calling process, which the worker
+            processes do not necessarily share.
+        workers: The number of worker processes. Defaults to the number of CPUs. If
+            0, the strings are matched in the calling process instead.
+        chunk_size: The number of strings sent to a worker at a time.
+
+    Returns:
+        an iterator of the indices of the globs which match each string, as for
+        `GlobSet.matches`, in the order of `values`.
+
+    Raises:
+        ValueError: if `workers` is negative or `chunk_size` is not positive.
+    """
+    if workers is not None and workers < 0:
+        raise ValueError(f"workers must not be negative, got {workers}")
+    if chunk_size < 1:
+        raise ValueError(f"chunk_size must be positive, got {chunk_size}")
+
+    globs = tuple(globs)
+    if backend is None:
+        backend = _default_backend
+    if workers == 0:
+        glob_set = GlobSet(
+            globs, word_boundary=word_boundary, ignore_case=ignore_case, backend=backend
+        )
+        return map(glob_set.matches, values)
+
+    return _glob_scan_in_pool(
+        (globs, word_boundary, ignore_case, backend),
+        values,
+        workers or os.cpu_count() or 1,
+        chunk_size,
+    )
+
+
+def _glob_scan_in_pool(
+    glob_set_args: Tuple[Tuple[str, ...], bool, bool, GlobBackend],
+    values: Iterable[str],
+    workers: int,
+    chunk_size: int,
+) -> Iterator[List[int]]:
+    from concurrent.futures import Future, ProcessPoolExecutor
+
+    with ProcessPoolExecutor(
+        workers, initializer=_init_scan_worker, initargs=glob_set_args
+    ) as executor:
+        # `ProcessPoolExecutor.map` would submit every chunk up front, so submit them
+        # as earlier ones are consumed instead, keeping each worker busy.
+        max_pending = 2 * workers
+        pending: Deque["Future[List[List[int]]]"] = collections.deque()
+        values = iter(values)
+        try:
+            while True:
+                while len(pending) < max_pending:
+                    chunk = list(itertools.islice(values, chunk_size))
+                    if not chunk:
+                        break
+                    pending.append(executor.submit(_scan_chunk, chunk))
+                if not pending:
+                    return
+                yield from pending.popleft().result()
+        finally:
+            # If the caller stops early, don't wait for chunks nobody will read.
+            for future in pending:
+                future.cancel()
+
+
+def _init_scan_worker(
+    globs: Tuple[str, ...],
+    word_boundary: bool,
+    ignore_case: bool,
+    backend: GlobBackend,
+) -> None:
+    global _scan_glob_set
+    _scan_glob_set = GlobSet(
+        globs, word_boundary=word_boundary, ignore_case=ignore_case, backend=backend
+    )
+
+
+def _scan_chunk(chunk: List[str]) -> List[List[int]]:
+    assert _scan_glob_set is not None
+    return [_scan_glob_set.matches(value) for value in chunk]
+
+
+class _DomainTrieNode:
+    __slots__ = ("children", "exact", "wildcards")
+
+    def __init__(self) -> None:
+        self.children: Dict[str, "_DomainTrieNode"] = {}
+        # Indices of the globs which end at this node.
+        self.exact: List[int] = []
+        # The number of leading `*` labels and the index of the globs which have them
+        # and whose remaining labels end at this node.
+        self.wildcards: List[Tuple[int, int]] = []
+
+
+class DomainGlobSet:
+    """A collection of globs over server names, indexed by their domain labels.
+
+    Server ACLs are mostly lists of globs such as `matrix.org`, `*.example.com` or
+    `*.*.badhost.net`: literal labels with only whole `*` labels in front. Such globs
+    are stored in a trie keyed by their labels in reverse, so that looking up a server
+    name costs time proportional to its number of labels rather than to the number of
+    globs. Any other globs are matched by a `GlobSet`.
+
+    The globs are anchored, and otherwise follow the same rules as `glob_to_regex`.
+    """
+
+    def __init__(
+        self,
+        globs: Iterable[str],
+        *,
+        ignore_case: bool = True,
+        backend: Optional[GlobBackend] = None,
+    ) -> None:
+        """
+        Args:
+            globs: The globs to match against.
+            ignore_case: If `True`, the globs will be case-insensitive.
+            backend: The engine to use for globs which need one, as for `GlobSet`.
+                Defaults to the backend set with `set_default_glob_backend`.
+        """
+        self.globs: Sequence[str] = tuple(globs)
+        self.ignore_case = ignore_case
+        self.backend = _default_backend if backend is None else backend
+
+        self._root = _DomainTrieNode()
+        generic_indices: List[int] = []
+        for index, glob in enumerate(self.globs):
+            if not self._insert(index, glob):
+                generic_indices.append(index)
+
+        self._generic_indices = generic_indices
+        self._generic = GlobSet(
+            [self.globs[index] for index in generic_indices],
+            ignore_case=ignore_case,
+            backend=self.backend,
+        )
+        self._all: Optional[GlobSet] = None
+
+    def __len__(self) -> int:
+        return len(self.globs)
+
+    def match_any(self, server_name: str) -> bool:
+        """Returns whether any of the globs match `server_name`."""
+        return bool(self.matches(server_name))
+
+    def match_first(self, server_name: str) -> Optional[int]:
+        """Returns the lowest index of a glob that matches `server_name`, if any."""
+        indices = self.matches(server_name)
+        return indices[0] if indices else None
+
+    def matches(self, server_name: str) -> List[int]:
+        """Returns the indices of all the globs that match `server_name`, in order."""
+        if "\n" in server_name or (self.ignore_case and not server_name.isascii()):
+            # Wildcards do not match newlines, and non-ASCII strings cannot be
+            # compared case-insensitively without `re`: see `glob_to_matcher`.
+            if self._all is None:
+                self._all = GlobSet(
+                    self.globs, ignore_case=self.ignore_case, backend=self.backend
+                )
+            return self._all.matches(server_name)
+
+        if self.ignore_case:
+            server_name = server_name.lower()
+        labels = server_name.split(".")
+
+        indices: List[int] = []
+        node: Optional[_DomainTrieNode] = self._root
+        # The number of labels not yet consumed by the walk down the trie.
+        remaining = len(labels)
+        while node is not None:
+            # A glob with `n` leading `*` labels needs the remaining labels to
+            # contain at least `n - 1` dots.
+            for stars, index in node.wildcards:
+                if remaining >= stars:
+                    indices.append(index)
+
+            if remaining == 0:
+                indices.extend(node.exact)
+                break
+
+            remaining -= 1
+            node = node.children.get(labels[remaining])
+
+        if self._generic_indices:
+            indices.extend(
+                self._generic_indices[index]
+                for index in self._generic.matches(server_name)
+            )
+
+        indices.sort()
+        return indices
+
+    def _insert(self, index: int, glob: str) -> bool:
+        """Adds a glob to the trie, if it has the right shape.
+
+        Returns:
+            `True` if the glob was added, `False` if it needs generic matching.
+        """
+        if self.ignore_case:
+            if not glob.isascii():
+                return False
+            glob = glob.lower()
+
+        labels = glob.split(".")
+        stars = 0
+        while stars < len(labels) and set(labels[stars]) == {"*"}:
+            stars += 1
+
+        literal_labels = labels[stars:]
+        if not literal_labels or any(
+            _WILDCARD_RUN.search(label) for label in literal_labels
+        ):
+            return False
+
+        node = self._root
+        for label in reversed(literal_labels):
+            child = node.children.get(label)
+            if child is None:
+                child = node.children[label] = _DomainTrieNode()
+            node = child
+
+        if stars:
+            node.wildcards.append((stars, index))
+        else:
+            node.exact.append(index)
+        return True
@@ -11,8 +11,44 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import importlib
+from typing import TYPE_CHECKING, Any, List
 
-from .mxc_uri import MXCUri
+if TYPE_CHECKING:
+    from .mxc_uri import MXCUri, MXCUriParseError
+    from .mxc_uri_set import MXCUriSet
+    from .server_name import ServerName, ServerNameKind
 
 # Allow importing classes directly from matrix_common.types.
-__all__ = ["MXCUri"]
+__all__ = ["MXCUri", "MXCUriParseError", "MXCUriSet", "ServerName", "ServerNameKind"]
+
+# The submodule defining each class. They are only imported when first used, as
+# `attr` is slow to import.
+_CLASS_MODULES = {
+    "MXCUri": ".mxc_uri",
+    "MXCUriParseError": ".mxc_uri",
+    "MXCUriSet": ".mxc_uri_set",
+    "ServerName": ".server_name",
+    "ServerNameKind": ".server_name",
+}
+
+
+# The submodules, which are likewise imported when first accessed as attributes.
+_SUBMODULES = frozenset({"mxc_uri", "mxc_uri_set", "server_name"})
+
+
+def __getattr__(name: str) -> Any:
+    if name in _SUBMODULES:
+        return importlib.import_module(f".{name}", __name__)
+
+    module_name = _CLASS_MODULES.get(name)
+    if module_name is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    value = getattr(importlib.import_module(module_name, __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__() -> List[str]:
+    return sorted({*globals(), *__all__, *_SUBMODULES})
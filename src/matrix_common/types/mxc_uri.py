@@ -11,13 +11,80 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-from typing import Type, TypeVar
-from urllib.parse import urlparse
+import re
+import sys
+import weakref
+from typing import Iterable, Iterator, List, Optional, Tuple, Type, TypeVar, Union, cast
 
 import attr
 
+from matrix_common._cache import CacheInfo, LruCache
+from matrix_common.types.server_name import ServerName
+
 MU = TypeVar("MU", bound="MXCUri")
 
+# Matches the MXC URIs which `urlparse` would split into exactly the "mxc" scheme, a
+# server name and a single path segment: printable ASCII only, and none of the
+# characters which delimit or get special treatment in URLs. Anything else is left
+# to `_parse_with_urlparse`, so both parsers accept and reject the same strings.
+_SIMPLE_MXC_URI_PART = r"[^\x00-\x20\x7f-\U0010ffff/?#;\[\]]+"
+_SIMPLE_MXC_URI = re.compile(
+    rf"mxc://({_SIMPLE_MXC_URI_PART})/({_SIMPLE_MXC_URI_PART})"
+)
+_SIMPLE_MXC_URI_BYTES = re.compile(
+    rb"mxc://([^\x00-\x20\x7f-\xff/?#;\[\]]+)/([^\x00-\x20\x7f-\xff/?#;\[\]]+)"
+)
+
+
+# Caches the results of `MXCUri.from_str`. Disabled until given a size with
+# `set_mxc_uri_parse_cache_size`.
+_parse_cache: "LruCache[Tuple[type, str], MXCUri]" = LruCache(0)
+
+# Canonical instances for `MXCUri.intern`, which go away once nothing else refers to
+# them.
+_interned: "weakref.WeakValueDictionary[Tuple[type, str, str], MXCUri]" = (
+    weakref.WeakValueDictionary()
+)
+_intern_parsed = False
+
+
+def set_mxc_uri_parse_cache_size(maxsize: int) -> None:
+    """Changes the number of parsed URIs kept by `MXCUri.from_str`.
+
+    Args:
+        maxsize: The new maximum number of entries. Least recently used entries are
+            evicted if the cache currently holds more than this. A value of 0, the
+            default, disables caching.
+
+    Raises:
+        ValueError: if `maxsize` is negative.
+    """
+    _parse_cache.resize(maxsize)
+
+
+def mxc_uri_parse_cache_info() -> CacheInfo:
+    """Returns the hit, miss and eviction statistics of the `MXCUri.from_str` cache."""
+    return _parse_cache.info()
+
+
+def clear_mxc_uri_parse_cache() -> None:
+    """Empties the `MXCUri.from_str` cache and resets its statistics."""
+    _parse_cache.clear()
+
+
+def set_mxc_uri_interning(enabled: bool) -> None:
+    """Sets whether `MXCUri.from_str` returns interned instances.
+
+    When enabled, every URI returned by `from_str` is passed through `MXCUri.intern`,
+    so that equal URIs share a single instance and server names share a single str.
+    Each distinct URI costs an entry in a weak dictionary, so this saves memory when
+    the same URIs are parsed repeatedly, but not for streams of distinct URIs.
+    Disabled by default. Changing the setting empties the `from_str` cache.
+    """
+    global _intern_parsed
+    _intern_parsed = enabled
+    _parse_cache.clear()
+
 
 @attr.s(frozen=True, slots=True, auto_attribs=True)
 class MXCUri:
@@ -43,44 +110,204 @@ class MXCUri:
         Raises:
             ValueError: If the str was not a valid MXC Uri.
         """
-        # Attempt to parse the given URI. This will raise a ValueError if the uri is
-        # particularly malformed.
-        parsed_mxc_uri = urlparse(mxc_uri_str)
-
-        # MXC Uri's are pretty bare bones. The scheme must be "mxc", and we don't allow
-        # any fragments, query parameters or other features.
-        if (
-            # The scheme must be "mxc".
-            parsed_mxc_uri.scheme != "mxc"
-            # There must be a host and path provided.
-            or not parsed_mxc_uri.netloc
-            or not parsed_mxc_uri.path
-            or not parsed_mxc_uri.path.startswith("/")
-            or len(parsed_mxc_uri.path) == 1  # if the path is only '/', aka no Media ID
-            # There cannot be any fragments, queries or parameters.
-            or parsed_mxc_uri.fragment
-            or parsed_mxc_uri.query
-            or parsed_mxc_uri.params
-        ):
-            raise ValueError(
-                f"Found invalid structure when parsing MXC Uri: {mxc_uri_str}"
+        if _parse_cache.maxsize and type(mxc_uri_str) is str:
+            # The cache is shared between subclasses, hence the casts.
+            return cast(
+                MU,
+                _parse_cache.get_or_compute(
+                    (cls, mxc_uri_str), lambda: cls._parse(mxc_uri_str)
+                ),
             )
 
-        # We use the parsed 'network location' as the server name
-        server_name = parsed_mxc_uri.netloc
+        return cls._parse(mxc_uri_str)
 
-        # urlparse adds a '/' to the beginning of the path, so let's remove that and use
-        # it as the media_id
-        media_id = parsed_mxc_uri.path[1:]
+    @classmethod
+    def from_bytes(cls: Type[MU], mxc_uri_bytes: Union[bytes, memoryview]) -> MU:
+        """
+        Given UTF-8 encoded bytes in the form "mxc://<domain>/<media_id>", return an
+        equivalent MXCUri.
 
-        # The media ID should not contain a '/'
-        if "/" in media_id:
-            raise ValueError(
-                f"Found invalid character in media ID portion of MXC Uri: {mxc_uri_str}"
-            )
+        Simple URIs are validated on the buffer itself, and only the server name and
+        media ID are decoded. Other URIs are decoded and follow the rules of
+        `from_str`.
+
+        Args:
+            mxc_uri_bytes: The MXC Uri as bytes or a memoryview of bytes.
+
+        Returns:
+            An MXCUri object with matching attributes.
+
+        Raises:
+            ValueError: If the bytes were not a valid UTF-8 encoded MXC Uri.
+        """
+        match = _SIMPLE_MXC_URI_BYTES.fullmatch(mxc_uri_bytes)
+        if match is None:
+            return cls.from_str(bytes(mxc_uri_bytes).decode("utf-8"))
+
+        mxc_uri = cls(match.group(1).decode("ascii"), match.group(2).decode("ascii"))
+        if _intern_parsed:
+            return mxc_uri.intern()
+        return mxc_uri
+
+    @classmethod
+    def _parse(cls: Type[MU], mxc_uri_str: str) -> MU:
+        match = None
+        if isinstance(mxc_uri_str, str):
+            match = _SIMPLE_MXC_URI.fullmatch(mxc_uri_str)
+
+        if match is not None:
+            mxc_uri = cls(match.group(1), match.group(2))
+        else:
+            mxc_uri = cls(*_parse_with_urlparse(mxc_uri_str))
+
+        if _intern_parsed:
+            return mxc_uri.intern()
+        return mxc_uri
 
-        return cls(server_name, media_id)
+    @property
+    def parsed_server_name(self) -> ServerName:
+        """The server name, split into its host and port.
+
+        Parsed on each access by `ServerName.from_str`, which caches the result, so
+        that URIs need not store it and parsing URIs costs nothing extra.
+
+        Raises:
+            ValueError: If the server name is not valid.
+        """
+        return ServerName.from_str(self.server_name)
+
+    def intern(self: MU) -> MU:
+        """Returns the canonical instance equal to this URI.
+
+        The canonical instance's server name is interned with `sys.intern`. Since
+        `MXCUri`s are immutable, the canonical instance can be shared freely; it is
+        kept for as long as something refers to it.
+        """
+        # The key is kept for as long as the canonical instance, so it must not hold
+        # on to a copy of the server name of its own.
+        server_name = sys.intern(self.server_name)
+        key = (type(self), server_name, self.media_id)
+        canonical = _interned.get(key)
+        if canonical is not None:
+            return cast(MU, canonical)
+
+        mxc_uri = self
+        if server_name is not self.server_name:
+            mxc_uri = attr.evolve(self, server_name=server_name)
+
+        return cast(MU, _interned.setdefault(key, mxc_uri))
 
     def __str__(self) -> str:
         """Convert an MXCUri object to a str."""
         return f"mxc://{self.server_name}/{self.media_id}"
+
+    def __bytes__(self) -> bytes:
+        """Convert an MXCUri object to UTF-8 encoded bytes."""
+        return str(self).encode("utf-8")
+
+
+@attr.s(frozen=True, slots=True, auto_attribs=True)
+class MXCUriParseError:
+    """An entry which `parse_many` could not parse as an MXC URI."""
+
+    # The position of the entry in the input, counting from 0.
+    index: int
+    # The entry, without any trailing line ending.
+    value: str
+    # The message of the `ValueError` raised by `MXCUri.from_str`.
+    reason: str
+
+
+def parse_many(
+    mxc_uri_strs: Iterable[str],
+    *,
+    errors: Optional[List[MXCUriParseError]] = None,
+) -> Iterator[Union[MXCUri, MXCUriParseError]]:
+    """Lazily parses many MXC URIs, reporting invalid entries instead of raising.
+
+    The input is consumed one entry at a time, so it can be a file object or a
+    database cursor over more URIs than fit in memory. A trailing line ending is
+    removed from each entry, so that the lines of a text file can be parsed directly.
+
+    Args:
+        mxc_uri_strs: The strs to parse.
+        errors: If given, invalid entries are appended to this list rather than
+            yielded.
+
+    Yields:
+        An `MXCUri` for each valid entry and, unless `errors` was given, an
+        `MXCUriParseError` for each invalid entry, in the order of the input.
+    """
+    # Skip the call to `MXCUri.from_str` for the common case, unless caching or
+    # interning need it.
+    fullmatch = _SIMPLE_MXC_URI.fullmatch
+    use_fast_path = not _parse_cache.maxsize and not _intern_parsed
+
+    for index, mxc_uri_str in enumerate(mxc_uri_strs):
+        if type(mxc_uri_str) is not str:
+            match = None
+        else:
+            if mxc_uri_str.endswith("\n"):
+                mxc_uri_str = mxc_uri_str[: -2 if mxc_uri_str.endswith("\r\n") else -1]
+            match = fullmatch(mxc_uri_str) if use_fast_path else None
+
+        if match is not None:
+            yield MXCUri(match.group(1), match.group(2))
+            continue
+
+        try:
+            mxc_uri = MXCUri.from_str(mxc_uri_str)
+        except ValueError as e:
+            error = MXCUriParseError(index, mxc_uri_str, str(e))
+            if errors is None:
+                yield error
+            else:
+                errors.append(error)
+        else:
+            yield mxc_uri
+
+
+def _parse_with_urlparse(mxc_uri_str: str) -> Tuple[str, str]:
+    """Splits an MXC URI into its server name and media ID using `urlparse`.
+
+    Raises:
+        ValueError: If the str was not a valid MXC Uri.
+    """
+    # Imported lazily, as most MXC URIs never need it.
+    from urllib.parse import urlparse
+
+    # Attempt to parse the given URI. This will raise a ValueError if the uri is
+    # particularly malformed.
+    parsed_mxc_uri = urlparse(mxc_uri_str)
+
+    # MXC Uri's are pretty bare bones. The scheme must be "mxc", and we don't allow
+    # any fragments, query parameters or other features.
+    if (
+        # The scheme must be "mxc".
+        parsed_mxc_uri.scheme != "mxc"
+        # There must be a host and path provided.
+        or not parsed_mxc_uri.netloc
+        or not parsed_mxc_uri.path
+        or not parsed_mxc_uri.path.startswith("/")
+        or len(parsed_mxc_uri.path) == 1  # if the path is only '/', aka no Media ID
+        # There cannot be any fragments, queries or parameters.
+        or parsed_mxc_uri.fragment
+        or parsed_mxc_uri.query
+        or parsed_mxc_uri.params
+    ):
+        raise ValueError(f"Found invalid structure when parsing MXC Uri: {mxc_uri_str}")
+
+    # We use the parsed 'network location' as the server name
+    server_name = parsed_mxc_uri.netloc
+
+    # urlparse adds a '/' to the beginning of the path, so let's remove that and use
+    # it as the media_id
+    media_id = parsed_mxc_uri.path[1:]
+
+    # The media ID should not contain a '/'
+    if "/" in media_id:
+        raise ValueError(
+            f"Found invalid character in media ID portion of MXC Uri: {mxc_uri_str}"
+        )
+
+    return server_name, media_id
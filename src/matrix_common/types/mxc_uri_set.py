@@ -0,0 +1,255 @@
+# Copyright 2022 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import bisect
+import heapq
+from array import array
+from typing import Dict, Iterable, Iterator, List, Set
+
+from .mxc_uri import MXCUri
+
+# Media IDs are stored as UTF-8. `surrogatepass` lets any str round-trip.
+_ENCODING = "utf-8"
+_ERRORS = "surrogatepass"
+
+
+class _PackedMediaIds:
+    """A sorted, duplicate-free sequence of media IDs packed into a single buffer.
+
+    The encoded media IDs are concatenated into `_data`, and the `i`th media ID spans
+    `_data[_offsets[i]:_offsets[i + 1]]`. Byte-wise order of UTF-8 is code point
+    order, so the sequence can be binary searched.
+    """
+
+    __slots__ = ("_data", "_offsets")
+
+    def __init__(self, sorted_media_ids: Iterable[bytes]) -> None:
+        """
+        Args:
+            sorted_media_ids: Encoded media IDs, in ascending order, without
+                duplicates.
+        """
+        chunks = list(sorted_media_ids)
+        self._data = b"".join(chunks)
+
+        offsets = array("I" if len(self._data) < 2**32 else "Q", [0])
+        position = 0
+        for chunk in chunks:
+            position += len(chunk)
+            offsets.append(position)
+        self._offsets = offsets
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def __getitem__(self, index: int) -> bytes:
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return self._data[self._offsets[index] : self._offsets[index + 1]]
+
+    def __iter__(self) -> Iterator[bytes]:
+        data = self._data
+        offsets = self._offsets
+        for index in range(len(offsets) - 1):
+            yield data[offsets[index] : offsets[index + 1]]
+
+    def __contains__(self, media_id: bytes) -> bool:
+        index = bisect.bisect_left(self, media_id)
+        return index < len(self) and self[index] == media_id
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, _PackedMediaIds):
+            return NotImplemented
+        return self._data == other._data and self._offsets == other._offsets
+
+    def __hash__(self) -> int:
+        return hash(self._data)
+
+    def nbytes(self) -> int:
+        """The number of bytes used by the buffers."""
+        return len(self._data) + self._offsets.itemsize * len(self._offsets)
+
+
+def _union(left: Iterable[bytes], right: Iterable[bytes]) -> Iterator[bytes]:
+    previous = None
+    for media_id in heapq.merge(left, right):
+        if media_id != previous:
+            yield media_id
+            previous = media_id
+
+
+def _intersection(left: _PackedMediaIds, right: _PackedMediaIds) -> Iterator[bytes]:
+    if len(left) > len(right):
+        left, right = right, left
+    return (media_id for media_id in left if media_id in right)
+
+
+def _difference(left: _PackedMediaIds, right: _PackedMediaIds) -> Iterator[bytes]:
+    # Binary search `right` if it is much larger than `left`. Otherwise, walk both
+    # sequences in step.
+    if len(right) > 16 * len(left):
+        return (media_id for media_id in left if media_id not in right)
+    return _merge_difference(left, right)
+
+
+def _merge_difference(left: _PackedMediaIds, right: _PackedMediaIds) -> Iterator[bytes]:
+    right_iter = iter(right)
+    current = next(right_iter, None)
+    for media_id in left:
+        while current is not None and current < media_id:
+            current = next(right_iter, None)
+        if current != media_id:
+            yield media_id
+
+
+class MXCUriSet:
+    """An immutable set of `MXCUri`s, stored compactly.
+
+    A `set` of `MXCUri`s costs an `MXCUri` and two strs per element. An `MXCUriSet`
+    stores each server name once, and the media IDs of each server in a single packed
+    buffer sorted for binary search. `MXCUri`s are only created while iterating.
+
+    Supports membership tests, `len`, iteration, equality and hashing like a
+    `frozenset`, as well as union (`|`), intersection (`&`) and difference (`-`) with other
+    `MXCUriSet`s, and per-server iteration.
+    """
+
+    __slots__ = ("_server_ids", "_server_names", "_media_ids")
+
+    def __init__(self, mxc_uris: Iterable[MXCUri] = ()) -> None:
+        groups: Dict[str, Set[bytes]] = {}
+        for mxc_uri in mxc_uris:
+            groups.setdefault(mxc_uri.server_name, set()).add(
+                mxc_uri.media_id.encode(_ENCODING, _ERRORS)
+            )
+
+        self._server_ids: Dict[str, int] = {}
+        self._server_names: List[str] = []
+        self._media_ids: List[_PackedMediaIds] = []
+        for server_name, media_ids in groups.items():
+            self._add_server(server_name, _PackedMediaIds(sorted(media_ids)))
+
+    @classmethod
+    def _from_packed(cls, groups: Dict[str, Iterable[bytes]]) -> "MXCUriSet":
+        """Builds a set from sorted, duplicate-free media IDs grouped by server."""
+        mxc_uri_set = cls()
+        for server_name, media_ids in groups.items():
+            packed = _PackedMediaIds(media_ids)
+            if len(packed):
+                mxc_uri_set._add_server(server_name, packed)
+        return mxc_uri_set
+
+    def _add_server(self, server_name: str, media_ids: _PackedMediaIds) -> None:
+        # The index of a server name in `_server_names` is its ID.
+        self._server_ids[server_name] = len(self._server_names)
+        self._server_names.append(server_name)
+        self._media_ids.append(media_ids)
+
+    def _media_ids_of(self, server_name: str) -> _PackedMediaIds:
+        server_id = self._server_ids.get(server_name)
+        if server_id is None:
+            return _EMPTY
+        return self._media_ids[server_id]
+
+    def __contains__(self, item: object) -> bool:
+        if not isinstance(item, MXCUri):
+            return False
+        server_id = self._server_ids.get(item.server_name)
+        if server_id is None:
+            return False
+        return item.media_id.encode(_ENCODING, _ERRORS) in self._media_ids[server_id]
+
+    def __len__(self) -> int:
+        return sum(len(media_ids) for media_ids in self._media_ids)
+
+    def __iter__(self) -> Iterator[MXCUri]:
+        for server_name in self._server_names:
+            yield from self.iter_server(server_name)
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, MXCUriSet):
+            return NotImplemented
+        return len(self) == len(other) and all(
+            self._media_ids_of(server_name) == media_ids
+            for server_name, media_ids in zip(other._server_names, other._media_ids)
+        )
+
+    def __hash__(self) -> int:
+        # Equal sets may have added their servers in different orders.
+        return hash(frozenset(zip(self._server_names, self._media_ids)))
+
+    def __repr__(self) -> str:
+        return f"<MXCUriSet of {len(self)} URIs on {len(self._server_names)} servers>"
+
+    def server_names(self) -> List[str]:
+        """Returns the server names of the URIs in the set."""
+        return list(self._server_names)
+
+    def media_ids(self, server_name: str) -> Iterator[str]:
+        """Yields the media IDs on the given server, in code point order."""
+        for media_id in self._media_ids_of(server_name):
+            yield media_id.decode(_ENCODING, _ERRORS)
+
+    def iter_server(self, server_name: str) -> Iterator[MXCUri]:
+        """Yields the URIs on the given server, ordered by media ID."""
+        for media_id in self.media_ids(server_name):
+            yield MXCUri(server_name, media_id)
+
+    def count(self, server_name: str) -> int:
+        """Returns the number of URIs on the given server."""
+        return len(self._media_ids_of(server_name))
+
+    def union(self, other: "MXCUriSet") -> "MXCUriSet":
+        """Returns the URIs in either set."""
+        groups: Dict[str, Iterable[bytes]] = {}
+        for server_name, media_ids in zip(self._server_names, self._media_ids):
+            groups[server_name] = _union(media_ids, other._media_ids_of(server_name))
+        for server_name, media_ids in zip(other._server_names, other._media_ids):
+            if server_name not in self._server_ids:
+                groups[server_name] = media_ids
+        return self._from_packed(groups)
+
+    def intersection(self, other: "MXCUriSet") -> "MXCUriSet":
+        """Returns the URIs in both sets."""
+        return self._from_packed(
+            {
+                server_name: _intersection(media_ids, other._media_ids_of(server_name))
+                for server_name, media_ids in zip(self._server_names, self._media_ids)
+                if server_name in other._server_ids
+            }
+        )
+
+    def difference(self, other: "MXCUriSet") -> "MXCUriSet":
+        """Returns the URIs in this set but not the other."""
+        return self._from_packed(
+            {
+                server_name: _difference(media_ids, other._media_ids_of(server_name))
+                for server_name, media_ids in zip(self._server_names, self._media_ids)
+            }
+        )
+
+    def __or__(self, other: "MXCUriSet") -> "MXCUriSet":
+        return self.union(other)
+
+    def __and__(self, other: "MXCUriSet") -> "MXCUriSet":
+        return self.intersection(other)
+
+    def __sub__(self, other: "MXCUriSet") -> "MXCUriSet":
+        return self.difference(other)
+
+    def nbytes(self) -> int:
+        """Returns the number of bytes used by the packed media ID buffers."""
+        return sum(media_ids.nbytes() for media_ids in self._media_ids)
+
+
+_EMPTY = _PackedMediaIds(())
@@ -0,0 +1,190 @@
+# Copyright 2022 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import enum
+import re
+import sys
+import weakref
+from typing import Optional, Tuple, Type, TypeVar, cast
+
+import attr
+
+from matrix_common._cache import CacheInfo, LruCache
+
+SN = TypeVar("SN", bound="ServerName")
+
+# The grammar of server names from the appendices of the Matrix specification. An
+# IPv4 address is tried before a DNS name, which would also match it.
+_SERVER_NAME = re.compile(
+    r"(?:(?P<ipv4>[0-9]{1,3}(?:\.[0-9]{1,3}){3})"
+    r"|(?P<ipv6>\[[0-9A-Fa-f:.]{2,45}\])"
+    r"|(?P<dns>[0-9A-Za-z.-]{1,255}))"
+    r"(?::(?P<port>[0-9]{1,5}))?"
+)
+
+# The default number of parsed server names kept by `ServerName.from_str`. A server
+# sees far fewer distinct server names than it parses, so the cache is enabled by
+# default, unlike that of `MXCUri.from_str`. The public federation numbers some tens
+# of thousands of servers, but a single homeserver mostly deals with the few hundred
+# to low thousands that share rooms with its users, and of those a much smaller set
+# of large servers accounts for most events and media. 1024 entries, a few hundred
+# KiB, hold that hot set; a deployment which sees many more can raise the size with
+# `set_server_name_parse_cache_size`.
+DEFAULT_SERVER_NAME_PARSE_CACHE_SIZE = 1024
+
+_parse_cache: "LruCache[Tuple[type, str], ServerName]" = LruCache(
+    DEFAULT_SERVER_NAME_PARSE_CACHE_SIZE
+)
+
+# Canonical instances for `ServerName.intern`, which go away once nothing else refers
+# to them.
+_interned: "weakref.WeakValueDictionary[Tuple[type, str, Optional[int]], ServerName]"
+_interned = weakref.WeakValueDictionary()
+_intern_parsed = False
+
+
+def set_server_name_parse_cache_size(maxsize: int) -> None:
+    """Changes the number of parsed server names kept by `ServerName.from_str`.
+
+    Args:
+        maxsize: The new maximum number of entries. Least recently used entries are
+            evicted if the cache currently holds more than this. A value of 0
+            disables caching.
+
+    Raises:
+        ValueError: if `maxsize` is negative.
+    """
+    _parse_cache.resize(maxsize)
+
+
+def server_name_parse_cache_info() -> CacheInfo:
+    """Returns the hit, miss and eviction statistics of the server name cache."""
+    return _parse_cache.info()
+
+
+def clear_server_name_parse_cache() -> None:
+    """Empties the `ServerName.from_str` cache and resets its statistics."""
+    _parse_cache.clear()
+
+
+def set_server_name_interning(enabled: bool) -> None:
+    """Sets whether `ServerName.from_str` returns interned instances.
+
+    When enabled, every server name returned by `from_str` is passed through
+    `ServerName.intern`, so that equal server names share a single instance even once
+    evicted from the cache, or with the cache disabled. Disabled by default. Changing
+    the setting empties the `from_str` cache.
+    """
+    global _intern_parsed
+    _intern_parsed = enabled
+    _parse_cache.clear()
+
+
+class ServerNameKind(enum.Enum):
+    """The kind of host in a server name."""
+
+    IPV4 = "ipv4"
+    IPV6 = "ipv6"
+    DNS = "dns"
+
+
+@attr.s(frozen=True, slots=True, auto_attribs=True)
+class ServerName:
+    """Represents a server name in matrix, split into its host and port.
+
+    Server names take the form 'host[:port]', where the host is an IPv4 address, an
+    IPv6 address in square brackets or a DNS name.
+    """
+
+    # The host, including the square brackets of an IPv6 address.
+    host: str
+    port: Optional[int]
+    kind: ServerNameKind
+
+    @classmethod
+    def from_str(cls: Type[SN], server_name: str) -> SN:
+        """
+        Given a str in the form "<host>[:<port>]", return an equivalent ServerName.
+
+        Parsed server names are kept in a bounded cache which can be configured with
+        `set_server_name_parse_cache_size`, so that equal server names parsed in
+        close succession share an instance. They are only interned if enabled with
+        `set_server_name_interning`.
+
+        Args:
+            server_name: The server name as a str.
+
+        Returns:
+            A ServerName object with matching attributes.
+
+        Raises:
+            ValueError: If the str was not a valid server name.
+        """
+        if _parse_cache.maxsize and type(server_name) is str:
+            # The cache is shared between subclasses, hence the casts.
+            return cast(
+                SN,
+                _parse_cache.get_or_compute(
+                    (cls, server_name), lambda: cls._parse(server_name)
+                ),
+            )
+
+        return cls._parse(server_name)
+
+    @classmethod
+    def _parse(cls: Type[SN], server_name: str) -> SN:
+        match = None
+        if isinstance(server_name, str):
+            match = _SERVER_NAME.fullmatch(server_name)
+        if match is None:
+            raise ValueError(f"Invalid server name: {server_name!r}")
+
+        ipv4, ipv6, dns, port = match.groups()
+        if ipv4 is not None:
+            host, kind = ipv4, ServerNameKind.IPV4
+        elif ipv6 is not None:
+            host, kind = ipv6, ServerNameKind.IPV6
+        else:
+            host, kind = dns, ServerNameKind.DNS
+
+        parsed = cls(host, None if port is None else int(port), kind)
+        if _intern_parsed:
+            return parsed.intern()
+        return parsed
+
+    def intern(self: SN) -> SN:
+        """Returns the canonical instance equal to this server name.
+
+        The canonical instance's host is interned with `sys.intern`. Since
+        `ServerName`s are immutable, the canonical instance can be shared freely; it
+        is kept for as long as something refers to it.
+        """
+        # The key is kept for as long as the canonical instance, so it must not hold
+        # on to a copy of the host of its own.
+        host = sys.intern(self.host)
+        key = (type(self), host, self.port)
+        canonical = _interned.get(key)
+        if canonical is not None:
+            return cast(SN, canonical)
+
+        server_name = self
+        if host is not self.host:
+            server_name = attr.evolve(self, host=host)
+
+        return cast(SN, _interned.setdefault(key, server_name))
+
+    def __str__(self) -> str:
+        """Convert a ServerName object to a str."""
+        if self.port is None:
+            return self.host
+        return f"{self.host}:{self.port}"
@@ -15,22 +15,38 @@
 import functools
 import logging
 import os.path
-import subprocess
-from typing import Optional
+import re
+import time
+from typing import TYPE_CHECKING, Any, Dict, List, Optional
 
-try:
-    from importlib.metadata import distribution
-except ImportError:
-    from importlib_metadata import distribution  # type: ignore
+from matrix_common._git import (
+    _RACY_NS,
+    GitMetadata,
+    checkout_fingerprint,
+    read_git_metadata,
+)
 
-__all__ = ["get_distribution_version_string"]
+if TYPE_CHECKING:
+    from importlib.metadata import Distribution
+
+# `subprocess`, `importlib.metadata` and friends are imported when first needed: they
+# are slow to import, and many processes only want the cached version string.
+
+__all__ = [
+    "get_distribution_version_string",
+    "get_distribution_version_string_async",
+    "stamp_distribution_version_string",
+]
 
 logger = logging.getLogger(__name__)
 
+# The environment variable which enables the on-disk version string cache.
+VERSION_CACHE_DIR_ENV = "MATRIX_COMMON_VERSION_CACHE_DIR"
+
 
 @functools.lru_cache()
 def get_distribution_version_string(
-    distribution_name: str, cwd: Optional[str] = None
+    distribution_name: str, cwd: Optional[str] = None, cache_dir: Optional[str] = None
 ) -> str:
     """Calculate a git-aware version string for a distribution package.
 
@@ -53,6 +69,11 @@ def get_distribution_version_string(
             If omitted, the function will attempt to locate the distribution's source
             on disk and use that location instead---but this fallback is not reliable.
 
+        cache_dir: if provided, a directory in which to cache the version string
+            between processes. Defaults to the `MATRIX_COMMON_VERSION_CACHE_DIR`
+            environment variable, if set. Cached version strings are used until the
+            git checkout changes. See also `stamp_distribution_version_string`.
+
     Raises:
         importlib.metadata.PackageNotFoundError if the given distribution name doesn't
         exist.
@@ -61,46 +82,276 @@ def get_distribution_version_string(
         The module version, possibly with git version information included.
     """
 
-    dist = distribution(distribution_name)
-    version_string = dist.version
+    dist = _distribution(distribution_name)
+    cwd = _git_cwd(dist, cwd)
+    cache_dir = cache_dir or os.environ.get(VERSION_CACHE_DIR_ENV)
+    if cache_dir:
+        return _cached_version_string(
+            cache_dir, distribution_name, dist.version, cwd, stamp=False
+        )
+
+    try:
+        return dist.version + _git_version_suffix(cwd)
+    except Exception as e:
+        logger.info("Failed to check for git repository: %s", e)
+        return dist.version
+
+
+async def get_distribution_version_string_async(
+    distribution_name: str, cwd: Optional[str] = None, cache_dir: Optional[str] = None
+) -> str:
+    """As `get_distribution_version_string`, but without blocking the event loop.
+
+    The version string is calculated on a thread pool: the event loop's default
+    executor when called from an asyncio task, and otherwise Twisted's reactor thread
+    pool. Results are cached together with those of
+    `get_distribution_version_string`.
+    """
+    import asyncio
+
+    call = functools.partial(
+        get_distribution_version_string, distribution_name, cwd, cache_dir
+    )
+
+    try:
+        in_asyncio_task = asyncio.current_task() is not None
+    except RuntimeError:
+        # There is no running asyncio event loop.
+        in_asyncio_task = False
+
+    if in_asyncio_task:
+        return await asyncio.get_running_loop().run_in_executor(None, call)
+
+    # Coroutines run by Twisted can only await Deferreds, even when Twisted runs on
+    # an asyncio event loop.
+    from twisted.internet.threads import deferToThread
+
+    return await deferToThread(call)
+
+
+def stamp_distribution_version_string(
+    distribution_name: str, cwd: Optional[str] = None, cache_dir: Optional[str] = None
+) -> str:
+    """Calculate a git-aware version string and store it in the on-disk cache.
+
+    Run this when building or installing a distribution package, so that processes
+    which then start together read one precomputed version string rather than each
+    running git. The stamp is used until the git checkout changes.
+
+    Can also be run as `python -m matrix_common.versionstring DISTRIBUTION`.
+
+    Args:
+        distribution_name: The name of the distribution package to check the version of
+
+        cwd: as for `get_distribution_version_string`.
+
+        cache_dir: the directory to store the version string in. Defaults to the
+            `MATRIX_COMMON_VERSION_CACHE_DIR` environment variable.
+
+    Raises:
+        importlib.metadata.PackageNotFoundError if the given distribution name doesn't
+        exist.
+
+        ValueError if no cache directory is given.
+
+    Returns:
+        The module version, possibly with git version information included.
+    """
+    cache_dir = cache_dir or os.environ.get(VERSION_CACHE_DIR_ENV)
+    if not cache_dir:
+        raise ValueError(
+            f"No cache directory given, and {VERSION_CACHE_DIR_ENV} is not set"
+        )
+
+    dist = _distribution(distribution_name)
+    return _cached_version_string(
+        cache_dir, distribution_name, dist.version, _git_cwd(dist, cwd), stamp=True
+    )
+
+
+def _distribution(distribution_name: str) -> "Distribution":
+    try:
+        from importlib.metadata import distribution
+    except ImportError:
+        from importlib_metadata import distribution  # type: ignore
+
+    return distribution(distribution_name)
+
+
+def _git_cwd(dist: "Distribution", cwd: Optional[str]) -> str:
     if cwd is None:
         # This used to work for Synapse, but seems to have broken between versions 1.56
         # and 1.57. I suspect that the cause is a difference in the metadata generated
         # by `setuptools` and `poetry-core` at package-install time.
         cwd = dist.locate_file(".").__fspath__()
-    cwd = os.path.dirname(cwd)
-    try:
+    return os.path.dirname(cwd)
+
 
-        def _run_git_command(prefix: str, *params: str) -> str:
-            try:
-                result = (
-                    subprocess.check_output(
-                        ["git", *params], stderr=subprocess.DEVNULL, cwd=cwd
-                    )
-                    .strip()
-                    .decode("ascii")
-                )
-                return prefix + result
-            except (subprocess.CalledProcessError, FileNotFoundError):
-                return ""
-
-        git_branch = _run_git_command("b=", "rev-parse", "--abbrev-ref", "HEAD")
-        git_tag = _run_git_command("t=", "describe", "--exact-match")
-        git_commit = _run_git_command("", "rev-parse", "--short", "HEAD")
+def _git_version_suffix(cwd: str) -> str:
+    """Returns the git information to append to the version string, if any."""
+    metadata = read_git_metadata(cwd)
+    if metadata is None:
+        metadata = _read_git_metadata_with_cli(cwd)
 
+    git_branch = "b=" + metadata.branch if metadata.branch else ""
+    git_tag = "t=" + metadata.tag if metadata.tag else ""
+    git_commit = metadata.commit
+
+    # `git describe` fails in repositories without annotated tags, so a dirty
+    # checkout can only be detected if there are some.
+    is_dirty = False
+    if metadata.describable:
         dirty_string = "-this_is_a_dirty_checkout"
-        is_dirty = _run_git_command("", "describe", "--dirty=" + dirty_string).endswith(
-            dirty_string
+        is_dirty = _run_git_command(
+            cwd, "describe", "--dirty=" + dirty_string
+        ).endswith(dirty_string)
+    git_dirty = "dirty" if is_dirty else ""
+
+    if git_branch or git_tag or git_commit or git_dirty:
+        git_version = ",".join(
+            s for s in (git_branch, git_tag, git_commit, git_dirty) if s
         )
-        git_dirty = "dirty" if is_dirty else ""
+        return f" ({git_version})"
+    return ""
 
-        if git_branch or git_tag or git_commit or git_dirty:
-            git_version = ",".join(
-                s for s in (git_branch, git_tag, git_commit, git_dirty) if s
-            )
 
-            version_string = f"{version_string} ({git_version})"
+def _cached_version_string(
+    cache_dir: str, distribution_name: str, version: str, cwd: str, stamp: bool
+) -> str:
+    """Returns the version string from the on-disk cache, calculating it if needed.
+
+    Args:
+        stamp: if true, always calculate the version string, and wait rather than
+            skip storing it if the checkout changed too recently.
+    """
+    # The fingerprint must be taken before running git, so that changes made while
+    # git runs invalidate the entry.
+    fingerprint = checkout_fingerprint(cwd)
+    if stamp and fingerprint is not None and fingerprint.racy:
+        time.sleep(_RACY_NS / 1e9)
+        fingerprint = checkout_fingerprint(cwd)
+
+    abs_cwd = os.path.abspath(cwd)
+    key = {
+        "distribution": distribution_name,
+        "version": version,
+        "cwd": abs_cwd,
+        "fingerprint": fingerprint.digest if fingerprint is not None else None,
+    }
+    import hashlib
+
+    safe_name = re.sub(r"[^A-Za-z0-9._-]", "_", distribution_name)
+    cwd_hash = hashlib.sha256(os.fsencode(abs_cwd)).hexdigest()[:16]
+    path = os.path.join(cache_dir, f"{safe_name}-{cwd_hash}.json")
+
+    if fingerprint is not None and not stamp:
+        entry = _read_cache_entry(path)
+        if entry is not None and all(
+            entry.get(name) == value for name, value in key.items()
+        ):
+            cached = entry.get("version_string")
+            if isinstance(cached, str):
+                return cached
+
+    try:
+        version_string = version + _git_version_suffix(cwd)
     except Exception as e:
         logger.info("Failed to check for git repository: %s", e)
+        return version
 
+    log = logger.info if stamp else logger.debug
+    if fingerprint is None:
+        log("Not caching the version string: cannot fingerprint %s", cwd)
+    elif fingerprint.racy:
+        log("Not caching the version string: %s changed too recently", cwd)
+    else:
+        _write_cache_entry(path, {**key, "version_string": version_string})
     return version_string
+
+
+def _read_cache_entry(path: str) -> Optional[Dict[str, Any]]:
+    import json
+
+    try:
+        with open(path, encoding="utf-8") as f:
+            entry = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.info("Failed to read cached version string %s: %s", path, e)
+        return None
+    return entry if isinstance(entry, dict) else None
+
+
+def _write_cache_entry(path: str, entry: Dict[str, Any]) -> None:
+    """Writes a cache entry atomically, so that readers never see a partial entry."""
+    import json
+    import tempfile
+
+    directory = os.path.dirname(path)
+    try:
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(entry, f)
+            # Let other users, e.g. workers running as a service user, read stamps.
+            os.chmod(temp_path, 0o644)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+    except OSError as e:
+        logger.info("Failed to cache version string in %s: %s", path, e)
+
+
+def _run_git_command(cwd: str, *params: str) -> str:
+    import subprocess
+
+    try:
+        return (
+            subprocess.check_output(
+                ["git", *params], stderr=subprocess.DEVNULL, cwd=cwd
+            )
+            .strip()
+            .decode("ascii")
+        )
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        return ""
+
+
+def _read_git_metadata_with_cli(cwd: str) -> GitMetadata:
+    return GitMetadata(
+        branch=_run_git_command(cwd, "rev-parse", "--abbrev-ref", "HEAD"),
+        tag=_run_git_command(cwd, "describe", "--exact-match"),
+        commit=_run_git_command(cwd, "rev-parse", "--short", "HEAD"),
+        describable=True,
+    )
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    """Stamps the version string of a distribution, e.g. while building an image."""
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog="python -m matrix_common.versionstring",
+        description=main.__doc__,
+    )
+    parser.add_argument("distribution", help="the name of the distribution package")
+    parser.add_argument("--cwd", help="a path inside the git checkout")
+    parser.add_argument(
+        "--cache-dir", help=f"the cache directory. Defaults to ${VERSION_CACHE_DIR_ENV}"
+    )
+    args = parser.parse_args(argv)
+
+    try:
+        version_string = stamp_distribution_version_string(
+            args.distribution, cwd=args.cwd, cache_dir=args.cache_dir
+        )
+    except ValueError as e:
+        parser.error(str(e))
+    print(version_string)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+# Copyright 2022 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import json
+from unittest import TestCase
+
+from benchmarks.__main__ import BENCHMARKS, run
+from benchmarks.compare import compare
+
+
+class BenchmarksTestCase(TestCase):
+    def test_quick_run(self) -> None:
+        """Every benchmark runs, and the results are JSON-serialisable."""
+        results = json.loads(json.dumps(run(quick=True)))
+        self.assertEqual(
+            list(results["results"]), [benchmark.name for benchmark in BENCHMARKS]
+        )
+        for result in results["results"].values():
+            self.assertGreater(result["best_seconds_per_item"], 0)
+
+    def test_compare(self) -> None:
+        """Benchmarks in both sets of results are compared by best time per item."""
+        base = {"results": {"a": {"best_seconds_per_item": 2.0}}}
+        new = {
+            "results": {
+                "a": {"best_seconds_per_item": 3.0},
+                "b": {"best_seconds_per_item": 1.0},
+            }
+        }
+        self.assertEqual(compare(base, new), [("a", 2.0, 3.0, 1.5)])
@@ -0,0 +1,230 @@
+# Copyright 2022 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import shutil
+import subprocess
+import tempfile
+from typing import Dict, Optional
+from unittest import TestCase, skipIf
+from unittest.mock import patch
+
+from matrix_common._git import GitMetadata, checkout_fingerprint, read_git_metadata
+from matrix_common.versionstring import _read_git_metadata_with_cli
+
+_GIT_ENV: Dict[str, str] = {
+    "GIT_AUTHOR_NAME": "Test",
+    "GIT_AUTHOR_EMAIL": "test@example.com",
+    "GIT_COMMITTER_NAME": "Test",
+    "GIT_COMMITTER_EMAIL": "test@example.com",
+    "GIT_CONFIG_NOSYSTEM": "1",
+}
+
+
+@skipIf(shutil.which("git") is None, "git is not installed")
+class GitRepositoryTestCase(TestCase):
+    """Base class for tests which need a git repository in a temporary directory."""
+
+    def setUp(self) -> None:
+        self._directory = tempfile.TemporaryDirectory()
+        self.repo = os.path.join(self._directory.name, "repo")
+        os.mkdir(self.repo)
+        self._date = 1_600_000_000
+        self.git("init", "-q", "-b", "main")
+
+    def tearDown(self) -> None:
+        self._directory.cleanup()
+
+    def git(self, *args: str, cwd: Optional[str] = None) -> str:
+        self._date += 1
+        env = dict(os.environ, **_GIT_ENV)
+        env["GIT_AUTHOR_DATE"] = env["GIT_COMMITTER_DATE"] = f"{self._date} +0000"
+        return subprocess.check_output(
+            ["git", *args], cwd=cwd or self.repo, env=env, stderr=subprocess.DEVNULL
+        ).decode("ascii")
+
+    def commit(self, message: str = "commit") -> None:
+        self.git("commit", "-q", "--allow-empty", "-m", message)
+
+
+class ReadGitMetadataTestCase(GitRepositoryTestCase):
+    def assertMatchesCli(self, cwd: Optional[str] = None) -> GitMetadata:
+        """Checks that the reader agrees with the git CLI, if it gives an answer."""
+        cwd = cwd or self.repo
+        metadata = read_git_metadata(cwd)
+        self.assertIsNotNone(metadata)
+        assert metadata is not None
+        expected = _read_git_metadata_with_cli(cwd)
+        self.assertEqual(metadata[:3], expected[:3])
+        return metadata
+
+    def test_not_a_repository(self) -> None:
+        """Directories outside a repository have no metadata."""
+        self.assertEqual(
+            read_git_metadata(self._directory.name), GitMetadata("", "", "", False)
+        )
+
+    def test_unborn_branch(self) -> None:
+        """A repository without commits has no metadata."""
+        self.assertMatchesCli()
+
+    def test_branch(self) -> None:
+        """The branch and abbreviated commit are read from a fresh repository."""
+        self.commit()
+        self.git("checkout", "-q", "-b", "feature/thing")
+        self.commit()
+        metadata = self.assertMatchesCli()
+        self.assertEqual(metadata.branch, "feature/thing")
+        self.assertFalse(metadata.describable)
+
+    def test_subdirectory(self) -> None:
+        """The repository is found from a subdirectory of the work tree."""
+        self.commit()
+        subdirectory = os.path.join(self.repo, "a", "b")
+        os.makedirs(subdirectory)
+        self.assertMatchesCli(subdirectory)
+
+    def test_detached_head(self) -> None:
+        """A detached HEAD is reported as the branch "HEAD"."""
+        self.commit()
+        self.commit()
+        self.git("checkout", "-q", "HEAD~1")
+        metadata = self.assertMatchesCli()
+        self.assertEqual(metadata.branch, "HEAD")
+
+    def test_lightweight_tag(self) -> None:
+        """Lightweight tags are ignored, as by `git describe`."""
+        self.commit()
+        self.git("tag", "v1.0")
+        metadata = self.assertMatchesCli()
+        self.assertEqual(metadata.tag, "")
+
+    def test_annotated_tags(self) -> None:
+        """Annotated tags are found, both loose and packed."""
+        self.commit()
+        self.git("tag", "-a", "-m", "v1.0", "v1.0")
+        self.commit()
+        self.git("tag", "-a", "-m", "v1.1", "v1.1")
+        self.git("tag", "-a", "-m", "v1.1-again", "v1.1-again")
+        metadata = self.assertMatchesCli()
+        self.assertEqual(metadata.tag, "v1.1-again")
+        self.assertTrue(metadata.describable)
+
+        self.git("pack-refs", "--all")
+        self.assertMatchesCli()
+
+        self.git("gc", "-q")
+        self.assertMatchesCli()
+
+        self.git("checkout", "-q", "v1.0")
+        metadata = self.assertMatchesCli()
+        self.assertEqual(metadata.tag, "v1.0")
+
+    def test_untagged_commit(self) -> None:
+        """No tag is reported for a commit after a tag."""
+        self.commit()
+        self.git("tag", "-a", "-m", "v1.0", "v1.0")
+        self.commit()
+        metadata = self.assertMatchesCli()
+        self.assertEqual(metadata.tag, "")
+        self.assertTrue(metadata.describable)
+
+    def test_packed_objects(self) -> None:
+        """Abbreviated commits agree with git once objects are packed."""
+        for i in range(50):
+            self.commit(str(i))
+        self.git("gc", "-q")
+        self.commit()
+        self.assertMatchesCli()
+
+    def test_ambiguous_branch(self) -> None:
+        """A branch sharing its name with a tag is not reported differently."""
+        self.commit()
+        self.git("tag", "-a", "-m", "same", "same")
+        self.git("checkout", "-q", "-b", "same")
+        metadata = read_git_metadata(self.repo)
+        if metadata is not None:
+            self.assertEqual(metadata[:3], _read_git_metadata_with_cli(self.repo)[:3])
+
+    def test_worktree(self) -> None:
+        """Linked worktrees are read through their common directory."""
+        self.commit()
+        worktree = os.path.join(self._directory.name, "worktree")
+        self.git("worktree", "add", "-q", "-b", "other", worktree)
+        metadata = self.assertMatchesCli(worktree)
+        self.assertEqual(metadata.branch, "other")
+
+
+class CheckoutFingerprintTestCase(GitRepositoryTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        # Trust all timestamps, so that the tests need not wait.
+        patcher = patch("matrix_common._git._RACY_NS", 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.tracked = os.path.join(self.repo, "tracked")
+        with open(self.tracked, "w") as f:
+            f.write("content")
+        self.git("add", "tracked")
+        self.commit()
+
+    def fingerprint(self) -> str:
+        fingerprint = checkout_fingerprint(self.repo)
+        assert fingerprint is not None
+        self.assertFalse(fingerprint.racy)
+        return fingerprint.digest
+
+    def test_not_a_repository(self) -> None:
+        """Directories outside a repository have no fingerprint."""
+        self.assertIsNone(checkout_fingerprint(self._directory.name))
+
+    def test_stable(self) -> None:
+        """The fingerprint does not change if the checkout does not."""
+        self.assertEqual(self.fingerprint(), self.fingerprint())
+
+    def test_racy(self) -> None:
+        """Fingerprints of checkouts which just changed are racy."""
+        with patch("matrix_common._git._RACY_NS", 2_000_000_000):
+            fingerprint = checkout_fingerprint(self.repo)
+        assert fingerprint is not None
+        self.assertTrue(fingerprint.racy)
+
+    def test_untracked_files(self) -> None:
+        """Untracked files do not change the fingerprint."""
+        before = self.fingerprint()
+        with open(os.path.join(self.repo, "untracked"), "w") as f:
+            f.write("content")
+        self.assertEqual(before, self.fingerprint())
+
+    def test_changes(self) -> None:
+        """Commits, tags, branch switches and edits change the fingerprint."""
+        fingerprints = [self.fingerprint()]
+
+        self.commit()
+        fingerprints.append(self.fingerprint())
+
+        self.git("tag", "-a", "-m", "v1.0", "v1.0")
+        fingerprints.append(self.fingerprint())
+
+        self.git("checkout", "-q", "-b", "other")
+        fingerprints.append(self.fingerprint())
+
+        self.git("pack-refs", "--all")
+        fingerprints.append(self.fingerprint())
+
+        with open(self.tracked, "a") as f:
+            f.write(" and more")
+        fingerprints.append(self.fingerprint())
+
+        self.assertEqual(len(set(fingerprints)), len(fingerprints))
@@ -0,0 +1,116 @@
+# Copyright 2022 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import subprocess
+import sys
+from typing import Dict, FrozenSet, List
+from unittest import TestCase
+
+# Generous budgets for the cumulative import time of each module, in microseconds.
+# They are several times what the imports take today, so only catch large
+# regressions; `test_lazy_dependencies` catches the precise ones.
+IMPORT_TIME_BUDGETS_US: Dict[str, int] = {
+    "matrix_common": 75_000,
+    "matrix_common.regex": 100_000,
+    "matrix_common.types": 75_000,
+    "matrix_common.versionstring": 150_000,
+}
+
+# Modules which are slow to import, and must only be imported when used.
+LAZY_DEPENDENCIES: FrozenSet[str] = frozenset(
+    {
+        "asyncio",
+        "attr",
+        "concurrent.futures",
+        "hashlib",
+        "importlib.metadata",
+        "importlib_metadata",
+        "json",
+        "subprocess",
+        "tempfile",
+        "twisted",
+        "urllib.parse",
+    }
+)
+
+
+def _run_python(*args: str) -> "subprocess.CompletedProcess[str]":
+    env = dict(os.environ)
+    # Let the first run write bytecode, so that later runs do not measure compiling.
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    return subprocess.run(
+        [sys.executable, *args],
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+
+
+def _import_time_us(module: str) -> int:
+    """Returns the cumulative time `python -X importtime` reports for a module."""
+    stderr = _run_python("-X", "importtime", "-c", f"import {module}").stderr
+    for line in stderr.splitlines():
+        # Lines look like "import time:  self [us] | cumulative | imported package".
+        fields = line.split("|")
+        if len(fields) == 3 and fields[2].strip() == module:
+            return int(fields[1])
+    raise AssertionError(f"{module} not found in -X importtime output:\n{stderr}")
+
+
+def _modules_imported_by(statement: str) -> List[str]:
+    code = f"import sys; {statement}; print('\\n'.join(sys.modules))"
+    return _run_python("-c", code).stdout.split()
+
+
+class ImportTimeTestCase(TestCase):
+    def test_import_time_budget(self) -> None:
+        """Importing each module stays well within its time budget."""
+        for module, budget in IMPORT_TIME_BUDGETS_US.items():
+            # The fastest of a few runs is the least affected by noise.
+            fastest = min(_import_time_us(module) for _ in range(3))
+            self.assertLessEqual(
+                fastest, budget, f"Importing {module} took {fastest}us"
+            )
+
+    def test_lazy_dependencies(self) -> None:
+        """Slow dependencies are not imported until they are needed."""
+        for statement in (
+            "import matrix_common",
+            "import matrix_common.regex",
+            "import matrix_common.types",
+            "import matrix_common.versionstring",
+        ):
+            imported = LAZY_DEPENDENCIES.intersection(_modules_imported_by(statement))
+            self.assertEqual(imported, set(), f"{statement} imported {imported}")
+
+    def test_lazy_attributes(self) -> None:
+        """Submodules and classes are imported on first access."""
+        modules = _modules_imported_by(
+            "import matrix_common; matrix_common.types.MXCUri.from_str('mxc://a/b')"
+        )
+        self.assertIn("matrix_common.types.mxc_uri", modules)
+        self.assertIn("attr", modules)
+        self.assertNotIn("matrix_common.versionstring", modules)
+
+    def test_lazy_submodules(self) -> None:
+        """Submodules of `matrix_common.types` are imported on first access."""
+        for submodule in ("mxc_uri", "mxc_uri_set", "server_name"):
+            output = _run_python(
+                "-c",
+                "import matrix_common.types; "
+                f"print(matrix_common.types.{submodule}.__name__)",
+            ).stdout
+            self.assertEqual(output.strip(), f"matrix_common.types.{submodule}")
@@ -11,10 +11,38 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import itertools
+import random
 import re
+import string
+import sys
+import time
+from typing import Any, Dict, List, Optional, Tuple
 from unittest import TestCase
 
-from matrix_common.regex import glob_to_regex, to_word_pattern
+from matrix_common.regex import (
+    _UNFOLDABLE,
+    DEFAULT_GLOB_CACHE_SIZE,
+    DomainGlobSet,
+    GlobBackend,
+    GlobMatcher,
+    GlobSet,
+    KeyedConditionEvaluator,
+    MatchContext,
+    MatchInstrumentation,
+    SlowMatch,
+    clear_glob_cache,
+    glob_cache_info,
+    glob_match_indices,
+    glob_match_mask,
+    glob_scan,
+    glob_to_matcher,
+    glob_to_regex,
+    set_default_glob_backend,
+    set_glob_cache_size,
+    set_match_instrumentation,
+    to_word_pattern,
+)
 
 
 class GlobToRegexTestCase(TestCase):
@@ -100,3 +128,1002 @@ class WordPatternTestCase(TestCase):
             pattern,
             "Pattern should be able to end its match anywhere",
         )
+
+
+class GlobCacheTestCase(TestCase):
+    def setUp(self) -> None:
+        clear_glob_cache()
+
+    def tearDown(self) -> None:
+        set_glob_cache_size(DEFAULT_GLOB_CACHE_SIZE)
+        clear_glob_cache()
+
+    def test_cache_hit(self) -> None:
+        """Tests that compiling the same glob twice returns the cached pattern."""
+        pattern = glob_to_regex("*.example.com")
+        self.assertIs(glob_to_regex("*.example.com"), pattern)
+
+        info = glob_cache_info()
+        self.assertEqual(info.hits, 1)
+        self.assertEqual(info.misses, 1)
+        self.assertEqual(info.currsize, 1)
+
+    def test_cache_key(self) -> None:
+        """Tests that the matching options are part of the cache key."""
+        pattern = glob_to_regex("foo")
+        self.assertIsNot(glob_to_regex("foo", word_boundary=True), pattern)
+        self.assertIsNot(glob_to_regex("foo", ignore_case=False), pattern)
+        self.assertEqual(glob_cache_info().misses, 3)
+
+    def test_eviction(self) -> None:
+        """Tests that the least recently used pattern is evicted."""
+        set_glob_cache_size(2)
+        glob_to_regex("a")
+        glob_to_regex("b")
+        glob_to_regex("a")
+        glob_to_regex("c")
+
+        info = glob_cache_info()
+        self.assertEqual(info.evictions, 1)
+        self.assertEqual(info.currsize, 2)
+
+        # "b" was evicted, "a" was not.
+        glob_to_regex("a")
+        self.assertEqual(glob_cache_info().hits, 2)
+        glob_to_regex("b")
+        self.assertEqual(glob_cache_info().misses, 4)
+
+    def test_resize(self) -> None:
+        """Tests that shrinking the cache evicts entries and 0 disables it."""
+        for glob in ("a", "b", "c"):
+            glob_to_regex(glob)
+
+        set_glob_cache_size(1)
+        info = glob_cache_info()
+        self.assertEqual(info.maxsize, 1)
+        self.assertEqual(info.currsize, 1)
+        self.assertEqual(info.evictions, 2)
+
+        set_glob_cache_size(0)
+        glob_to_regex("d")
+        self.assertEqual(glob_cache_info().currsize, 0)
+
+        with self.assertRaises(ValueError):
+            set_glob_cache_size(-1)
+
+
+class GlobSetTestCase(TestCase):
+    GLOBS = ["*.example.com", "matrix.org", "spam*", "f?o", "*.org", "*"]
+
+    def test_matches(self) -> None:
+        """Tests that all matching globs are reported, in order."""
+        globs = GlobSet(self.GLOBS[:-1])
+        self.assertEqual(globs.matches("Matrix.org"), [1, 4])
+        self.assertEqual(globs.matches("a.example.com"), [0])
+        self.assertEqual(globs.matches("spam.org"), [2, 4])
+        self.assertEqual(globs.matches("example.net"), [])
+
+        self.assertEqual(globs.match_first("spam.org"), 2)
+        self.assertIsNone(globs.match_first("example.net"))
+        self.assertTrue(globs.match_any("foo"))
+        self.assertFalse(globs.match_any("fooo"))
+
+    def test_empty(self) -> None:
+        """Tests that an empty set matches nothing."""
+        globs = GlobSet([])
+        self.assertEqual(len(globs), 0)
+        self.assertFalse(globs.match_any(""))
+        self.assertEqual(globs.matches("foo"), [])
+
+    def test_ignore_case(self) -> None:
+        """Tests that case sensitivity is honoured."""
+        globs = GlobSet(["matrix.org"], ignore_case=False)
+        self.assertFalse(globs.match_any("Matrix.org"))
+        self.assertTrue(globs.match_any("matrix.org"))
+
+    def test_word_boundary_first_match(self) -> None:
+        """Tests that the lowest matching index is returned with word boundaries.
+
+        The leftmost match in the string belongs to the second glob here.
+        """
+        globs = GlobSet(["world", "hello"], word_boundary=True)
+        self.assertEqual(globs.match_first("hello world"), 0)
+        self.assertEqual(globs.matches("hello world"), [0, 1])
+        self.assertIsNone(globs.match_first("helloworld"))
+
+    def test_agrees_with_glob_to_regex(self) -> None:
+        """Tests that a GlobSet gives the same results as individual patterns."""
+        values = [
+            "",
+            "foo",
+            "FOO",
+            "a.example.com",
+            "example.com",
+            "matrix.org",
+            "spam",
+            "spam\n",
+            "spam and eggs",
+            "eat spam now",
+            "some.thing.org",
+        ]
+        for word_boundary in (False, True):
+            globs = GlobSet(self.GLOBS, word_boundary=word_boundary)
+            patterns = [
+                glob_to_regex(glob, word_boundary=word_boundary) for glob in self.GLOBS
+            ]
+            for value in values:
+                expected = [
+                    index
+                    for index, pattern in enumerate(patterns)
+                    if pattern.search(value)
+                ]
+                self.assertEqual(globs.matches(value), expected, value)
+                self.assertEqual(
+                    globs.match_first(value), expected[0] if expected else None
+                )
+
+    def test_random(self) -> None:
+        """Tests that every kind of glob agrees with the regex on random strings."""
+        rng = random.Random(0)
+        alphabet = "ab. \n\u212a\u017f"
+        for _ in range(300):
+            globs = [
+                "".join(rng.choices(alphabet + "**?", k=rng.randint(0, 4)))
+                # Large enough sets for both ways of matching without word boundaries.
+                for _ in range(rng.randint(1, 40))
+            ]
+            for word_boundary in (False, True):
+                for ignore_case in (False, True):
+                    glob_set = GlobSet(
+                        globs, word_boundary=word_boundary, ignore_case=ignore_case
+                    )
+                    patterns = [
+                        glob_to_regex(
+                            glob, word_boundary=word_boundary, ignore_case=ignore_case
+                        )
+                        for glob in globs
+                    ]
+                    for _ in range(10):
+                        value = "".join(
+                            rng.choices(alphabet + "AK", k=rng.randint(0, 6))
+                        )
+                        expected = [
+                            index
+                            for index, pattern in enumerate(patterns)
+                            if pattern.search(value)
+                        ]
+                        self.assertEqual(
+                            glob_set.matches(value),
+                            expected,
+                            (globs, value, word_boundary, ignore_case),
+                        )
+                        self.assertEqual(glob_set.match_any(value), bool(expected))
+
+
+class _RecordingEvent(Dict[str, Any]):
+    """An event which records the keys looked up in it."""
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.lookups: List[str] = []
+
+    def get(self, key: str, default: Optional[Any] = None) -> Any:
+        self.lookups.append(key)
+        return super().get(key, default)
+
+
+class KeyedConditionEvaluatorTestCase(TestCase):
+    RULES = [
+        [("type", "m.room.message"), ("content.body", "*@room*")],
+        [("type", "m.room.message"), ("content.body", "alice")],
+        [("type", "m.call.*")],
+        [("type", "m.room.message"), ("sender", "@bob:*")],
+        [],
+    ]
+
+    def test_evaluate(self) -> None:
+        """Tests that the first matching rule is returned."""
+        evaluator = KeyedConditionEvaluator(self.RULES[:-1])
+        self.assertEqual(len(evaluator), 4)
+        event = {"type": "m.room.message", "content.body": "Hi Alice!"}
+        self.assertEqual(evaluator.evaluate(event), 1)
+        self.assertEqual(evaluator.matching_rules(event), [1])
+
+        event["sender"] = "@bob:example.com"
+        self.assertEqual(evaluator.matching_rules(event), [1, 3])
+
+        self.assertEqual(evaluator.evaluate({"type": "m.call.invite"}), 2)
+        self.assertIsNone(evaluator.evaluate({"type": "m.room.member"}))
+
+    def test_empty_rule(self) -> None:
+        """Tests that a rule without conditions always matches."""
+        evaluator = KeyedConditionEvaluator(self.RULES)
+        self.assertEqual(evaluator.evaluate({}), 4)
+        self.assertIsNone(KeyedConditionEvaluator([]).evaluate({}))
+
+    def test_missing_and_non_string_values(self) -> None:
+        """Tests that conditions on missing keys or non-strings do not match."""
+        evaluator = KeyedConditionEvaluator([[("content.body", "*")], [("a", "1")]])
+        self.assertIsNone(evaluator.evaluate({}))
+        self.assertIsNone(evaluator.evaluate({"content.body": None, "a": 1}))
+
+    def test_word_boundary_keys(self) -> None:
+        """Tests that only the given keys match at word boundaries."""
+        rules = [[("content.body", "alice")], [("sender", "alice")]]
+        event = {"content.body": "hi alice", "sender": "hi alice"}
+        self.assertEqual(KeyedConditionEvaluator(rules).matching_rules(event), [0])
+        self.assertEqual(
+            KeyedConditionEvaluator(
+                rules, word_boundary_keys=["sender"]
+            ).matching_rules(event),
+            [1],
+        )
+        self.assertEqual(
+            KeyedConditionEvaluator(rules, ignore_case=False).matching_rules(
+                {"content.body": "hi Alice"}
+            ),
+            [],
+        )
+
+    def test_visits_keys_once(self) -> None:
+        """Tests that each key is looked up at most once, and only when needed."""
+        evaluator = KeyedConditionEvaluator(self.RULES)
+        event = _RecordingEvent(type="m.room.member", sender="@bob:example.com")
+        self.assertEqual(evaluator.evaluate(event), 4)
+        # Every rule fails on `type`, so neither `content.body` nor `sender` is needed.
+        self.assertEqual(event.lookups, ["type"])
+
+        event = _RecordingEvent(type="m.room.message", sender="@bob:example.com")
+        self.assertEqual(evaluator.matching_rules(event), [3, 4])
+        self.assertEqual(event.lookups, ["type", "content.body", "sender"])
+
+    def test_agrees_with_glob_to_regex(self) -> None:
+        """Tests that the evaluator agrees with matching each condition separately."""
+        rng = random.Random(0)
+        values = ["", "m.room.message", "m.call.invite", "hello @room", "Alice", "x"]
+        rules = [
+            [
+                (
+                    rng.choice(["type", "content.body"]),
+                    rng.choice(["*", "m.*", "al?ce"]),
+                )
+                for _ in range(rng.randint(0, 3))
+            ]
+            for _ in range(20)
+        ]
+        evaluator = KeyedConditionEvaluator(rules)
+        for _ in range(100):
+            event = {
+                key: rng.choice(values)
+                for key in ("type", "content.body")
+                if rng.random() < 0.8
+            }
+            expected = [
+                i
+                for i, rule in enumerate(rules)
+                if all(
+                    key in event
+                    and glob_to_regex(glob, word_boundary=key == "content.body").search(
+                        event[key]
+                    )
+                    for key, glob in rule
+                )
+            ]
+            self.assertEqual(evaluator.matching_rules(event), expected)
+
+
+class GlobMatcherTestCase(TestCase):
+    GLOBS = [
+        "",
+        "*",
+        "example.com",
+        "*.evil.org",
+        "spam*",
+        "**spam",
+        "sk*",
+        "f?o*baz",
+        "a*b*c",
+        "Straße",
+        "line\nbreak",
+    ]
+    VALUES = [
+        "",
+        "example.com",
+        "EXAMPLE.COM",
+        "example.co",
+        "a.b.evil.org",
+        ".evil.org",
+        "evil.org",
+        "a\n.evil.org",
+        "spam",
+        "Spam and eggs",
+        "spam\n",
+        "eggs spam",
+        "sky",
+        # U+212A KELVIN SIGN, which re.IGNORECASE treats as equal to "k".
+        "Ky",
+        # U+017F LATIN SMALL LETTER LONG S, which re.IGNORECASE treats as "s".
+        "ſpam",
+        "fxobarbaz",
+        "abc",
+        "STRASSE",
+        "straße",
+        "line\nbreak",
+        "LINE\nBREAK",
+    ]
+
+    def test_classification(self) -> None:
+        """Tests that simple globs avoid regular expressions."""
+        self.assertEqual(
+            type(glob_to_matcher("example.com")).__name__, "_LiteralMatcher"
+        )
+        self.assertEqual(type(glob_to_matcher("*.evil.org")).__name__, "_SuffixMatcher")
+        self.assertEqual(type(glob_to_matcher("spam**")).__name__, "_PrefixMatcher")
+        self.assertEqual(type(glob_to_matcher("a*b*c")).__name__, "_RegexMatcher")
+        self.assertEqual(type(glob_to_matcher("?spam")).__name__, "_RegexMatcher")
+        self.assertEqual(
+            type(glob_to_matcher("spam", word_boundary=True)).__name__,
+            "_WordLiteralMatcher",
+        )
+        for glob in ("spam*", "*spam", "**spam*"):
+            self.assertEqual(
+                type(glob_to_matcher(glob, word_boundary=True)).__name__,
+                "_WordAffixMatcher",
+            )
+        for glob in ("sp*am", "spam?", "*"):
+            self.assertEqual(
+                type(glob_to_matcher(glob, word_boundary=True)).__name__,
+                "_RegexMatcher",
+            )
+
+    def test_abstract(self) -> None:
+        """Tests that a matcher without a `match` method cannot be constructed."""
+
+        class IncompleteMatcher(GlobMatcher):
+            pass
+
+        with self.assertRaises(TypeError):
+            IncompleteMatcher(  # type: ignore[abstract]
+                "spam", word_boundary=False, ignore_case=True
+            )
+
+    def test_pattern(self) -> None:
+        """Tests that matchers expose the pattern from glob_to_regex."""
+        matcher = glob_to_matcher("*.evil.org", ignore_case=False)
+        self.assertIs(matcher.pattern, glob_to_regex("*.evil.org", ignore_case=False))
+
+    def test_agrees_with_glob_to_regex(self) -> None:
+        """Tests that every kind of matcher agrees with the regex."""
+        for glob in self.GLOBS:
+            for word_boundary in (False, True):
+                for ignore_case in (False, True):
+                    matcher = glob_to_matcher(
+                        glob, word_boundary=word_boundary, ignore_case=ignore_case
+                    )
+                    pattern = glob_to_regex(
+                        glob, word_boundary=word_boundary, ignore_case=ignore_case
+                    )
+                    for value in self.VALUES:
+                        self.assertEqual(
+                            matcher.match(value),
+                            pattern.search(value) is not None,
+                            (glob, value, word_boundary, ignore_case),
+                        )
+
+
+class LinearBackendTestCase(TestCase):
+    def tearDown(self) -> None:
+        set_default_glob_backend(GlobBackend.REGEX)
+
+    def _assert_agrees(
+        self, glob: str, value: str, word_boundary: bool, ignore_case: bool
+    ) -> None:
+        matcher = glob_to_matcher(
+            glob,
+            word_boundary=word_boundary,
+            ignore_case=ignore_case,
+            backend=GlobBackend.LINEAR,
+        )
+        pattern = glob_to_regex(
+            glob, word_boundary=word_boundary, ignore_case=ignore_case
+        )
+        self.assertEqual(
+            matcher.match(value),
+            pattern.search(value) is not None,
+            (glob, value, word_boundary, ignore_case),
+        )
+
+    def test_corpus(self) -> None:
+        """Tests that the linear backend agrees with the regex on a fixed corpus."""
+        globs = GlobMatcherTestCase.GLOBS + [
+            "f?o*baz",
+            "*a*a*b",
+            "?*?",
+            "foo bar",
+            "foo ",
+            " foo",
+            "*@*:example.com",
+            "é*",
+            "k?y",
+        ]
+        values = GlobMatcherTestCase.VALUES + [
+            "foo baré",
+            "baz foo bar baz",
+            "foo  ",
+            "xfoo bar",
+            "@alice:example.com",
+            "ÉCOLE",
+            "aaaaab",
+            "aaaaa\nb",
+        ]
+        for glob in globs:
+            for value in values:
+                for word_boundary in (False, True):
+                    for ignore_case in (False, True):
+                        self._assert_agrees(glob, value, word_boundary, ignore_case)
+
+    def test_random_corpus(self) -> None:
+        """Tests that the linear backend agrees with the regex on random inputs."""
+        rng = random.Random(1234)
+        for _ in range(2000):
+            glob = "".join(rng.choices("aAb ?*\n", k=rng.randint(0, 8)))
+            value = "".join(rng.choices("aAbB \n_.", k=rng.randint(0, 12)))
+            self._assert_agrees(
+                glob, value, rng.choice((False, True)), rng.choice((False, True))
+            )
+
+    def test_adversarial(self) -> None:
+        """Tests a glob which makes the regex backtrack heavily."""
+        value = "a" * 5000
+        for word_boundary in (False, True):
+            matcher = glob_to_matcher(
+                "*a*a*a*a*a*b",
+                word_boundary=word_boundary,
+                backend=GlobBackend.LINEAR,
+            )
+            self.assertFalse(matcher.match(value))
+            self.assertTrue(matcher.match(value + "b"))
+
+    def test_glob_set_adversarial(self) -> None:
+        """Tests that GlobSets match the adversarial glob in linear time."""
+        glob = "*a*a*a*a*a*b"
+        # The leading `b` gets past the check for the longest literal, and the
+        # non-ASCII character past the case folding.
+        values = ["b" + "a" * 5000, "ſb" + "a" * 5000]
+        set_default_glob_backend(GlobBackend.LINEAR)
+        start = time.perf_counter()
+        for word_boundary in (False, True):
+            for globs in ([glob], [glob] + [f"spam{i}*" for i in range(40)]):
+                glob_set = GlobSet(globs, word_boundary=word_boundary)
+                self.assertIs(glob_set.backend, GlobBackend.LINEAR)
+                for value in values:
+                    self.assertEqual(glob_set.matches(value), [])
+                    self.assertFalse(glob_set.match_any(value))
+                    self.assertEqual(glob_set.matches(value + "b"), [0])
+        self.assertLess(time.perf_counter() - start, 5)
+
+    def test_glob_set(self) -> None:
+        """Tests that GlobSets using the linear backend agree with the regex."""
+        globs = GlobSetTestCase.GLOBS + ["*a*a*b", "f?o*baz", "k?y", "*@*:example.com"]
+        values = GlobMatcherTestCase.VALUES + ["aaaaab", "aaaaa\nb", "Kay", "Ky"]
+        for word_boundary in (False, True):
+            for padding in (0, 40):
+                padded = globs + [f"spam{i}*" for i in range(padding)]
+                glob_set = GlobSet(
+                    padded, word_boundary=word_boundary, backend=GlobBackend.LINEAR
+                )
+                patterns = [
+                    glob_to_regex(glob, word_boundary=word_boundary) for glob in padded
+                ]
+                for value in values:
+                    expected = [
+                        index
+                        for index, pattern in enumerate(patterns)
+                        if pattern.search(value)
+                    ]
+                    self.assertEqual(glob_set.matches(value), expected, value)
+                    self.assertEqual(glob_set.match_any(value), bool(expected), value)
+
+    def test_evaluator_adversarial(self) -> None:
+        """Tests that evaluators match the adversarial glob in linear time."""
+        rules = [[("content.body", "*a*a*a*a*a*b")], [("sender", "*a*a*a*a*a*b")]]
+        events = [
+            {"content.body": "b" + "a" * 5000, "sender": "b" + "a" * 5000},
+            {"content.body": "aaaaab", "sender": "aaaaab"},
+        ]
+        start = time.perf_counter()
+        evaluator = KeyedConditionEvaluator(rules, backend=GlobBackend.LINEAR)
+        self.assertEqual(evaluator.matching_rules(events[0]), [])
+        self.assertEqual(evaluator.matching_rules(events[1]), [0, 1])
+
+        set_default_glob_backend(GlobBackend.LINEAR)
+        evaluator = KeyedConditionEvaluator(rules)
+        self.assertEqual(evaluator.matching_rules(events[0]), [])
+        self.assertLess(time.perf_counter() - start, 5)
+
+    def test_domain_glob_set_adversarial(self) -> None:
+        """Tests that DomainGlobSets match the adversarial glob in linear time."""
+        globs = ["matrix.org", "*.example.com", "*a*a*a*a*a*b"]
+        start = time.perf_counter()
+        domain_glob_set = DomainGlobSet(globs, backend=GlobBackend.LINEAR)
+        # The second string is matched by the fallback for non-ASCII strings.
+        for value in ["b" + "a" * 5000, "ſb" + "a" * 5000]:
+            self.assertEqual(domain_glob_set.matches(value), [])
+            self.assertEqual(domain_glob_set.matches(value + "b"), [2])
+        self.assertLess(time.perf_counter() - start, 5)
+
+    def test_default_backend(self) -> None:
+        """Tests that the backend can be selected globally."""
+        self.assertEqual(type(glob_to_matcher("a*b*c")).__name__, "_RegexMatcher")
+        set_default_glob_backend(GlobBackend.LINEAR)
+        self.assertEqual(type(glob_to_matcher("a*b*c")).__name__, "_LinearMatcher")
+        self.assertEqual(
+            type(glob_to_matcher("a*b*c", backend=GlobBackend.REGEX)).__name__,
+            "_RegexMatcher",
+        )
+        # Simple globs still take the string fast paths.
+        self.assertEqual(type(glob_to_matcher("spam*")).__name__, "_PrefixMatcher")
+
+
+class MatchContextTestCase(TestCase):
+    GLOBS = [
+        "cake",
+        "CAKE",
+        "cake lie",
+        "lie ",
+        " the",
+        "!",
+        "",
+        "caf?",
+        "ñ",
+        "Kelvin",
+        "cake*",
+        "*lie",
+        "*ak*",
+        "* lie",
+        "!*",
+        "c?ke*",
+        "*is*a*",
+        "ke?v*",
+    ]
+    TEXTS = [
+        "",
+        "The cake is a lie",
+        "the cake is a lie!",
+        "cakes are a lie",
+        "cupcake",
+        "cake_lie",
+        "cake lie cake",
+        "CAKE\nlie",
+        "café au lait",
+        "el niño",
+        # U+212A KELVIN SIGN, which re.IGNORECASE treats as equal to "k".
+        "Kelvin",
+        "the \u212aelvin cake",
+        "\u0130stanbul cake",
+        "caf\u0131 ca\u017fe",
+        "🎉 cake is a lie 🎉",
+        "café cakes lie",
+    ]
+
+    def test_agrees_with_glob_to_regex(self) -> None:
+        """Tests that matching a prepared text agrees with the regex."""
+        for text in self.TEXTS:
+            context = MatchContext(text)
+            for glob in self.GLOBS:
+                for ignore_case in (False, True):
+                    matcher = glob_to_matcher(
+                        glob, word_boundary=True, ignore_case=ignore_case
+                    )
+                    pattern = glob_to_regex(
+                        glob, word_boundary=True, ignore_case=ignore_case
+                    )
+                    self.assertEqual(
+                        matcher.match_context(context),
+                        pattern.search(text) is not None,
+                        (glob, text, ignore_case),
+                    )
+
+    def test_random(self) -> None:
+        """Tests that random globs agree with the regex on random texts."""
+        rng = random.Random(0)
+        alphabet = "ak \n!_é\u212a\u017f"
+        for _ in range(2000):
+            glob = "".join(rng.choices(alphabet + "*?", k=rng.randint(0, 5)))
+            text = "".join(rng.choices(alphabet + "AK", k=rng.randint(0, 10)))
+            for ignore_case in (False, True):
+                matcher = glob_to_matcher(
+                    glob, word_boundary=True, ignore_case=ignore_case
+                )
+                pattern = glob_to_regex(
+                    glob, word_boundary=True, ignore_case=ignore_case
+                )
+                self.assertEqual(
+                    matcher.match_context(MatchContext(text)),
+                    pattern.search(text) is not None,
+                    (glob, text, ignore_case),
+                )
+                self.assertEqual(
+                    matcher.match(text),
+                    pattern.search(text) is not None,
+                    (glob, text, ignore_case),
+                )
+
+                # The anchored matchers fold case in the same way.
+                matcher = glob_to_matcher(glob, ignore_case=ignore_case)
+                pattern = glob_to_regex(glob, ignore_case=ignore_case)
+                self.assertEqual(
+                    matcher.match(text),
+                    pattern.match(text) is not None,
+                    (glob, text, ignore_case),
+                )
+
+    def test_unfoldable_characters(self) -> None:
+        """Tests that `_UNFOLDABLE` lists every character which `str.lower` folds
+        differently from `re.IGNORECASE` when compared with ASCII."""
+        letters = [
+            re.compile(re.escape(c), re.IGNORECASE) for c in string.ascii_letters
+        ]
+        for codepoint in range(0x80, sys.maxunicode + 1):
+            char = chr(codepoint)
+            lowered = char.lower()
+            # Only cased characters can differ.
+            if lowered == char and char.upper() == char:
+                continue
+            unfoldable = (
+                len(lowered) != 1
+                or lowered.isascii()
+                or char.isalnum() != lowered.isalnum()
+                or any(letter.fullmatch(char) for letter in letters)
+            )
+            self.assertEqual(
+                _UNFOLDABLE.match(char) is not None, unfoldable, hex(codepoint)
+            )
+
+    def test_words(self) -> None:
+        """Tests that the text is split into words once, when first needed."""
+        context = MatchContext("The cake is a LIE!")
+        self.assertEqual(context.words, {"The", "cake", "is", "a", "LIE"})
+        self.assertEqual(context.lowered_words, {"the", "cake", "is", "a", "lie"})
+        self.assertIs(context.words, context.words)
+
+
+class GlobMatchManyTestCase(TestCase):
+    VALUES = ["matrix.org", "a.evil.org", "Evil.org", "example.com", "x.EVIL.ORG"]
+
+    def test_mask(self) -> None:
+        """Tests matching a glob against many strings."""
+        self.assertEqual(
+            list(glob_match_mask("*.evil.org", self.VALUES)),
+            [False, True, False, False, True],
+        )
+        self.assertEqual(
+            list(glob_match_mask("matrix.org", self.VALUES, ignore_case=False)),
+            [True, False, False, False, False],
+        )
+
+    def test_indices(self) -> None:
+        """Tests that the indices of matching strings are returned."""
+        self.assertEqual(list(glob_match_indices("*evil.org", self.VALUES)), [1, 2, 4])
+        self.assertEqual(list(glob_match_indices("nothing", self.VALUES)), [])
+
+    def test_matchers_and_sets(self) -> None:
+        """Tests that prepared matchers and GlobSets are accepted."""
+        globs = GlobSet(["matrix.org", "example.*"])
+        self.assertEqual(list(glob_match_indices(globs, self.VALUES)), [0, 3])
+
+        for backend in GlobBackend:
+            matcher = glob_to_matcher("?.*.org", backend=backend)
+            self.assertEqual(list(glob_match_indices(matcher, self.VALUES)), [1, 4])
+
+    def test_agrees_with_glob_to_regex(self) -> None:
+        """Tests that the batch fast paths agree with the regex."""
+        values = GlobMatcherTestCase.VALUES
+        for glob in GlobMatcherTestCase.GLOBS:
+            for word_boundary in (False, True):
+                for ignore_case in (False, True):
+                    pattern = glob_to_regex(
+                        glob, word_boundary=word_boundary, ignore_case=ignore_case
+                    )
+                    mask = glob_match_mask(
+                        glob,
+                        values,
+                        word_boundary=word_boundary,
+                        ignore_case=ignore_case,
+                    )
+                    self.assertEqual(
+                        list(mask),
+                        [pattern.search(value) is not None for value in values],
+                    )
+
+    def test_streaming(self) -> None:
+        """Tests that the strings are consumed lazily."""
+        values = (f"server{i}.example.com" for i in itertools.count())
+        indices = glob_match_indices("server?.example.com", values)
+        self.assertEqual(list(itertools.islice(indices, 3)), [0, 1, 2])
+
+
+class GlobScanTestCase(TestCase):
+    GLOBS = ["alice", "*outage*", "deploy*", "bug #*"]
+    VALUES = [
+        "Hi Alice",
+        "the deploy went fine",
+        "major OUTAGE today",
+        "see bug #12",
+        "nothing to see",
+        "",
+    ] * 10
+
+    def test_single_process(self) -> None:
+        """Tests that `workers=0` gives the same results as a `GlobSet`."""
+        glob_set = GlobSet(self.GLOBS, word_boundary=True)
+        self.assertEqual(
+            list(glob_scan(self.GLOBS, iter(self.VALUES), workers=0)),
+            [glob_set.matches(value) for value in self.VALUES],
+        )
+
+    def test_process_pool(self) -> None:
+        """Tests that a process pool gives the same results, in order."""
+        for word_boundary in (False, True):
+            expected = list(
+                glob_scan(
+                    self.GLOBS, self.VALUES, word_boundary=word_boundary, workers=0
+                )
+            )
+            results = glob_scan(
+                self.GLOBS,
+                iter(self.VALUES),
+                word_boundary=word_boundary,
+                workers=2,
+                chunk_size=7,
+            )
+            self.assertEqual(list(results), expected)
+
+    def test_linear_backend(self) -> None:
+        """Tests that the worker processes use the given backend."""
+        values = ["b" + "a" * 5000, "aaaaab"] * 3
+        start = time.perf_counter()
+        for workers in (0, 2):
+            results = glob_scan(
+                ["*a*a*a*a*a*b"],
+                values,
+                backend=GlobBackend.LINEAR,
+                workers=workers,
+                chunk_size=2,
+            )
+            self.assertEqual(list(results), [[], [0]] * 3)
+        self.assertLess(time.perf_counter() - start, 30)
+
+    def test_stop_early(self) -> None:
+        """Tests that the pool can be abandoned before all values are consumed."""
+        results = glob_scan(self.GLOBS, itertools.repeat("alice"), workers=1)
+        self.assertEqual(list(itertools.islice(results, 3)), [[0], [0], [0]])
+        results.close()  # type: ignore[attr-defined]
+
+    def test_invalid_arguments(self) -> None:
+        """Tests that invalid arguments are rejected immediately."""
+        with self.assertRaises(ValueError):
+            glob_scan(self.GLOBS, self.VALUES, workers=-1)
+        with self.assertRaises(ValueError):
+            glob_scan(self.GLOBS, self.VALUES, chunk_size=0)
+
+
+class DomainGlobSetTestCase(TestCase):
+    GLOBS = [
+        "matrix.org",
+        "*.example.com",
+        "*.*.badhost.net",
+        "*",
+        "*.org",
+        "evil*.org",
+        "192.168.*",
+        "?.example.com",
+        "",
+        "*example.com",
+    ]
+    SERVER_NAMES = [
+        "",
+        ".",
+        "matrix.org",
+        "MATRIX.org",
+        "matrix.org.",
+        "example.com",
+        ".example.com",
+        "a.example.com",
+        "a.b.example.com",
+        "badexample.com",
+        "badhost.net",
+        "a.badhost.net",
+        "a.b.badhost.net",
+        "..badhost.net",
+        "evil.org",
+        "evilcorp.org",
+        "192.168.1.1",
+        "a.example.com\n",
+        "a\n.example.com",
+        # U+212A KELVIN SIGN, which re.IGNORECASE treats as equal to "k".
+        "kelvin.org",
+        "Kelvin.org",
+    ]
+
+    def test_matches(self) -> None:
+        """Tests looking up server names."""
+        globs = DomainGlobSet(["matrix.org", "*.example.com", "*.*.badhost.net"])
+        self.assertEqual(globs.matches("Matrix.org"), [0])
+        self.assertEqual(globs.match_first("a.b.example.com"), 1)
+        self.assertTrue(globs.match_any("a.b.badhost.net"))
+        self.assertFalse(globs.match_any("a.badhost.net"))
+        self.assertFalse(globs.match_any("example.com"))
+
+    def test_agrees_with_glob_to_regex(self) -> None:
+        """Tests that the trie and the generic fallback agree with the regex."""
+        for ignore_case in (False, True):
+            globs = DomainGlobSet(self.GLOBS, ignore_case=ignore_case)
+            patterns = [
+                glob_to_regex(glob, ignore_case=ignore_case) for glob in self.GLOBS
+            ]
+            for server_name in self.SERVER_NAMES:
+                expected = [
+                    index
+                    for index, pattern in enumerate(patterns)
+                    if pattern.match(server_name)
+                ]
+                self.assertEqual(
+                    globs.matches(server_name), expected, (server_name, ignore_case)
+                )
+
+    def test_random_corpus(self) -> None:
+        """Tests random domain-shaped globs and server names against the regex."""
+        rng = random.Random(4321)
+        labels = ["a", "B", "b", "*", "**", "", "a?", "*a"]
+        names = ["a", "A", "b", "", "ab"]
+        for _ in range(200):
+            globs = [
+                ".".join(rng.choices(labels, k=rng.randint(1, 4))) for _ in range(10)
+            ]
+            ignore_case = rng.choice((False, True))
+            glob_set = DomainGlobSet(globs, ignore_case=ignore_case)
+            for _ in range(20):
+                server_name = ".".join(rng.choices(names, k=rng.randint(1, 5)))
+                expected = [
+                    index
+                    for index, glob in enumerate(globs)
+                    if glob_to_regex(glob, ignore_case=ignore_case).match(server_name)
+                ]
+                self.assertEqual(
+                    glob_set.matches(server_name), expected, (globs, server_name)
+                )
+
+
+class MatchInstrumentationTestCase(TestCase):
+    def setUp(self) -> None:
+        self.instrumentation = MatchInstrumentation(slow_threshold=0.05)
+        set_match_instrumentation(self.instrumentation)
+        self.addCleanup(set_match_instrumentation, None)
+
+    def test_disabled(self) -> None:
+        """Tests that matchers are not wrapped without instrumentation."""
+        set_match_instrumentation(None)
+        matcher = glob_to_matcher("a*")
+        self.assertNotIn("instrumented", repr(matcher))
+        matcher.match("abc")
+        self.assertEqual(self.instrumentation.stats(), {})
+
+    def test_stats(self) -> None:
+        """Tests that calls, matches and times are counted per glob."""
+        calls: List[Tuple[str, float, bool]] = []
+        self.instrumentation.on_match = lambda *args: calls.append(args)
+
+        matcher = glob_to_matcher("*.evil.org")
+        word_matcher = glob_to_matcher("alice", word_boundary=True)
+        self.assertTrue(matcher.match("a.evil.org"))
+        self.assertFalse(matcher.match("matrix.org"))
+        self.assertTrue(word_matcher.match_context(MatchContext("Hi Alice!")))
+        self.assertEqual(list(matcher.match_many(["b.evil.org"])), [True])
+
+        stats = self.instrumentation.stats()
+        self.assertEqual(stats.keys(), {"*.evil.org", "alice"})
+        self.assertEqual(stats["*.evil.org"][:2], (3, 2))
+        self.assertEqual(stats["alice"][:2], (1, 1))
+        self.assertGreaterEqual(
+            stats["*.evil.org"].total_seconds, stats["*.evil.org"].max_seconds
+        )
+        self.assertEqual(
+            [(glob, matched) for glob, _, matched in calls],
+            [
+                ("*.evil.org", True),
+                ("*.evil.org", False),
+                ("alice", True),
+                ("*.evil.org", True),
+            ],
+        )
+
+        self.instrumentation.reset()
+        self.assertEqual(self.instrumentation.stats(), {})
+
+    def test_slow_matches(self) -> None:
+        """Tests that matches over the threshold are kept and reported."""
+        glob_to_matcher("a").match("a")
+        self.assertEqual(list(self.instrumentation.slow_matches), [])
+
+        # Every match takes longer than a negative threshold.
+        slow_matches: List[SlowMatch] = []
+        instrumentation = MatchInstrumentation(
+            slow_threshold=-1, max_slow_matches=2, on_slow_match=slow_matches.append
+        )
+        set_match_instrumentation(instrumentation)
+        matcher = glob_to_matcher("*.org")
+        for value in ("a.org", "bb.org", "matrix.com"):
+            matcher.match(value)
+
+        self.assertEqual(
+            [(m.glob, m.length, m.matched) for m in slow_matches],
+            [("*.org", 5, True), ("*.org", 6, True), ("*.org", 10, False)],
+        )
+        self.assertEqual(list(instrumentation.slow_matches), slow_matches[1:])
+
+    def test_same_results(self) -> None:
+        """Tests that instrumented matchers agree with the regex."""
+        values = GlobMatcherTestCase.VALUES
+        for glob in GlobMatcherTestCase.GLOBS:
+            for word_boundary in (False, True):
+                matcher = glob_to_matcher(glob, word_boundary=word_boundary)
+                pattern = glob_to_regex(glob, word_boundary=word_boundary)
+                self.assertEqual(
+                    list(matcher.match_many(values)),
+                    [pattern.search(value) is not None for value in values],
+                )
+
+    def test_glob_set(self) -> None:
+        """Tests that instrumented GlobSets time each glob and agree with the regex."""
+        values = ["", "foo", "matrix.org", "spam and eggs", "a.example.com", "ſpam"]
+        for word_boundary in (False, True):
+            self.instrumentation.reset()
+            globs = GlobSet(GlobSetTestCase.GLOBS, word_boundary=word_boundary)
+            patterns = [
+                glob_to_regex(glob, word_boundary=word_boundary)
+                for glob in GlobSetTestCase.GLOBS
+            ]
+            for value in values:
+                expected = [
+                    index
+                    for index, pattern in enumerate(patterns)
+                    if pattern.search(value)
+                ]
+                self.assertEqual(globs.matches(value), expected, value)
+                self.assertEqual(globs.match_any(value), bool(expected), value)
+
+            stats = self.instrumentation.stats()
+            self.assertEqual(stats.keys(), set(GlobSetTestCase.GLOBS))
+            self.assertEqual({s.calls for s in stats.values()}, {2 * len(values)})
+
+    def test_evaluator(self) -> None:
+        """Tests that an evaluator reports its globs to the given instrumentation."""
+        set_match_instrumentation(None)
+        instrumentation = MatchInstrumentation()
+        evaluator = KeyedConditionEvaluator(
+            KeyedConditionEvaluatorTestCase.RULES, instrumentation=instrumentation
+        )
+        event = {"type": "m.room.message", "content.body": "Hi Alice!"}
+        self.assertEqual(evaluator.evaluate(event), 1)
+
+        # Only the keys the rules needed were matched.
+        stats = instrumentation.stats()
+        self.assertEqual(
+            {glob: s[:2] for glob, s in stats.items()},
+            {
+                "m.room.message": (1, 1),
+                "m.call.*": (1, 0),
+                "*@room*": (1, 0),
+                "alice": (1, 1),
+            },
+        )
+        self.assertEqual(self.instrumentation.stats(), {})
+
+    def test_glob_set_disabled(self) -> None:
+        """Tests that GlobSets built without instrumentation do not report to it."""
+        set_match_instrumentation(None)
+        globs = GlobSet(GlobSetTestCase.GLOBS)
+        set_match_instrumentation(self.instrumentation)
+        self.assertEqual(globs.matches("matrix.org"), [1, 4, 5])
+        self.assertEqual(self.instrumentation.stats(), {})
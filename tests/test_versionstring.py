@@ -11,9 +11,29 @@
 #  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
+import asyncio
+import json
+import os
+import tempfile
+import threading
+from typing import Optional
 from unittest import TestCase
+from unittest.mock import patch
 
-from matrix_common.versionstring import get_distribution_version_string
+import aiounittest
+from twisted.internet import defer, reactor
+from twisted.trial import unittest as trial
+
+from matrix_common.versionstring import (
+    VERSION_CACHE_DIR_ENV,
+    get_distribution_version_string,
+    get_distribution_version_string_async,
+    stamp_distribution_version_string,
+)
+from tests.test_git import GitRepositoryTestCase
+
+# The version string, bypassing the in-memory cache.
+_get_version_string = get_distribution_version_string.__wrapped__
 
 
 class TestVersionString(TestCase):
@@ -25,3 +45,172 @@ class TestVersionString(TestCase):
         version = get_distribution_version_string("matrix-common")
         self.assertIsInstance(version, str)
         self.assertTrue(version)
+
+
+class VersionStringCacheTestCase(GitRepositoryTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        for name in (
+            "matrix_common._git._RACY_NS",
+            "matrix_common.versionstring._RACY_NS",
+        ):
+            patcher = patch(name, 0)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.cache_dir = os.path.join(self._directory.name, "cache")
+        # `cwd` may be a file in the checkout.
+        self.cwd = os.path.join(self.repo, "tracked")
+        with open(self.cwd, "w") as f:
+            f.write("content")
+        self.git("add", "tracked")
+        self.commit()
+        self.git("tag", "-a", "-m", "v1.0", "v1.0")
+
+    def get(self) -> str:
+        return _get_version_string("matrix-common", self.cwd, self.cache_dir)
+
+    def tamper(self) -> None:
+        """Replaces the cached version string, to tell when it is used."""
+        (filename,) = os.listdir(self.cache_dir)
+        path = os.path.join(self.cache_dir, filename)
+        with open(path) as f:
+            entry = json.load(f)
+        entry["version_string"] = "tampered"
+        with open(path, "w") as f:
+            json.dump(entry, f)
+
+    def test_cache(self) -> None:
+        """Version strings are cached on disk, and identical to uncached ones."""
+        expected = _get_version_string("matrix-common", self.cwd)
+        self.assertIn("t=v1.0", expected)
+        self.assertEqual(self.get(), expected)
+        self.tamper()
+        self.assertEqual(self.get(), "tampered")
+
+    def test_environment_variable(self) -> None:
+        """The cache is enabled by the environment variable."""
+        self.get()
+        self.tamper()
+        with patch.dict(os.environ, {VERSION_CACHE_DIR_ENV: self.cache_dir}):
+            self.assertEqual(_get_version_string("matrix-common", self.cwd), "tampered")
+
+    def test_invalidation(self) -> None:
+        """The cache is invalidated when the checkout changes."""
+        self.get()
+        self.tamper()
+
+        self.commit()
+        self.assertEqual(self.get(), _get_version_string("matrix-common", self.cwd))
+        self.assertNotIn("t=v1.0", self.get())
+
+        self.git("checkout", "-q", "v1.0")
+        self.assertIn("t=v1.0", self.get())
+        self.assertNotIn("dirty", self.get())
+
+        with open(self.cwd, "a") as f:
+            f.write(" and more")
+        self.assertIn("dirty", self.get())
+
+    def test_racy(self) -> None:
+        """Version strings are not cached while the checkout is changing."""
+        with patch("matrix_common._git._RACY_NS", 2_000_000_000):
+            self.get()
+        self.assertFalse(os.path.exists(self.cache_dir))
+
+    def test_stamp(self) -> None:
+        """Stamped version strings are read back until the checkout changes."""
+        version_string = stamp_distribution_version_string(
+            "matrix-common", self.cwd, self.cache_dir
+        )
+        self.assertEqual(version_string, _get_version_string("matrix-common", self.cwd))
+        self.tamper()
+        self.assertEqual(self.get(), "tampered")
+
+        # Stamping recalculates the version string.
+        stamp_distribution_version_string("matrix-common", self.cwd, self.cache_dir)
+        self.assertEqual(self.get(), version_string)
+
+    def test_stamp_needs_cache_dir(self) -> None:
+        """Stamping fails without a cache directory."""
+        with patch.dict(os.environ, clear=True):
+            with self.assertRaises(ValueError):
+                stamp_distribution_version_string("matrix-common", self.cwd)
+
+    def test_unwritable_cache_dir(self) -> None:
+        """Failing to write to the cache is not an error."""
+        with tempfile.NamedTemporaryFile() as f:
+            self.assertEqual(
+                _get_version_string("matrix-common", self.cwd, f.name),
+                _get_version_string("matrix-common", self.cwd),
+            )
+
+
+class _BlockingVersionString:
+    """Stands in for `get_distribution_version_string`, blocking until `event` is set.
+
+    Setting `event` from the event loop only works if the version string is not
+    calculated on the event loop's thread.
+    """
+
+    def __init__(self) -> None:
+        self.event = threading.Event()
+
+    def __call__(
+        self,
+        distribution_name: str,
+        cwd: Optional[str] = None,
+        cache_dir: Optional[str] = None,
+    ) -> str:
+        if not self.event.wait(5):
+            return "blocked the event loop"
+        return get_distribution_version_string(distribution_name, cwd, cache_dir)
+
+
+class AsyncioVersionStringTestCase(aiounittest.AsyncTestCase):
+    async def test_same_result(self) -> None:
+        """The async version string is the same as the synchronous one."""
+        self.assertEqual(
+            await get_distribution_version_string_async("matrix-common"),
+            get_distribution_version_string("matrix-common"),
+        )
+
+    async def test_does_not_block(self) -> None:
+        """The version string is calculated off the event loop."""
+        blocking = _BlockingVersionString()
+        with patch(
+            "matrix_common.versionstring.get_distribution_version_string", blocking
+        ):
+            asyncio.get_running_loop().call_soon(blocking.event.set)
+            version = await get_distribution_version_string_async("matrix-common")
+        self.assertEqual(version, get_distribution_version_string("matrix-common"))
+
+
+class TwistedVersionStringTestCase(trial.TestCase):
+    def test_same_result(self) -> "defer.Deferred[None]":
+        """The async version string is the same as the synchronous one."""
+
+        async def test() -> None:
+            version = await get_distribution_version_string_async("matrix-common")
+            self.assertEqual(  # type: ignore[no-untyped-call]
+                version, get_distribution_version_string("matrix-common")
+            )
+
+        return defer.ensureDeferred(test())
+
+    def test_does_not_block(self) -> "defer.Deferred[None]":
+        """The version string is calculated off the reactor thread."""
+        blocking = _BlockingVersionString()
+
+        async def test() -> None:
+            with patch(
+                "matrix_common.versionstring.get_distribution_version_string", blocking
+            ):
+                # zope.interface methods confuse mypy about `self`.
+                reactor.callLater(0, blocking.event.set)  # type: ignore
+                version = await get_distribution_version_string_async("matrix-common")
+            self.assertEqual(  # type: ignore[no-untyped-call]
+                version, get_distribution_version_string("matrix-common")
+            )
+
+        return defer.ensureDeferred(test())
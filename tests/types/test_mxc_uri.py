@@ -11,9 +11,23 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import io
+import random
+import sys
+from typing import List
 from unittest import TestCase
 
-from matrix_common.types.mxc_uri import MXCUri
+from matrix_common.types.mxc_uri import (
+    MXCUri,
+    MXCUriParseError,
+    _interned,
+    _parse_with_urlparse,
+    clear_mxc_uri_parse_cache,
+    mxc_uri_parse_cache_info,
+    parse_many,
+    set_mxc_uri_interning,
+    set_mxc_uri_parse_cache_size,
+)
 
 
 class MXCUriTestCase(TestCase):
@@ -95,3 +109,220 @@ class MXCUriTestCase(TestCase):
 
         with self.assertRaises(ValueError):
             MXCUri.from_str(None)  # type: ignore
+
+    def test_agrees_with_urlparse(self) -> None:
+        """Tests that from_str accepts and rejects the same strings as urlparse."""
+        corpus = [
+            "mxc://example.com/abcdef",
+            "MXC://example.com/abcdef",
+            "mxc://user@example.com:8448/abc%20def",
+            "mxc://example.com/abc;def",
+            "mxc://example.com/abc?def",
+            "mxc://example.com/abc#def",
+            "mxc://example.com/abc def",
+            " mxc://example.com/abcdef",
+            "mxc://example.com/abcdef\n",
+            "mxc://exam\tple.com/abc\rdef",
+            "mxc://[::1]/abcdef",
+            "mxc://[::1/abcdef",
+            "mxc://example.com]/abcdef",
+            "mxc://ex\u00e4mple.com/abcdef",
+            "mxc://example.com/\u00e4bcdef",
+            "mxc://example.com/abc\\def",
+            "mxc:/example.com/abcdef",
+            "mxc:example.com/abcdef",
+        ]
+        rng = random.Random(8008)
+        for _ in range(5000):
+            corpus.append(
+                "mxc://"
+                + "".join(rng.choices("a:/?#;[]@% \t\n\u00e4.", k=rng.randint(0, 10)))
+            )
+
+        for mxc_uri_str in corpus:
+            try:
+                expected = _parse_with_urlparse(mxc_uri_str)
+            except ValueError as e:
+                with self.assertRaises(ValueError) as cm:
+                    MXCUri.from_str(mxc_uri_str)
+                self.assertEqual(str(cm.exception), str(e))
+            else:
+                mxc_uri = MXCUri.from_str(mxc_uri_str)
+                self.assertEqual(
+                    (mxc_uri.server_name, mxc_uri.media_id), expected, mxc_uri_str
+                )
+
+
+class MXCUriCacheTestCase(TestCase):
+    def tearDown(self) -> None:
+        set_mxc_uri_parse_cache_size(0)
+        set_mxc_uri_interning(False)
+        clear_mxc_uri_parse_cache()
+
+    def test_parse_cache(self) -> None:
+        """Tests that parsed URIs are cached once the cache is enabled."""
+        uri = "mxc://example.com/abcdef"
+        self.assertIsNot(MXCUri.from_str(uri), MXCUri.from_str(uri))
+        self.assertEqual(mxc_uri_parse_cache_info().currsize, 0)
+
+        set_mxc_uri_parse_cache_size(2)
+        mxc_uri = MXCUri.from_str(uri)
+        self.assertIs(MXCUri.from_str(uri), mxc_uri)
+        MXCUri.from_str("mxc://example.com/1")
+        MXCUri.from_str("mxc://example.com/2")
+
+        info = mxc_uri_parse_cache_info()
+        self.assertEqual(info.hits, 1)
+        self.assertEqual(info.misses, 3)
+        self.assertEqual(info.evictions, 1)
+        self.assertEqual(info.currsize, 2)
+
+        # Invalid URIs are not cached.
+        with self.assertRaises(ValueError):
+            MXCUri.from_str("mxc://example.com/")
+        self.assertEqual(mxc_uri_parse_cache_info().currsize, 2)
+
+    def test_parse_cache_subclass(self) -> None:
+        """Tests that subclasses do not receive cached instances of other classes."""
+
+        class SubMXCUri(MXCUri):
+            pass
+
+        set_mxc_uri_parse_cache_size(10)
+        uri = "mxc://example.com/abcdef"
+        MXCUri.from_str(uri)
+        self.assertIsInstance(SubMXCUri.from_str(uri), SubMXCUri)
+
+    def test_intern(self) -> None:
+        """Tests that equal URIs intern to a single instance."""
+        server_name = "".join(["example", ".com"])
+        mxc_uri = MXCUri(server_name, "abcdef").intern()
+        self.assertIs(mxc_uri.server_name, sys.intern("example.com"))
+        self.assertIs(MXCUri("example.com", "abcdef").intern(), mxc_uri)
+
+    def test_intern_key(self) -> None:
+        """Tests that interned URIs do not keep copies of their server name alive."""
+        # Distinct copies of an already interned server name.
+        interned = sys.intern("".join(["intern-key", ".example"]))
+        server_names = ["".join(["intern-key", ".example"]) for _ in range(3)]
+        mxc_uris = [
+            MXCUri(server_name, "abcdef").intern() for server_name in server_names
+        ]
+        self.assertIs(mxc_uris[1], mxc_uris[0])
+        self.assertIs(mxc_uris[0].server_name, interned)
+
+        keys = [key for key in _interned.keys() if key[1] == interned]
+        self.assertEqual(len(keys), 1)
+        self.assertIs(keys[0][1], interned)
+
+    def test_interning_mode(self) -> None:
+        """Tests that from_str returns interned instances when asked to."""
+        uri = "mxc://example.com/abcdef"
+        set_mxc_uri_interning(True)
+        mxc_uri = MXCUri.from_str(uri)
+        self.assertIs(MXCUri.from_str(uri), mxc_uri)
+        self.assertIs(MXCUri("example.com", "abcdef").intern(), mxc_uri)
+
+        set_mxc_uri_interning(False)
+        self.assertIsNot(MXCUri.from_str(uri), mxc_uri)
+
+
+class ParseManyTestCase(TestCase):
+    LINES = [
+        "mxc://example.com/abcdef\n",
+        "mxc://example.com/\n",
+        "MXC://example.com/ghijkl\r\n",
+        "http://example.com/abcdef",
+        "mxc://[::1]/mnopqr",
+    ]
+
+    def test_yield_errors(self) -> None:
+        """Tests that invalid entries are yielded in place, with their position."""
+        results = list(parse_many(self.LINES))
+        self.assertEqual(
+            results,
+            [
+                MXCUri("example.com", "abcdef"),
+                MXCUriParseError(
+                    1,
+                    "mxc://example.com/",
+                    "Found invalid structure when parsing MXC Uri: mxc://example.com/",
+                ),
+                MXCUri("example.com", "ghijkl"),
+                MXCUriParseError(
+                    3,
+                    "http://example.com/abcdef",
+                    "Found invalid structure when parsing MXC Uri: "
+                    "http://example.com/abcdef",
+                ),
+                MXCUri("[::1]", "mnopqr"),
+            ],
+        )
+
+    def test_collect_errors(self) -> None:
+        """Tests that invalid entries can be collected separately."""
+        errors: List[MXCUriParseError] = []
+        results = list(parse_many(self.LINES, errors=errors))
+        self.assertEqual(len(results), 3)
+        self.assertTrue(all(isinstance(result, MXCUri) for result in results))
+        self.assertEqual([error.index for error in errors], [1, 3])
+
+    def test_file(self) -> None:
+        """Tests parsing the lines of a file lazily."""
+        f = io.StringIO("".join(self.LINES))
+        results = parse_many(f)
+        self.assertEqual(next(results), MXCUri("example.com", "abcdef"))
+        self.assertEqual(f.tell(), len(self.LINES[0]))
+
+    def test_interning(self) -> None:
+        """Tests that parse_many honours the interning mode."""
+        set_mxc_uri_interning(True)
+        try:
+            first, second = parse_many(["mxc://a/b", "mxc://a/b"])
+        finally:
+            set_mxc_uri_interning(False)
+        self.assertIs(first, second)
+
+
+class MXCUriBytesTestCase(TestCase):
+    def test_from_bytes(self) -> None:
+        """Tests parsing bytes and memoryviews."""
+        self.assertEqual(
+            MXCUri.from_bytes(b"mxc://example.com/abcdef"),
+            MXCUri("example.com", "abcdef"),
+        )
+
+        buffer = memoryview(b"GET mxc://[::1]:8448/abcdef HTTP/1.1")
+        self.assertEqual(
+            MXCUri.from_bytes(buffer[4:-9]), MXCUri("[::1]:8448", "abcdef")
+        )
+
+        with self.assertRaises(ValueError):
+            MXCUri.from_bytes(b"mxc://example.com/\xff")
+
+    def test_to_bytes(self) -> None:
+        """Tests converting an MXCUri to bytes."""
+        mxc_uri = MXCUri("ex\u00e4mple.com", "abcdef")
+        self.assertEqual(bytes(mxc_uri), "mxc://ex\u00e4mple.com/abcdef".encode())
+        self.assertEqual(MXCUri.from_bytes(bytes(mxc_uri)), mxc_uri)
+
+    def test_agrees_with_from_str(self) -> None:
+        """Tests that from_bytes follows the same rules as from_str."""
+        rng = random.Random(8448)
+        corpus = [
+            "mxc://"
+            + "".join(rng.choices("a:/?#;[]@% \t\n\u00e4.", k=rng.randint(0, 10)))
+            for _ in range(5000)
+        ]
+        for mxc_uri_str in corpus:
+            try:
+                expected = MXCUri.from_str(mxc_uri_str)
+            except ValueError as e:
+                with self.assertRaises(ValueError) as cm:
+                    MXCUri.from_bytes(mxc_uri_str.encode("utf-8"))
+                self.assertEqual(str(cm.exception), str(e))
+            else:
+                self.assertEqual(
+                    MXCUri.from_bytes(memoryview(mxc_uri_str.encode("utf-8"))),
+                    expected,
+                )
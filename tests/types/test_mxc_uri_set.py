@@ -0,0 +1,113 @@
+# Copyright 2022 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import random
+from typing import Set
+from unittest import TestCase
+
+from matrix_common.types import MXCUri, MXCUriSet
+
+
+def _random_uris(rng: random.Random, count: int) -> Set[MXCUri]:
+    return {
+        MXCUri(
+            rng.choice(["matrix.org", "example.com", "[::1]:8448"]),
+            "".join(rng.choices("abcABä\U0001f600", k=rng.randint(1, 3))),
+        )
+        for _ in range(count)
+    }
+
+
+class MXCUriSetTestCase(TestCase):
+    def test_basics(self) -> None:
+        """Tests membership, length and iteration."""
+        uris = {
+            MXCUri("matrix.org", "abc"),
+            MXCUri("matrix.org", "def"),
+            MXCUri("example.com", "abc"),
+        }
+        mxc_uri_set = MXCUriSet(list(uris) + [MXCUri("matrix.org", "abc")])
+
+        self.assertEqual(len(mxc_uri_set), 3)
+        self.assertEqual(set(mxc_uri_set), uris)
+        self.assertIn(MXCUri("example.com", "abc"), mxc_uri_set)
+        self.assertNotIn(MXCUri("example.com", "def"), mxc_uri_set)
+        self.assertNotIn(MXCUri("example.org", "abc"), mxc_uri_set)
+        self.assertNotIn("mxc://example.com/abc", mxc_uri_set)
+
+    def test_per_server(self) -> None:
+        """Tests grouping by server."""
+        mxc_uri_set = MXCUriSet(
+            [
+                MXCUri("matrix.org", "def"),
+                MXCUri("example.com", "abc"),
+                MXCUri("matrix.org", "abc"),
+            ]
+        )
+        self.assertEqual(
+            sorted(mxc_uri_set.server_names()), ["example.com", "matrix.org"]
+        )
+        self.assertEqual(list(mxc_uri_set.media_ids("matrix.org")), ["abc", "def"])
+        self.assertEqual(
+            list(mxc_uri_set.iter_server("example.com")),
+            [MXCUri("example.com", "abc")],
+        )
+        self.assertEqual(mxc_uri_set.count("matrix.org"), 2)
+        self.assertEqual(mxc_uri_set.count("example.org"), 0)
+        self.assertEqual(list(mxc_uri_set.media_ids("example.org")), [])
+
+    def test_set_operations(self) -> None:
+        """Tests that set operations agree with those of `set`."""
+        rng = random.Random(1337)
+        for _ in range(50):
+            left = _random_uris(rng, rng.randint(0, 30))
+            right = _random_uris(rng, rng.randint(0, 30))
+            left_set = MXCUriSet(left)
+            right_set = MXCUriSet(right)
+
+            self.assertEqual(set(left_set | right_set), left | right)
+            self.assertEqual(set(left_set & right_set), left & right)
+            self.assertEqual(set(left_set - right_set), left - right)
+            self.assertEqual(left_set | right_set, MXCUriSet(left | right))
+            self.assertEqual(left_set == right_set, left == right)
+            if left == right:
+                self.assertEqual(hash(left_set), hash(right_set))
+            for mxc_uri in left | right:
+                self.assertEqual(mxc_uri in left_set, mxc_uri in left)
+
+    def test_difference_of_large_set(self) -> None:
+        """Tests the binary search path of difference."""
+        referenced = MXCUriSet(MXCUri("matrix.org", str(i)) for i in range(1000))
+        stored = MXCUriSet(
+            [MXCUri("matrix.org", "5"), MXCUri("matrix.org", "unreferenced")]
+        )
+        self.assertEqual(
+            list(stored - referenced), [MXCUri("matrix.org", "unreferenced")]
+        )
+
+    def test_hash(self) -> None:
+        """Tests that equal sets hash equally, so that they can be used as keys."""
+        uris = [
+            MXCUri("matrix.org", "abc"),
+            MXCUri("example.com", "abc"),
+            MXCUri("matrix.org", "def"),
+        ]
+        mxc_uri_set = MXCUriSet(uris)
+        # The servers are added in the opposite order.
+        reordered = MXCUriSet(reversed(uris))
+        self.assertEqual(mxc_uri_set, reordered)
+        self.assertEqual(hash(mxc_uri_set), hash(reordered))
+        self.assertEqual(hash(MXCUriSet()), hash(MXCUriSet([]) - mxc_uri_set))
+
+        self.assertEqual({mxc_uri_set: 1}[reordered], 1)
+        self.assertEqual(len({mxc_uri_set, reordered, MXCUriSet(uris[:2])}), 2)
@@ -0,0 +1,152 @@
+# Copyright 2022 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import sys
+from unittest import TestCase
+
+from matrix_common.types import MXCUri, ServerName, ServerNameKind
+from matrix_common.types.server_name import (
+    DEFAULT_SERVER_NAME_PARSE_CACHE_SIZE,
+    _interned,
+    clear_server_name_parse_cache,
+    server_name_parse_cache_info,
+    set_server_name_interning,
+    set_server_name_parse_cache_size,
+)
+
+
+class ServerNameTestCase(TestCase):
+    def test_valid_server_names(self) -> None:
+        """Tests that valid server names are split into their host and port."""
+        cases = [
+            ("matrix.org", "matrix.org", None, ServerNameKind.DNS),
+            ("localhost:8448", "localhost", 8448, ServerNameKind.DNS),
+            ("1.2.3.4", "1.2.3.4", None, ServerNameKind.IPV4),
+            ("1.2.3.4:1234", "1.2.3.4", 1234, ServerNameKind.IPV4),
+            ("[::1]", "[::1]", None, ServerNameKind.IPV6),
+            ("[1234:5678::abcd]:443", "[1234:5678::abcd]", 443, ServerNameKind.IPV6),
+            # Not an IPv4 address, but a valid DNS name.
+            ("1.2.3.4.5", "1.2.3.4.5", None, ServerNameKind.DNS),
+            ("a-b.example", "a-b.example", None, ServerNameKind.DNS),
+        ]
+        for value, host, port, kind in cases:
+            server_name = ServerName.from_str(value)
+            self.assertEqual(server_name, ServerName(host, port, kind), value)
+            self.assertEqual(str(server_name), value)
+
+    def test_invalid_server_names(self) -> None:
+        """Tests that invalid server names are rejected."""
+        for value in [
+            "",
+            ":8448",
+            "matrix.org:",
+            "matrix.org:123456",
+            "matrix.org:http",
+            "user@matrix.org",
+            "matrix.org/path",
+            "::1",
+            "[::1",
+            "[example.com]",
+            "ex ample.com",
+            "exämple.com",
+            "matrix.org\n",
+            "a" * 256,
+        ]:
+            with self.assertRaises(ValueError, msg=value):
+                ServerName.from_str(value)
+
+        with self.assertRaises(ValueError):
+            ServerName.from_str(b"matrix.org")  # type: ignore[arg-type]
+
+    def test_mxc_uri(self) -> None:
+        """Tests that MXC URIs expose their parsed server names."""
+        mxc_uri = MXCUri.from_str("mxc://[::1]:8008/abcdef")
+        self.assertEqual(
+            mxc_uri.parsed_server_name,
+            ServerName("[::1]", 8008, ServerNameKind.IPV6),
+        )
+        self.assertIs(mxc_uri.parsed_server_name, mxc_uri.parsed_server_name)
+
+        with self.assertRaises(ValueError):
+            MXCUri("user@matrix.org", "abcdef").parsed_server_name
+
+
+class ServerNameCacheTestCase(TestCase):
+    def tearDown(self) -> None:
+        set_server_name_interning(False)
+        set_server_name_parse_cache_size(DEFAULT_SERVER_NAME_PARSE_CACHE_SIZE)
+        clear_server_name_parse_cache()
+
+    def test_parse_cache(self) -> None:
+        """Tests that parsed server names are cached."""
+        clear_server_name_parse_cache()
+        set_server_name_parse_cache_size(2)
+        server_name = ServerName.from_str("example.com")
+        self.assertIs(ServerName.from_str("example.com"), server_name)
+        ServerName.from_str("example.com:1")
+        ServerName.from_str("example.com:2")
+
+        info = server_name_parse_cache_info()
+        self.assertEqual(info.hits, 1)
+        self.assertEqual(info.misses, 3)
+        self.assertEqual(info.evictions, 1)
+        self.assertEqual(info.currsize, 2)
+
+        # Invalid server names are not cached.
+        with self.assertRaises(ValueError):
+            ServerName.from_str("example.com:")
+        self.assertEqual(server_name_parse_cache_info().currsize, 2)
+
+    def test_parse_cache_subclass(self) -> None:
+        """Tests that subclasses do not receive cached instances of other classes."""
+
+        class SubServerName(ServerName):
+            pass
+
+        ServerName.from_str("example.com")
+        self.assertIsInstance(SubServerName.from_str("example.com"), SubServerName)
+
+    def test_no_intern(self) -> None:
+        """Tests that parsed server names are not interned by default."""
+        set_server_name_parse_cache_size(0)
+        server_name = ServerName.from_str("example.com")
+        self.assertEqual(ServerName.from_str("example.com"), server_name)
+        self.assertIsNot(ServerName.from_str("example.com"), server_name)
+
+    def test_intern(self) -> None:
+        """Tests that equal server names are interned when enabled, without the cache."""
+        set_server_name_parse_cache_size(0)
+        set_server_name_interning(True)
+        server_name = ServerName.from_str("".join(["example", ".com"]))
+        self.assertIs(server_name.host, sys.intern("example.com"))
+        self.assertIs(ServerName.from_str("example.com"), server_name)
+        self.assertIs(
+            ServerName("example.com", None, ServerNameKind.DNS).intern(), server_name
+        )
+        self.assertEqual(server_name_parse_cache_info().currsize, 0)
+
+    def test_intern_key(self) -> None:
+        """Tests that interned server names do not keep copies of their host alive."""
+        # Distinct copies of an already interned host.
+        interned = sys.intern("".join(["intern-key", ".example"]))
+        server_names = [
+            ServerName("".join(["intern-key", ".example"]), None, ServerNameKind.DNS)
+            for _ in range(3)
+        ]
+        canonical = [server_name.intern() for server_name in server_names]
+        self.assertIs(canonical[1], canonical[0])
+        self.assertIs(canonical[0].host, interned)
+
+        keys = [key for key in _interned.keys() if key[1] == interned]
+        self.assertEqual(len(keys), 1)
+        self.assertIs(keys[0][1], interned)